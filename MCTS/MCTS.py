@@ -5,6 +5,7 @@ import copy
 from termcolor import colored
 import ipdb
 from tqdm import tqdm
+from utils import utils_environment as utils_env
 
 class MCTS:
     def __init__(self, env, agent_id, char_index, max_episode_length, num_simulation, max_rollout_step, c_init, c_base, agent_params, seed=1):
@@ -23,6 +24,10 @@ class MCTS:
         self.last_opened = None
         self.verbose = False
         self.agent_params = agent_params
+        # Memoize the heuristic plans, keyed on the parts of the state they depend on
+        self.heuristic_cache = None
+        if agent_params.get('heuristic_cache', False):
+            self.heuristic_cache = utils_env.HeuristicCache(agent_id, char_index, agent_params.get('heuristic_cache_size', 100000))
         np.random.seed(self.seed)
         random.seed(self.seed)
 
@@ -259,8 +264,7 @@ class MCTS:
             # print(subgoals)
             # print(subgoals[list_goals[rollout_step]])
             goal_selected = subgoals[list_goals[rollout_step]][0]
-            heuristic = self.heuristic_dict[goal_selected.split('_')[0]]
-            actions, costs = heuristic(self.agent_id, self.char_index, unsatisfied, curr_state, self.env, goal_selected)
+            actions, costs = self.get_heuristic_actions(goal_selected, unsatisfied, curr_state)
             
             # print(actions)
 
@@ -395,8 +399,7 @@ class MCTS:
         goals_expanded = 0
         for goal_predicate in subgoals:
             goal, predicate, aug_predicate = goal_predicate[0], goal_predicate[1], goal_predicate[2] # subgoal, goal predicate, the new satisfied predicate
-            heuristic = self.heuristic_dict[goal.split('_')[0]]
-            actions_heuristic, costs = heuristic(self.agent_id, self.char_index, unsatisfied, state, self.env, goal)
+            actions_heuristic, costs = self.get_heuristic_actions(goal, unsatisfied, state)
             if actions_heuristic is None:
                 continue
             cost = sum(costs)
@@ -431,6 +434,12 @@ class MCTS:
             return None
         return node
 
+    def get_heuristic_actions(self, subgoal, unsatisfied, state):
+        heuristic = self.heuristic_dict[subgoal.split('_')[0]]
+        if self.heuristic_cache is not None:
+            return self.heuristic_cache.get_actions(heuristic, unsatisfied, state, self.env, subgoal)
+        return heuristic(self.agent_id, self.char_index, unsatisfied, state, self.env, subgoal)
+
     def get_action_str(self, action_tuple):
         obj_args = [x for x in list(action_tuple)[1:] if x is not None]
         objects_str = ' '.join(['<{}> ({})'.format(x[0], x[1]) for x in obj_args])
@@ -1,6 +1,7 @@
 import random
 import numpy as np
-from envs.graph_env import VhGraphEnv
+from collections import OrderedDict
+from envs.graph_env import VhGraphEnv, state_snapshot, get_state_delta
 from anytree import AnyNode as Node
 import copy
 from termcolor import colored
@@ -10,10 +11,56 @@ from termcolor import colored
 
 from tqdm import tqdm
 from utils import utils_environment as utils_env
+from utils import utils_graph
+from utils.utils_goals import GoalProgressTracker
 import traceback
 from evolving_graph.environment import Relation
 from utils import utils_exception
 
+class TranspositionEntry:
+    def __init__(self):
+        self.num_visited = 0
+        self.sum_value = 0.
+        # action_str -> (vh_state, state, cost, reward, progress) after the action
+        self.successors = {}
+
+
+class TranspositionTable:
+    """
+    Shares visits, values and transitions between tree nodes that reach the same state
+    with different orders of actions. States are identified by all their edges and node states,
+    so a node reusing the transition of another one gets the same successor state.
+    Holds at most max_size states, evicted in LRU order.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def state_key(self, graph):
+        edges = frozenset(utils_graph.get_edges(graph))
+        node_states = frozenset([(node['id'], frozenset(node['states'])) for node in graph['nodes']])
+        return edges, node_states
+
+    def get(self, graph):
+        key = self.state_key(graph)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = TranspositionEntry()
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def get_successor(self, entry, action_str):
+        if action_str in entry.successors:
+            self.hits += 1
+            return entry.successors[action_str]
+        self.misses += 1
+        return None
+
+
 class MCTS_particles_v2:
     def __init__(self, gt_graph, agent_id, char_index, max_episode_length, num_simulation, max_rollout_step, c_init, c_base, agent_params, seed=1, add_bp=False):
         self.env = None
@@ -33,6 +80,18 @@ class MCTS_particles_v2:
         self.any_verbose = False
         self.verbose = False
         self.agent_params = agent_params
+        # Use CompactGraph for the states of the tree, instead of dicts
+        self.compact_graph = agent_params.get('compact_graph', False)
+        # Update the goal progress from the changes of every transition, instead of checking all the edges
+        self.incremental_progress = agent_params.get('incremental_progress', False)
+        # Share statistics and transitions between nodes reaching the same state
+        self.use_transposition_table = agent_params.get('transposition_table', False)
+        self.transposition_table_size = agent_params.get('transposition_table_size', 10000)
+        self.transposition_table = None
+        # Memoize the heuristic plans, keyed on the parts of the state they depend on
+        self.heuristic_cache = None
+        if agent_params.get('heuristic_cache', False):
+            self.heuristic_cache = utils_env.HeuristicCache(agent_id, char_index, agent_params.get('heuristic_cache_size', 100000))
         self.gt_graph = copy.deepcopy(gt_graph)
         np.random.seed(self.seed)
         random.seed(self.seed)
@@ -44,6 +103,8 @@ class MCTS_particles_v2:
         for key, value in goal_spec.items():
             if key.startswith('off'):
                 count += value
+        if utils_graph.is_compact(state):
+            return count + self.check_progress_compact(state, goal_spec)
         id2node = {node['id']: node for node in state['nodes']}
         class2id = {}
 
@@ -78,28 +139,63 @@ class MCTS_particles_v2:
                         count += 1
 
         return count
-        
+
+    def check_progress_compact(self, graph, goal_spec):
+        """Same as check_progress, only visiting the edges of the goal nodes"""
+        count = 0
+        for key, value in goal_spec.items():
+            elements = key.split('_')
+            if elements[0] in ['on', 'inside', 'offOn']:
+                relation = 'inside' if elements[0] == 'inside' else 'on'
+                for from_id in graph.get_node_ids_to(int(elements[2]), lambda rel: rel.lower() == relation):
+                    if graph.node(from_id)['class_name'] == elements[1] or str(from_id) == elements[1]:
+                        count += -1 if elements[0] == 'offOn' else 1
+            elif elements[0] == 'holds':
+                for to_id in graph.get_node_ids_from(int(elements[2]), lambda rel: rel.lower().startswith('holds')):
+                    if graph.node(to_id)['class_name'] == elements[1]:
+                        count += 1
+            elif elements[0] == 'sit':
+                for to_id in graph.get_node_ids_from(int(elements[1]), lambda rel: rel.lower().startswith('on')):
+                    if to_id == int(elements[2]):
+                        count += 1
+            if elements[0] == 'turnOn':
+                if 'ON' in graph.node(int(elements[1]))['states']:
+                    count += 1
+            if elements[0] == 'touch':
+                for id_touch in graph.class2id[elements[1]]:
+                    if 'TOUCHED' in [st.upper() for st in graph.node(id_touch)['states']]:
+                        count += 1
+        return count
+
     def run(self, curr_root, t, heuristic_dict, plan, opponent_subgoal):
-        self.env = VhGraphEnv()
-        self.env.pomdp = True
-        self.env.reset(copy.deepcopy(self.gt_graph))
-
-        if not self.env.state is None:
-            self.id2node_env =  {node['id']: node for node in self.env.state['nodes']}
-            static_classes = [
-                'bathroomcabinet',
-                'kitchencabinet',
-                'cabinet',
-                'fridge',
-                'stove',
-                'dishwasher',
-                'microwave',
-                'kitchentable',
-            ]
-            self.static_object_ids = [node['id'] for node in self.env.state['nodes'] if node['class_name'] in static_classes]
+        # The environment only depends on gt_graph, reuse it when the planner is kept across plans
+        if self.env is None:
+            self.env = VhGraphEnv()
+            self.env.pomdp = True
+            self.env.reset(copy.deepcopy(self.gt_graph))
+
+            if not self.env.state is None:
+                self.id2node_env =  {node['id']: node for node in self.env.state['nodes']}
+                static_classes = [
+                    'bathroomcabinet',
+                    'kitchencabinet',
+                    'cabinet',
+                    'fridge',
+                    'stove',
+                    'dishwasher',
+                    'microwave',
+                    'kitchentable',
+                ]
+                self.static_object_ids = [node['id'] for node in self.env.state['nodes'] if node['class_name'] in static_classes]
 
         state_particle = curr_root.state
         unsatisfied = state_particle[-1]
+        if self.incremental_progress and getattr(curr_root, 'progress', None) is None:
+            curr_root.progress = GoalProgressTracker(curr_root.id[1][0], state_particle[1])
+        if self.use_transposition_table:
+            # The states of the table are only comparable within a particle
+            self.transposition_table = TranspositionTable(self.transposition_table_size)
+            curr_root.tt_entry = self.transposition_table.get(state_particle[1])
         #print(colored("Goal:", "green"), curr_root.id[1][0])
         #print(unsatisfied)
         #print(colored('-----', "green"))
@@ -238,6 +334,9 @@ class MCTS_particles_v2:
                 pass
                 #ipdb.set_trace()
         
+        if self.any_verbose:
+            print(colored("Cache stats: {}".format(self.cache_stats()), "green"))
+
         next_root = None
         plan = []
         subgoals = []
@@ -294,6 +393,7 @@ class MCTS_particles_v2:
         curr_vh_state, curr_state, satisfied, unsatisfied = state_particle
         last_reward = lrw
         curr_vh_state = copy.deepcopy(curr_vh_state)
+        progress = getattr(leaf_node, 'progress', None)
 
         # TODO: we should start with goals at random, or with all the goals
         # Probably not needed here since we already computed whern expanding node
@@ -308,7 +408,7 @@ class MCTS_particles_v2:
                 
 
             # If you have an object grabbed already reduce the subgoal space search and add the object you already had
-            hands_busy = [edge['to_id'] for edge in curr_state['edges'] if 'HOLD' in edge['relation_type']]
+            hands_busy = [to_id for _, _, to_id in utils_graph.get_edges(curr_state, lambda rel: 'HOLD' in rel)]
 
             unsatisfied_aux = unsatisfied.copy()
             subgoals_hand = []
@@ -361,11 +461,7 @@ class MCTS_particles_v2:
                 goal_selected = subgoals[curr_goal][0]
                 last_goal = goal_selected
 
-            heuristic = self.heuristic_dict[goal_selected.split('_')[0]]
-
-
-
-            actions, _ = heuristic(self.agent_id, self.char_index, unsatisfied, curr_state, self.env, goal_selected)
+            actions, _ = self.get_heuristic_actions(goal_selected, unsatisfied, curr_state)
             if verbose:
                 print(hands_busy)
                 print("Rollout: ", rollout_step)
@@ -390,7 +486,7 @@ class MCTS_particles_v2:
                 
                 action_str = self.get_action_str(action)
                 try:
-                    success, next_vh_state, next_vh_state_dict, cost, curr_reward = self.transition(curr_vh_state, {0: action_str}, goal_spec)
+                    success, next_vh_state, next_vh_state_dict, cost, curr_reward, progress = self.transition(curr_vh_state, {0: action_str}, goal_spec, progress)
                 except:
                     raise Exception
                     #traceback.print_exc() 
@@ -412,7 +508,10 @@ class MCTS_particles_v2:
             actions_l.append(action)
 
             # print(action_str, curr_reward)
-            satisfied, unsatisfied = utils_env.check_progress(curr_state, goal_spec)
+            if progress is not None:
+                satisfied, unsatisfied = progress.progress()
+            else:
+                satisfied, unsatisfied = utils_env.check_progress(curr_state, goal_spec)
 
             # curr_state = next_state
         # ipdb.set_trace()
@@ -436,7 +535,11 @@ class MCTS_particles_v2:
         return sum_reward, rewards, actions_l
 
 
-    def transition(self, curr_vh_state, action, goal_spec):
+    def transition(self, curr_vh_state, action, goal_spec, progress=None):
+        """
+        If progress, the GoalProgressTracker of curr_vh_state, is given, the reward is computed
+        from the changes of the transition and the tracker of the new state is returned.
+        """
         cost = 0.
         # graph = curr_vh_state.to_dict()
         # id2node = {node['id']: node for node in graph['nodes']}
@@ -502,16 +605,25 @@ class MCTS_particles_v2:
             print(colored("missing action {}".format(action[0]), "red"))
         # vdict = curr_vh_state.to_dict()
         # print("HANDS", [edge for edge in vdict['edges'] if 'HOLD' in edge['relation_type']])
+        if progress is not None:
+            snapshot = state_snapshot(curr_vh_state)
         success, next_vh_state = self.env.transition(curr_vh_state, action)
         #print(type(next_vh_state), type(curr_vh_state))
-        dict_vh_state = next_vh_state.to_dict()
-        reward = self.check_progress(dict_vh_state, goal_spec)
+        if self.compact_graph:
+            dict_vh_state = next_vh_state.to_compact()
+        else:
+            dict_vh_state = next_vh_state.to_dict()
+        if progress is not None:
+            progress = progress.child(*get_state_delta(snapshot, next_vh_state))
+            reward = progress.reward()
+        else:
+            reward = self.check_progress(dict_vh_state, goal_spec)
         
-        return success, next_vh_state, dict_vh_state, cost, reward
+        return success, next_vh_state, dict_vh_state, cost, reward, progress
 
     def calculate_score(self, curr_node, child, num_actions, info=False):
-        parent_visit_count = curr_node.num_visited
-        self_visit_count = child.num_visited
+        parent_visit_count, _ = self.node_statistics(curr_node)
+        self_visit_count, self_sum_value = self.node_statistics(child)
         subgoal_prior = 1.0/num_actions
 
         if self_visit_count == 0:
@@ -522,7 +634,7 @@ class MCTS_particles_v2:
                                       self.c_base) + self.c_init
             u_score = exploration_rate * subgoal_prior * np.sqrt(
                 parent_visit_count) / float(1 + self_visit_count)
-            q_score = child.sum_value / self_visit_count
+            q_score = self_sum_value / self_visit_count
 
         score = q_score + u_score
         if info:
@@ -530,6 +642,13 @@ class MCTS_particles_v2:
         return score
 
 
+    def node_statistics(self, node):
+        """Visits and value of a node, shared with the nodes of the same state if using the transposition table"""
+        tt_entry = getattr(node, 'tt_entry', None)
+        if tt_entry is not None:
+            return tt_entry.num_visited, tt_entry.sum_value
+        return node.num_visited, node.sum_value
+
     def select_child(self, curr_node, curr_state):
         # print("Child...", actions)
         possible_children = [child for child in curr_node.children]
@@ -588,10 +707,22 @@ class MCTS_particles_v2:
         # print('.....')
         if selected_child.state is None:
 
-            # print("New action", actions)
-            next_vh_state = copy.deepcopy(next_vh_state)
+            successor = None
+            parent_entry = getattr(curr_node, 'tt_entry', None)
+            if self.transposition_table is not None and parent_entry is not None:
+                successor = self.transposition_table.get_successor(parent_entry, actions)
+            if successor is not None:
+                # Another node reached this state, reuse its transition
+                success = True
+                next_vh_state, next_state_dict, cost, reward, progress = successor
+            else:
+                # print("New action", actions)
+                next_vh_state = copy.deepcopy(next_vh_state)
 
-            success, next_vh_state, next_state_dict, cost, reward = self.transition(next_vh_state, {0: actions}, goal_spec)
+                progress = getattr(curr_node, 'progress', None)
+                success, next_vh_state, next_state_dict, cost, reward, progress = self.transition(next_vh_state, {0: actions}, goal_spec, progress)
+                if success and self.transposition_table is not None and parent_entry is not None:
+                    parent_entry.successors[actions] = (next_vh_state, next_state_dict, cost, reward, progress)
             # if 'put' in actions:
             #      print("CLOSE:", [edge for edge in next_state_dict['edges'] if edge['to_id'] == 232 and edge['from_id'] == 1])
             if not success:
@@ -599,10 +730,16 @@ class MCTS_particles_v2:
             # final_vh_state = copy.deepcopy(next_vh_state)
             final_vh_state = next_vh_state
             final_state = next_state_dict
-            satisfied, unsatisfied = utils_env.check_progress(final_state, goal_spec)
+            if progress is not None:
+                satisfied, unsatisfied = progress.progress()
+            else:
+                satisfied, unsatisfied = utils_env.check_progress(final_state, goal_spec)
             next_state = (final_vh_state, final_state, satisfied, unsatisfied)
             
             selected_child.state = next_state
+            selected_child.progress = progress
+            if self.transposition_table is not None:
+                selected_child.tt_entry = self.transposition_table.get(final_state)
             selected_child.cost = cost
             selected_child.reward = reward
         else:
@@ -685,6 +822,7 @@ class MCTS_particles_v2:
             print(colored("ROLLOUT", "yellow"))
             print(value, reward_rollout, actions_rollout)
             print("======")
+        tt_entries_updated = set()
         while t >= 0:
             node = node_list[t]
             curr_reward = delta_reward[t]
@@ -694,6 +832,13 @@ class MCTS_particles_v2:
             node.sum_value += curr_value
             node.num_visited += 1
 
+            # A state may appear twice in the path, count the visit once
+            tt_entry = getattr(node, 'tt_entry', None)
+            if tt_entry is not None and id(tt_entry) not in tt_entries_updated:
+                tt_entries_updated.add(id(tt_entry))
+                tt_entry.sum_value += curr_value
+                tt_entry.num_visited += 1
+
             avg_value = node.sum_value/node.num_visited
 
             if self.verbose:
@@ -762,7 +907,7 @@ class MCTS_particles_v2:
 
         # If you have an object grabbed already reduce the subgoal space search and add the object you already had
         curr_state = state
-        hands_busy = [edge['to_id'] for edge in curr_state['edges'] if 'HOLD' in edge['relation_type']]
+        hands_busy = [to_id for _, _, to_id in utils_graph.get_edges(curr_state, lambda rel: 'HOLD' in rel)]
 
         unsatisfied_aux = unsatisfied.copy()
         subgoals_hand = []
@@ -795,7 +940,7 @@ class MCTS_particles_v2:
         current_action = node.id[-1][-1]
 
 
-        hands_busy = [edge['to_id'] for edge in state_particle[1]['edges'] if 'HOLD' in edge['relation_type']]
+        hands_busy = [to_id for _, _, to_id in utils_graph.get_edges(state_particle[1], lambda rel: 'HOLD' in rel)]
         
         if len(hands_busy) == 2:
             subgoals = [subg for subg in subgoals if int(subg[0].split('_')[1]) in hands_busy]
@@ -803,8 +948,7 @@ class MCTS_particles_v2:
         act_all = []
         for goal_predicate in subgoals:
             goal, predicate, aug_predicate = goal_predicate[0], goal_predicate[1], goal_predicate[2] # subgoal, goal predicate, the new satisfied predicate
-            heuristic = self.heuristic_dict[goal.split('_')[0]]
-            action_heuristic,  _ = heuristic(self.agent_id, self.char_index, unsatisfied, state, self.env, goal)
+            action_heuristic,  _ = self.get_heuristic_actions(goal, unsatisfied, state)
             act_all.append((action_heuristic, goal))
 
             # TODO(xavier): this crashes sometimes!! Check what is happening
@@ -871,6 +1015,26 @@ class MCTS_particles_v2:
         #     return None, []
         return node, actions_heuristic
 
+    def get_heuristic_actions(self, subgoal, unsatisfied, state):
+        heuristic = self.heuristic_dict[subgoal.split('_')[0]]
+        if self.heuristic_cache is not None:
+            return self.heuristic_cache.get_actions(heuristic, unsatisfied, state, self.env, subgoal)
+        return heuristic(self.agent_id, self.char_index, unsatisfied, state, self.env, subgoal)
+
+    def cache_stats(self):
+        """Hits and hit rates of the heuristic cache and the transposition table"""
+        stats = {}
+        if self.heuristic_cache is not None:
+            stats['heuristic_hits'] = self.heuristic_cache.hits
+            stats['heuristic_misses'] = self.heuristic_cache.misses
+            stats['heuristic_hit_rate'] = self.heuristic_cache.hit_rate()
+        if self.transposition_table is not None:
+            total = self.transposition_table.hits + self.transposition_table.misses
+            stats['transition_hits'] = self.transposition_table.hits
+            stats['transition_misses'] = self.transposition_table.misses
+            stats['transition_hit_rate'] = self.transposition_table.hits * 1. / total if total > 0 else 0.
+        return stats
+
     def get_action_str(self, action_tuple):
         obj_args = [x for x in list(action_tuple)[1:] if x is not None]
         objects_str = ' '.join(['<{}> ({})'.format(x[0], x[1]) for x in obj_args])
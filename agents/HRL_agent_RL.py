@@ -1,5 +1,5 @@
 import torch
-from models import actor_critic, actor_critic_hl_mcts
+from models import actor_critic, actor_critic_hl_mcts, policy_export
 from gym import spaces
 from utils import utils_rl_agent
 import numpy as np
@@ -389,6 +389,16 @@ class HRL_agent_RL:
 
         self.actor_critic.base.main.main.bad_transformer = False
 
+        # Models used to act, the TorchScript policies exported by models/policy_export.py if given
+        self.policies = {
+            'high_level': self.actor_critic,
+            'low_level': self.actor_critic_low_level,
+            'low_level_put': self.actor_critic_low_level_put
+        }
+        compiled_policy = getattr(args, 'compiled_policy', '')
+        if len(compiled_policy) > 0:
+            self.policies = policy_export.load_compiled_policies(compiled_policy, self.policies)
+
         self.id2node = None
         self.hidden_state = self.init_hidden_state()
         self.hidden_state_low_level = self.init_hidden_state()
@@ -446,7 +456,23 @@ class HRL_agent_RL:
         pass
 
     def get_action(self, observation, goal_spec, action_space_ids=None, action_indices=None, full_graph=None):
+        step_inputs = self.prepare_action(observation, goal_spec, action_space_ids=action_space_ids, full_graph=full_graph)
+        policy_output = None
+        if step_inputs['act']:
+            policy_output = self.policies['high_level'].act(
+                step_inputs['inputs_tensor'],
+                step_inputs['rnn_hxs'],
+                step_inputs['masks'],
+                deterministic=self.deterministic,
+                epsilon=self.epsilon,
+                action_indices=action_indices)
+        return self.finish_action(step_inputs, policy_output)
 
+    def prepare_action(self, observation, goal_spec, action_space_ids=None, full_graph=None):
+        """
+        Inputs of the high level policy, as in HRL_agent.prepare_action. The low level policies are run
+        in finish_action
+        """
         # ipdb.set_trace()
         print("GETTING ACTION")
         full_graph = None
@@ -528,19 +554,35 @@ class HRL_agent_RL:
                 inp_tensor = inp_tensor.float()
             inputs_tensor[input_name] = inp_tensor
 
+        return {
+            'act': self.action_count == 0,
+            'inputs': inputs,
+            'inputs_ll': inputs_ll,
+            'inputs_tensor': inputs_tensor,
+            'rnn_hxs': rnn_hxs,
+            'rnn_hxs_low_level': rnn_hxs_low_level,
+            'rnn_hxs_low_level_put': rnn_hxs_low_level_put,
+            'masks': masks,
+            'observation': observation,
+            'observation_belief': observation_belief,
+            'visible_objects': visible_objects,
+            'action_space_ids': action_space_ids
+        }
+
+    def finish_action(self, step_inputs, policy_output=None):
+        """Second part of get_action, policy_output is the output of the high level policy if step_inputs['act']"""
+        inputs, inputs_ll, inputs_tensor = step_inputs['inputs'], step_inputs['inputs_ll'], step_inputs['inputs_tensor']
+        rnn_hxs_low_level, rnn_hxs_low_level_put = step_inputs['rnn_hxs_low_level'], step_inputs['rnn_hxs_low_level_put']
+        masks = step_inputs['masks']
+        observation, observation_belief = step_inputs['observation'], step_inputs['observation_belief']
+        visible_objects, action_space_ids = step_inputs['visible_objects'], step_inputs['action_space_ids']
 
         # ipdb.set_trace()
 
-        if self.action_count == 0:
+        if step_inputs['act']:
             self.last_action_low_level = None
             self.hidden_state_low_level = self.init_hidden_state()
-            value, action, action_probs, rnn_state, out_dict = self.actor_critic.act(
-                inputs_tensor,
-                rnn_hxs,
-                masks,
-                deterministic=self.deterministic,
-                epsilon=self.epsilon,
-                action_indices=action_indices)
+            value, action, action_probs, rnn_state, out_dict = policy_output
 
             self.hidden_state = rnn_state
             info_model = {}
@@ -640,11 +682,11 @@ class HRL_agent_RL:
                     inputs_tensor_ll[input_name] = inp_tensor
 
                 if self.put_policy is False:
-                    value_ll, action_ll, action_probs_ll, rnn_state_ll, out_dict_ll = self.actor_critic_low_level.act(inputs_tensor_ll, rnn_hxs_low_level, masks)
+                    value_ll, action_ll, action_probs_ll, rnn_state_ll, out_dict_ll = self.policies['low_level'].act(inputs_tensor_ll, rnn_hxs_low_level, masks)
                     self.hidden_state_low_level_put = self.init_hidden_state()
                     self.hidden_state_low_level = rnn_state_ll
                 else:
-                    value_ll, action_ll, action_probs_ll, rnn_state_ll, out_dict_ll = self.actor_critic_low_level_put.act(
+                    value_ll, action_ll, action_probs_ll, rnn_state_ll, out_dict_ll = self.policies['low_level_put'].act(
                         inputs_tensor_ll, rnn_hxs_low_level_put, masks)
                     self.hidden_state_low_level_put = rnn_state_ll
                     self.hidden_state_low_level = self.init_hidden_state()
@@ -1,5 +1,5 @@
 import torch
-from models import actor_critic, actor_critic_hl_mcts
+from models import actor_critic, actor_critic_hl_mcts, policy_export
 from gym import spaces
 from utils import utils_rl_agent
 import numpy as np
@@ -383,6 +383,13 @@ class HRL_agent:
         self.actor_critic = actor_critic_hl_mcts.ActorCritic(self.action_space, base_name=args.base_net,
                                                              base_kwargs=base_kwargs, seed=seed)
         self.actor_critic.base.main.main.bad_transformer = False
+
+        # Models used to act, the TorchScript policies exported by models/policy_export.py if given
+        self.policies = {'high_level': self.actor_critic}
+        compiled_policy = getattr(args, 'compiled_policy', '')
+        if len(compiled_policy) > 0:
+            self.policies = policy_export.load_compiled_policies(compiled_policy, self.policies)
+
         self.id2node = None
         self.hidden_state = self.init_hidden_state()
 
@@ -433,6 +440,23 @@ class HRL_agent:
         pass
 
     def get_action(self, observation, goal_spec, action_space_ids=None, action_indices=None, full_graph=None):
+        step_inputs = self.prepare_action(observation, goal_spec, action_space_ids=action_space_ids, full_graph=full_graph)
+        policy_output = None
+        if step_inputs['act']:
+            policy_output = self.policies['high_level'].act(
+                step_inputs['inputs_tensor'],
+                step_inputs['rnn_hxs'],
+                step_inputs['masks'],
+                deterministic=self.deterministic,
+                epsilon=self.epsilon,
+                action_indices=action_indices)
+        return self.finish_action(step_inputs, policy_output)
+
+    def prepare_action(self, observation, goal_spec, action_space_ids=None, full_graph=None):
+        """
+        First part of get_action: belief and inputs of the policy. step_inputs['act'] says whether the policy
+        has to be run in this step. Split so that algos/vec_arena.py can run the policy of many agents in a batch
+        """
         # ipdb.set_trace()
         if full_graph is not None:
             observation_belief = self.sample_belief(full_graph)
@@ -501,14 +525,29 @@ class HRL_agent:
                 inp_tensor = inp_tensor.float()
             inputs_tensor[input_name] = inp_tensor
 
-        if self.action_count == 0:
-            value, action, action_probs, rnn_state, out_dict = self.actor_critic.act(
-                inputs_tensor,
-                rnn_hxs,
-                masks,
-                deterministic=self.deterministic,
-                epsilon=self.epsilon,
-                action_indices=action_indices)
+        return {
+            'act': self.action_count == 0,
+            'inputs': inputs,
+            'inputs_tensor': inputs_tensor,
+            'rnn_hxs': rnn_hxs,
+            'masks': masks,
+            'observation': observation,
+            'observation_belief': observation_belief,
+            'visible_objects': visible_objects,
+            'action_space_ids': action_space_ids,
+            'obj_pred_names': obj_pred_names,
+            'loc_pred_names': loc_pred_names
+        }
+
+    def finish_action(self, step_inputs, policy_output=None):
+        """Second part of get_action, policy_output is the output of the policy act if step_inputs['act']"""
+        inputs, inputs_tensor = step_inputs['inputs'], step_inputs['inputs_tensor']
+        observation, observation_belief = step_inputs['observation'], step_inputs['observation_belief']
+        visible_objects, action_space_ids = step_inputs['visible_objects'], step_inputs['action_space_ids']
+        obj_pred_names, loc_pred_names = step_inputs['obj_pred_names'], step_inputs['loc_pred_names']
+
+        if step_inputs['act']:
+            value, action, action_probs, rnn_state, out_dict = policy_output
 
             self.hidden_state = rnn_state
             info_model = {}
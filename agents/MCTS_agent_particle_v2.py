@@ -8,6 +8,7 @@ import copy
 import importlib
 import json
 import multiprocessing as mp
+import queue
 from functools import partial
 import ipdb
 import pdb
@@ -24,16 +25,16 @@ import sys
 sys.path.append('..')
 from utils import utils_environment as utils_env
 from utils import utils_exception
+from utils import utils_graph
 
 
 def find_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, object_target):
     observations = simulator.get_observations(env_graph, char_index=char_index)
-    id2node = {node['id']: node for node in env_graph['nodes']}
-    containerdict = {edge['from_id']: edge['to_id'] for edge in env_graph['edges'] if edge['relation_type'] == 'INSIDE'}
+    id2node = utils_graph.get_id2node(env_graph)
     target = int(object_target.split('_')[-1])
     observation_ids = [x['id'] for x in observations['nodes']]
     try:
-        room_char = [edge['to_id'] for edge in env_graph['edges'] if edge['from_id'] == agent_id and edge['relation_type'] == 'INSIDE'][0]
+        room_char = utils_graph.get_node_ids_from(env_graph, agent_id, 'INSIDE')[0]
     except:
         print('Error')
         #ipdb.set_trace()
@@ -44,7 +45,7 @@ def find_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, obje
     #     )ipdb.set_trace()
     while target not in observation_ids:
         try:
-            container = containerdict[target]
+            container = utils_graph.get_node_ids_from(env_graph, target, 'INSIDE')[-1]
         except:
             print(id2node[target])
             raise Exception
@@ -79,9 +80,10 @@ def touch_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, obj
     target_id = int(object_target.split('_')[-1])
 
     observed_ids = [node['id'] for node in observations['nodes']]
-    agent_close = [edge for edge in env_graph['edges'] if ((edge['from_id'] == agent_id and edge['to_id'] == target_id) or (edge['from_id'] == target_id and edge['to_id'] == agent_id) and edge['relation_type'] == 'CLOSE')]
+    agent_close = [to_id for to_id in utils_graph.get_node_ids_from(env_graph, agent_id) if to_id == target_id] + \
+                  [to_id for to_id in utils_graph.get_node_ids_from(env_graph, target_id, 'CLOSE') if to_id == agent_id]
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_id][0]
+    target_node = utils_graph.get_node(env_graph, target_id)
 
     target_action = [('touch', (target_node['class_name'], target_id), None)]
     cost = [0.05]
@@ -97,10 +99,11 @@ def grab_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, obje
     target_id = int(object_target.split('_')[-1])
 
     observed_ids = [node['id'] for node in observations['nodes']]
-    agent_close = [edge for edge in env_graph['edges'] if ((edge['from_id'] == agent_id and edge['to_id'] == target_id) or (edge['from_id'] == target_id and edge['to_id'] == agent_id) and edge['relation_type'] == 'CLOSE')]
-    grabbed_obj_ids = [edge['to_id'] for edge in env_graph['edges'] if (edge['from_id'] == agent_id and 'HOLDS' in edge['relation_type'])]
+    agent_close = [to_id for to_id in utils_graph.get_node_ids_from(env_graph, agent_id) if to_id == target_id] + \
+                  [to_id for to_id in utils_graph.get_node_ids_from(env_graph, target_id, 'CLOSE') if to_id == agent_id]
+    grabbed_obj_ids = utils_graph.get_node_ids_from(env_graph, agent_id, lambda rel: 'HOLDS' in rel)
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_id][0]
+    target_node = utils_graph.get_node(env_graph, target_id)
 
     if target_id not in grabbed_obj_ids:
         target_action = [('grab', (target_node['class_name'], target_id), None)]
@@ -120,10 +123,11 @@ def turnOn_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, ob
     target_id = int(object_target.split('_')[-1])
 
     observed_ids = [node['id'] for node in observations['nodes']]
-    agent_close = [edge for edge in env_graph['edges'] if ((edge['from_id'] == agent_id and edge['to_id'] == target_id) or (edge['from_id'] == target_id and edge['to_id'] == agent_id) and edge['relation_type'] == 'CLOSE')]
-    grabbed_obj_ids = [edge['to_id'] for edge in env_graph['edges'] if (edge['from_id'] == agent_id and 'HOLDS' in edge['relation_type'])]
+    agent_close = [to_id for to_id in utils_graph.get_node_ids_from(env_graph, agent_id) if to_id == target_id] + \
+                  [to_id for to_id in utils_graph.get_node_ids_from(env_graph, target_id, 'CLOSE') if to_id == agent_id]
+    grabbed_obj_ids = utils_graph.get_node_ids_from(env_graph, agent_id, lambda rel: 'HOLDS' in rel)
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_id][0]
+    target_node = utils_graph.get_node(env_graph, target_id)
 
     if target_id not in grabbed_obj_ids:
         target_action = [('switchon', (target_node['class_name'], target_id), None)]
@@ -143,10 +147,11 @@ def sit_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, objec
     target_id = int(object_target.split('_')[-1])
 
     observed_ids = [node['id'] for node in observations['nodes']]
-    agent_close = [edge for edge in env_graph['edges'] if ((edge['from_id'] == agent_id and edge['to_id'] == target_id) or (edge['from_id'] == target_id and edge['to_id'] == agent_id) and edge['relation_type'] == 'CLOSE')]
-    on_ids = [edge['to_id'] for edge in env_graph['edges'] if (edge['from_id'] == agent_id and 'ON' in edge['relation_type'])]
+    agent_close = [to_id for to_id in utils_graph.get_node_ids_from(env_graph, agent_id) if to_id == target_id] + \
+                  [to_id for to_id in utils_graph.get_node_ids_from(env_graph, target_id, 'CLOSE') if to_id == agent_id]
+    on_ids = utils_graph.get_node_ids_from(env_graph, agent_id, lambda rel: 'ON' in rel)
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_id][0]
+    target_node = utils_graph.get_node(env_graph, target_id)
 
     if target_id not in on_ids:
         target_action = [('sit', (target_node['class_name'], target_id), None)]
@@ -175,10 +180,10 @@ def put_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, targe
         # Object has been placed
         return [], []
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_grab][0]
-    target_node2 = [node for node in env_graph['nodes'] if node['id'] == target_put][0]
-    id2node = {node['id']: node for node in env_graph['nodes']}
-    target_grabbed = len([edge for edge in env_graph['edges'] if edge['from_id'] == agent_id and 'HOLDS' in edge['relation_type'] and edge['to_id'] == target_grab]) > 0
+    target_node = utils_graph.get_node(env_graph, target_grab)
+    target_node2 = utils_graph.get_node(env_graph, target_put)
+    id2node = utils_graph.get_id2node(env_graph)
+    target_grabbed = target_grab in utils_graph.get_node_ids_from(env_graph, agent_id, lambda rel: 'HOLDS' in rel)
 
 
     object_diff_room = None
@@ -219,10 +224,10 @@ def putIn_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, tar
         # Object has been placed
         return None, None
 
-    target_node = [node for node in env_graph['nodes'] if node['id'] == target_grab][0]
-    target_node2 = [node for node in env_graph['nodes'] if node['id'] == target_put][0]
-    id2node = {node['id']: node for node in env_graph['nodes']}
-    target_grabbed = len([edge for edge in env_graph['edges'] if edge['from_id'] == agent_id and 'HOLDS' in edge['relation_type'] and edge['to_id'] == target_grab]) > 0
+    target_node = utils_graph.get_node(env_graph, target_grab)
+    target_node2 = utils_graph.get_node(env_graph, target_put)
+    id2node = utils_graph.get_id2node(env_graph)
+    target_grabbed = target_grab in utils_graph.get_node_ids_from(env_graph, agent_id, lambda rel: 'HOLDS' in rel)
 
 
     object_diff_room = None
@@ -234,7 +239,8 @@ def putIn_heuristic(agent_id, char_index, unsatisfied, env_graph, simulator, tar
                 if id2node[id_room]['category'] == 'Rooms':
                     object_diff_room = id_room
         
-        env_graph_new = copy.deepcopy(env_graph)
+        # Edges are replaced, not modified, no need to copy them
+        env_graph_new = {'nodes': env_graph['nodes'], 'edges': list(env_graph['edges'])}
         
         if object_diff_room:
             env_graph_new['edges'] = [edge for edge in env_graph_new['edges'] if edge['to_id'] != agent_id and edge['from_id'] != agent_id]
@@ -350,16 +356,17 @@ def clean_graph(state, goal_spec, last_opened):
 
     return new_graph
 
+heuristic_dict = {
+    'find': find_heuristic,
+    'grab': grab_heuristic,
+    'put': put_heuristic,
+    'putIn': putIn_heuristic,
+    'sit': sit_heuristic,
+    'turnOn': turnOn_heuristic,
+    'touch': touch_heuristic
+}
+
 def mp_run_mcts(root_node, mcts, nb_steps, last_subgoal, opponent_subgoal):
-    heuristic_dict = {
-        'find': find_heuristic,
-        'grab': grab_heuristic,
-        'put': put_heuristic,
-        'putIn': putIn_heuristic,
-        'sit': sit_heuristic,
-        'turnOn': turnOn_heuristic,
-        'touch': touch_heuristic
-    }
     # res = root_node * 2
     try:
         new_mcts = copy.deepcopy(mcts)
@@ -375,65 +382,152 @@ def mp_run_mcts(root_node, mcts, nb_steps, last_subgoal, opponent_subgoal):
     return res
 
 
-def mp_run_2(process_id, root_node, mcts, nb_steps, last_subgoal, opponent_subgoal, res):
-    res[process_id] = mp_run_mcts(
-        root_node=root_node,
-        mcts=mcts, 
-        nb_steps=nb_steps, 
-        last_subgoal=last_subgoal, 
-        opponent_subgoal=opponent_subgoal)
-
-
-
-def get_plan(mcts, particles, env, nb_steps, goal_spec, last_subgoal, last_action, opponent_subgoal=None, num_process=10, verbose=True):    
-    root_nodes = []
-    for particle_id in range(len(particles)):
-        root_action = None
-        root_node = Node(id=(root_action, [copy.deepcopy(goal_spec), 0, []]),
-                         particle_id=particle_id,
-                         state=copy.deepcopy(particles[particle_id]),
-                         num_visited=0,
-                         sum_value=0,
-                         is_expanded=False)
-        root_nodes.append(root_node)
-    
+def planner_worker(mcts, task_queue, result_queue):
+    """
+    Long lived planning process. Keeps the mcts instance and the last graph of every particle
+    it was assigned, and only receives graph deltas for the following plans.
+    """
+    sim_env = VhGraphEnv()
+    particle_graphs = {}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        particle_id, delta, satisfied, unsatisfied, goal_spec, nb_steps, last_subgoal, opponent_subgoal, last_opened, task_seed = task
+        if delta['full']:
+            particle_graphs[particle_id] = delta['graph']
+        else:
+            particle_graphs[particle_id] = utils_env.apply_graph_delta(particle_graphs[particle_id], delta['graph'])
 
+        try:
+            init_state = copy.deepcopy(particle_graphs[particle_id])
+            init_vh_state = sim_env.get_vh_state(init_state)
+            root_node = Node(id=(None, [goal_spec, 0, []]),
+                             particle_id=particle_id,
+                             state=(init_vh_state, init_state, satisfied, unsatisfied),
+                             num_visited=0,
+                             sum_value=0,
+                             is_expanded=False)
+
+            # Plans should not depend on each other, as when copying the mcts for every plan.
+            # The worker plans several particles in a row, every plan gets its own random state
+            random.seed(task_seed)
+            np.random.seed(task_seed)
+            mcts.last_opened = last_opened
+            res = mcts.run(root_node, nb_steps, heuristic_dict, last_subgoal, opponent_subgoal)
+        except Exception as e:
+            res = utils_exception.ExceptionWrapper(e)
+        result_queue.put((particle_id, res))
+
+
+class PlannerPool:
+    """
+    Pool of planning processes, created once per episode. Every particle is always planned
+    by the same process, which allows sending only the changes in the particle graph.
+    """
+    def __init__(self, mcts, num_process, timeout=1800., poll_interval=5., seed=0):
+        self.num_process = num_process
+        # The plan of a particle is seeded with (seed, particle_id, number of plans)
+        self.seed = seed
+        self.num_plans = 0
+        # Seconds to wait for the plans of a step, and between checks that the processes are alive
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.result_queue = mp.Queue()
+        self.task_queues = []
+        self.processes = []
+        self.sent_graphs = {}
+        for _ in range(num_process):
+            task_queue = mp.Queue()
+            p = mp.Process(target=planner_worker, args=(mcts, task_queue, self.result_queue))
+            p.daemon = True
+            p.start()
+            self.task_queues.append(task_queue)
+            self.processes.append(p)
+
+    def run(self, particles, nb_steps, goal_spec, last_subgoal, opponent_subgoal, last_opened=None):
+        if len(self.processes) == 0:
+            raise Exception('The planning processes were terminated, a new PlannerPool is needed')
+        for particle_id, particle in enumerate(particles):
+            _, init_state, satisfied, unsatisfied = particle
+            if particle_id in self.sent_graphs:
+                delta = {'full': False, 'graph': utils_env.graph_delta(self.sent_graphs[particle_id], init_state)}
+            else:
+                delta = {'full': True, 'graph': init_state}
+            self.sent_graphs[particle_id] = copy.deepcopy(init_state)
+
+            task_seed = hash((self.seed, particle_id, self.num_plans)) % (2 ** 32)
+            task = (particle_id, delta, satisfied, unsatisfied, goal_spec, nb_steps, last_subgoal, opponent_subgoal, last_opened, task_seed)
+            self.task_queues[particle_id % self.num_process].put(task)
+        self.num_plans += 1
+
+        info = [None] * len(particles)
+        num_results = 0
+        start_time = time.time()
+        while num_results < len(particles):
+            try:
+                particle_id, res = self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [p.exitcode for p in self.processes if not p.is_alive()]
+                if len(dead) > 0:
+                    self.terminate()
+                    raise Exception('Planning process died (exit codes {})'.format(dead))
+                if time.time() - start_time > self.timeout:
+                    self.terminate()
+                    raise Exception('No plan after {} seconds'.format(self.timeout))
+                continue
+            info[particle_id] = res
+            num_results += 1
+        return info
+
+    def terminate(self):
+        # The processes may be stuck or dead, they are not asked to stop
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.processes = []
+        self.task_queues = []
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        self.task_queues = []
+
+
+def get_plan(mcts, particles, env, nb_steps, goal_spec, last_subgoal, last_action, opponent_subgoal=None, num_process=10, verbose=True, planner_pool=None):    
     length_plan = 5
-    # root_nodes = list(range(10))
-    mp_run = partial(mp_run_mcts, 
-        mcts=mcts, 
-        nb_steps=nb_steps, 
-        last_subgoal=last_subgoal, 
-        opponent_subgoal=opponent_subgoal)
-
-    if len(root_nodes) == 0:
+    if len(particles) == 0:
         print("No root nodes")
         raise Exception
     if num_process > 0:
-
-        manager = mp.Manager()
-        res = manager.dict()
-        num_root_nodes = len(root_nodes)
-        for start_root_id in range(0, num_root_nodes, num_process):
-            end_root_id = min(start_root_id + num_process, num_root_nodes)
-            jobs = []
-            for process_id in range(start_root_id, end_root_id):
-                # print(process_id)
-                p = mp.Process(target=mp_run_2,
-                               args=(process_id,
-                                     root_nodes[process_id],
-                                     mcts,
-                                     nb_steps,
-                                     last_subgoal,
-                                     opponent_subgoal,
-                                     res))
-                jobs.append(p)
-                p.start()
-            for p in jobs:
-                p.join()
-        info = [res[x] for x in range(len(root_nodes))]
+        if planner_pool is None:
+            pool = PlannerPool(mcts, num_process)
+        else:
+            pool = planner_pool
+        info = pool.run(particles, nb_steps, goal_spec, last_subgoal, opponent_subgoal, last_opened=mcts.last_opened)
+        if planner_pool is None:
+            pool.close()
 
     else:
+        root_nodes = []
+        for particle_id in range(len(particles)):
+            root_action = None
+            root_node = Node(id=(root_action, [copy.deepcopy(goal_spec), 0, []]),
+                             particle_id=particle_id,
+                             state=copy.deepcopy(particles[particle_id]),
+                             num_visited=0,
+                             sum_value=0,
+                             is_expanded=False)
+            root_nodes.append(root_node)
+        mp_run = partial(mp_run_mcts, 
+            mcts=mcts, 
+            nb_steps=nb_steps, 
+            last_subgoal=last_subgoal, 
+            opponent_subgoal=opponent_subgoal)
         info = [mp_run(rn) for rn in root_nodes]
 
     for info_item in info:
@@ -554,6 +648,8 @@ class MCTS_agent_particle_v2:
         self.num_samples = num_samples
         self.num_processes = num_processes
         self.num_particles = num_particles
+        # Sample all the particles at once from the belief matrices
+        self.batch_sampling = agent_params.get('batch_sampling', False)
 
         self.previous_belief_graph = None
         self.verbose = False
@@ -564,6 +660,7 @@ class MCTS_agent_particle_v2:
         #         self.should_close = self.planner_params['should_close']
 
         self.mcts = None 
+        self.planner_pool = None
         #MCTS_particles_v2(self.agent_id, self.char_index, self.max_episode_length,
         #                 self.num_simulation, self.max_rollout_steps,
         #                 self.c_init, self.c_base, agent_params=self.agent_params)
@@ -762,16 +859,22 @@ class MCTS_agent_particle_v2:
         
         if should_replan:
             # ipdb.set_trace()
+            if self.batch_sampling:
+                sampled_particles = self.belief.sample_particles(len(self.particles), obs)
             for particle_id, particle in enumerate(self.particles):
                 belief_states = []
                 obs_ids = [node['id'] for node in obs['nodes']]
 
                 # if True: #particle is None:
-                new_graph = self.belief.update_graph_from_gt_graph(obs, resample_unseen_nodes=True, update_belief=False)
+                if self.batch_sampling:
+                    new_graph = self.belief.particle_graph(sampled_particles, particle_id)
+                else:
+                    new_graph = self.belief.update_graph_from_gt_graph(obs, resample_unseen_nodes=True, update_belief=False)
 
                 init_state = clean_graph(new_graph, goal_spec, self.mcts.last_opened)
                 satisfied, unsatisfied = utils_env.check_progress(init_state, goal_spec)
-                init_vh_state = self.sim_env.get_vh_state(init_state)
+                # The planner pool rebuilds the vh_state in the worker processes
+                init_vh_state = self.sim_env.get_vh_state(init_state) if self.planner_pool is None else None
 
                 self.particles[particle_id] = (init_vh_state, init_state, satisfied, unsatisfied)
 
@@ -779,7 +882,15 @@ class MCTS_agent_particle_v2:
                 self.particles_full[particle_id] = new_graph
             # print('-----')
 
-            plan, root_node, subgoals = get_plan(self.mcts, self.particles, self.sim_env, nb_steps, goal_spec, last_plan, last_action, opponent_subgoal, verbose=verbose, num_process=self.num_processes)
+            try:
+                plan, root_node, subgoals = get_plan(self.mcts, self.particles, self.sim_env, nb_steps, goal_spec, last_plan, last_action, opponent_subgoal, verbose=verbose, num_process=self.num_processes,
+                                                    planner_pool=self.planner_pool)
+            except Exception:
+                # The pool may have been terminated, reset builds a new one
+                if self.planner_pool is not None:
+                    self.planner_pool.terminate()
+                    self.planner_pool = None
+                raise
             
             # print(colored(plan[:min(len(plan), 10)], 'cyan'))
         else:
@@ -833,4 +944,14 @@ class MCTS_agent_particle_v2:
                          self.num_simulation, self.max_rollout_steps,
                          self.c_init, self.c_base, seed=seed, agent_params=self.agent_params, add_bp=add_bp)
 
+        # Start the planning processes once per episode, they keep the mcts across steps
+        self.close()
+        if self.num_processes > 0:
+            self.planner_pool = PlannerPool(self.mcts, self.num_processes, seed=seed)
+
+    def close(self):
+        if self.planner_pool is not None:
+            self.planner_pool.close()
+            self.planner_pool = None
+
         # self.mcts.should_close = self.should_close
@@ -243,11 +243,15 @@ class Belief():
         
         self.first_belief = copy.deepcopy(self.edge_belief) 
         self.first_room = copy.deepcopy(self.room_node) 
+        self.first_inside_belief = self.inside_belief.copy()
+        self.first_on_belief = self.on_belief.copy()
+        self.first_room_belief = self.room_belief.copy()
 
 
     def update(self, origin, final):
-        origin_sm = scipy.special.softmax(origin)
-        final_sm = scipy.special.softmax(final)
+        # origin and final can be a belief or a matrix of beliefs, one per row
+        origin_sm = scipy.special.softmax(origin, axis=-1)
+        final_sm = scipy.special.softmax(final, axis=-1)
         # pdb.set_trace()
         maxdelta = np.abs(origin_sm - final_sm)
         signdelta = (final_sm - origin_sm ) * 1./(maxdelta+1e-9)
@@ -269,13 +273,10 @@ class Belief():
             belief_node[1] = prior
 
     def update_to_prior(self):
-        for node_name in self.edge_belief:
-            self.edge_belief[node_name]['INSIDE'][1] = self.update(self.edge_belief[node_name]['INSIDE'][1], self.first_belief[node_name]['INSIDE'][1])
-
-            self.edge_belief[node_name]['ON'][1] = self.update(self.edge_belief[node_name]['ON'][1], self.first_belief[node_name]['ON'][1])
-
-        for node in self.room_node:
-            self.room_node[node][1] = self.update(self.room_node[node][1], self.first_room[node][1])
+        # Updated in place, edge_belief and room_node are views of the stacked matrices
+        self.inside_belief[:] = self.update(self.inside_belief, self.first_inside_belief)
+        self.on_belief[:] = self.update(self.on_belief, self.first_on_belief)
+        self.room_belief[:] = self.update(self.room_belief, self.first_room_belief)
 
 
     def _remove_house_obj(self, state):
@@ -415,6 +416,29 @@ class Belief():
 
                 self.room_node[node['id']] = [self.room_ids, room_array]
         self.sampled_graph['edges'] = []
+        self.stack_belief()
+
+    def stack_belief(self):
+        """
+        Stores the beliefs as log-probability matrices: objects x containers (INSIDE), objects x surfaces (ON)
+        and objects x rooms. edge_belief and room_node keep views of the rows, so they can still be updated per object.
+        """
+        self.belief_ids = list(self.edge_belief.keys())
+        self.room_belief_ids = list(self.room_node.keys())
+        self.belief_index = {node_id: it for it, node_id in enumerate(self.belief_ids)}
+        self.room_belief_index = {node_id: it for it, node_id in enumerate(self.room_belief_ids)}
+
+        self.inside_belief = np.zeros((len(self.belief_ids), len(self.container_ids)))
+        self.on_belief = np.zeros((len(self.belief_ids), len(self.surface_ids)))
+        self.room_belief = np.zeros((len(self.room_belief_ids), len(self.room_ids)))
+        for it, node_id in enumerate(self.belief_ids):
+            self.inside_belief[it] = self.edge_belief[node_id]['INSIDE'][1]
+            self.on_belief[it] = self.edge_belief[node_id]['ON'][1]
+            self.edge_belief[node_id]['INSIDE'][1] = self.inside_belief[it]
+            self.edge_belief[node_id]['ON'][1] = self.on_belief[it]
+        for it, node_id in enumerate(self.room_belief_ids):
+            self.room_belief[it] = self.room_node[node_id][1]
+            self.room_node[node_id][1] = self.room_belief[it]
 
 
     def reset_belief(self):
@@ -554,6 +578,117 @@ class Belief():
         
         return self.sampled_graph
 
+    def sample_gumbel_max(self, log_probs, num_samples):
+        """Index sampled from softmax(log_probs) for every row, num_samples times: (num_samples, rows)"""
+        gumbel = -np.log(-np.log(np.random.uniform(1e-20, 1., (num_samples,) + log_probs.shape)))
+        return np.argmax(log_probs[None, :] + gumbel, -1)
+
+    def sample_particles(self, num_particles, gt_graph=None):
+        """
+        Samples num_particles graphs from the belief in one pass, with Gumbel-max over the stacked matrices.
+        Without gt_graph, the graphs are distributed as sample_from_belief(). With an observation gt_graph,
+        as update_graph_from_gt_graph(gt_graph, resample_unseen_nodes=True, update_belief=False):
+        the observed edges are kept and the objects not observed are sampled.
+        Returns the sampled edges as arrays over the sampled objects, build the graphs with particle_graph.
+        """
+        if gt_graph is not None:
+            gt_graph = {
+                'nodes': [node for node in gt_graph['nodes'] if node['id'] not in self.prohibit_ids],
+                'edges': [edge for edge in gt_graph['edges'] if edge['from_id'] not in self.prohibit_ids and edge['to_id'] not in self.prohibit_ids]
+            }
+            id2node = {node['id']: node for node in gt_graph['nodes']}
+            self.update_visible_states(id2node)
+            base_edges = list(gt_graph['edges'])
+            sample_ids = [node['id'] for node in self.sampled_graph['nodes'] if node['id'] not in id2node]
+        else:
+            base_edges = []
+            sample_ids = [node['id'] for node in self.sampled_graph['nodes']]
+
+        # States
+        state_node_ids, state_vars, state_probs = [], [], []
+        for node_id in sample_ids:
+            for var_name, var_belief_value in self.node_to_state_belief.get(node_id, {}).items():
+                state_node_ids.append(node_id)
+                state_vars.append(var_name)
+                state_probs.append(var_belief_value)
+        state_values = np.random.uniform(size=(num_particles, len(state_probs))) < np.array(state_probs)
+
+        # Objects with a belief are inside a container or, if inside nothing, in a room
+        fixed_inside = {edge['from_id']: edge['to_id'] for edge in base_edges if edge['relation_type'] == 'INSIDE'}
+        node_ids = [node_id for node_id in sample_ids if node_id in self.edge_belief or node_id in self.room_node]
+        inside_to = np.zeros((num_particles, len(node_ids)), dtype=np.int64)
+        in_room = np.zeros((num_particles, len(node_ids)), dtype=bool)
+
+        rows_room = [self.room_belief_index[node_id] for node_id in node_ids if node_id in self.room_node]
+        cols_room = [it for it, node_id in enumerate(node_ids) if node_id in self.room_node]
+        room_ids = np.array(self.room_ids)
+        inside_to[:, cols_room] = room_ids[self.sample_gumbel_max(self.room_belief[rows_room], num_particles)]
+
+        cols_belief = [it for it, node_id in enumerate(node_ids) if node_id in self.edge_belief]
+        rows_belief = [self.belief_index[node_ids[it]] for it in cols_belief]
+        container_ids = np.array([-1] + self.container_ids[1:])
+        inside_index = self.sample_gumbel_max(self.inside_belief[rows_belief], num_particles)
+        for it, col in enumerate(cols_belief):
+            if node_ids[col] in fixed_inside:
+                # The relationships with observed objects stay the same
+                inside_to[:, col] = fixed_inside[node_ids[col]]
+            else:
+                in_container = inside_index[:, it] > 0
+                inside_to[in_container, col] = container_ids[inside_index[in_container, it]]
+                in_room[~in_container, col] = True
+
+        # Objects in a room may be on a surface in that room
+        surface_room = -np.ones((num_particles, len(self.surface_ids)), dtype=np.int64)
+        node_index = {node_id: it for it, node_id in enumerate(node_ids)}
+        room_set = set(self.room_ids)
+        for it, surface_id in enumerate(self.surface_ids):
+            if surface_id in node_index:
+                surface_inside = inside_to[:, node_index[surface_id]]
+                surface_room[:, it] = np.where(np.isin(surface_inside, self.room_ids), surface_inside, -1)
+        for edge in base_edges:
+            if edge['relation_type'] == 'INSIDE' and edge['from_id'] in self.surface_index_belief_dict and edge['to_id'] in room_set:
+                surface_room[:, self.surface_index_belief_dict[edge['from_id']]] = edge['to_id']
+
+        surface_ids = np.array([-1] + self.surface_ids[1:])
+        on_index = self.sample_gumbel_max(self.on_belief[rows_belief], num_particles)
+        on_room = np.take_along_axis(surface_room, on_index, 1)
+        on_to = -np.ones((num_particles, len(node_ids)), dtype=np.int64)
+        valid_on = (on_index > 0) & in_room[:, cols_belief] & (on_room == inside_to[:, cols_belief])
+        on_to[:, cols_belief] = np.where(valid_on, surface_ids[on_index], -1)
+
+        return {
+            'base_edges': base_edges,
+            'node_ids': np.array(node_ids, dtype=np.int64),
+            'inside_to': inside_to,
+            'on_to': on_to,
+            'state_node_ids': state_node_ids,
+            'state_vars': state_vars,
+            'state_values': state_values
+        }
+
+    def particle_graph(self, particles, particle_id):
+        """Graph of a particle from sample_particles"""
+        node_states = {}
+        for node_id, var_name, value in zip(particles['state_node_ids'], particles['state_vars'], particles['state_values'][particle_id]):
+            node_states.setdefault(node_id, []).append(self.bin_var_dict[var_name][0][int(value)])
+        nodes = []
+        for node in self.sampled_graph['nodes']:
+            if node['id'] in node_states:
+                node = dict(node, states=node_states[node['id']])
+            nodes.append(node)
+
+        node_ids = particles['node_ids'].tolist()
+        edges = list(particles['base_edges'])
+        edges += [{'from_id': from_id, 'to_id': to_id, 'relation_type': 'INSIDE'}
+                  for from_id, to_id in zip(node_ids, particles['inside_to'][particle_id].tolist())]
+        edges += [{'from_id': from_id, 'to_id': to_id, 'relation_type': 'ON'}
+                  for from_id, to_id in zip(node_ids, particles['on_to'][particle_id].tolist()) if to_id >= 0]
+        for node_door in self.door_edges.keys():
+            node_1, node_2 = self.door_edges[node_door]
+            edges.append({'to_id': node_1, 'from_id': node_door, 'relation_type': 'BETWEEN'})
+            edges.append({'to_id': node_2, 'from_id': node_door, 'relation_type': 'BETWEEN'})
+        return {'nodes': nodes, 'edges': edges}
+
     def to_vh_state(self, graph):
         state = self._remove_house_obj(graph)
         vh_state = EnvironmentState(EnvironmentGraph(state), 
@@ -570,6 +705,20 @@ class Belief():
         self.update_to_prior()
         self.update_from_gt_graph(gt_graph)
 
+    def update_visible_states(self, id2node):
+        for node in self.sampled_graph['nodes']:
+            if node['id'] in id2node.keys():
+                # Update the state of the visible nodes
+                states_graph_old = id2node[node['id']]['states']
+                object_name = id2node[node['id']]['class_name']
+                bin_vars = self.graph_helper.get_object_binary_variables(object_name)
+                bin_vars = [x for x in bin_vars if x.default in self.states_consider]
+                bin_vars_missing = [x for x in bin_vars if x.positive not in states_graph_old and x.negative not in states_graph_old]
+                states_graph = states_graph_old + [x.default for x in bin_vars_missing]
+                # fill out the rest of info regarding the states
+                node['states'] = states_graph
+                id2node[node['id']]['states'] = states_graph
+
     def update_graph_from_gt_graph(self, gt_graph, sampled_graph=None, resample_unseen_nodes=False, update_belief=True):
         """
         Updates the current sampled graph with a set of observations
@@ -605,19 +754,7 @@ class Belief():
 
                 inside[x['from_id']] = x['to_id']
 
-        for node in self.sampled_graph['nodes']:
-            if node['id'] in id2node.keys():
-                # Update the state of the visible nodes
-                states_graph_old = id2node[node['id']]['states']
-                object_name = id2node[node['id']]['class_name']
-                bin_vars = self.graph_helper.get_object_binary_variables(object_name)
-                bin_vars = [x for x in bin_vars if x.default in self.states_consider]
-                bin_vars_missing = [x for x in bin_vars if x.positive not in states_graph_old and x.negative not in states_graph_old]
-                states_graph = states_graph_old + [x.default for x in bin_vars_missing]
-                # fill out the rest of info regarding the states
-                node['states'] = states_graph
-                id2node[node['id']]['states'] = states_graph
-
+        self.update_visible_states(id2node)
 
 
         edges_keep = []
@@ -697,6 +834,7 @@ class Belief():
 
     def update_from_gt_graph(self, gt_graph):
         # Update the states of nodes that we can see in the belief. Note that this does not change the sampled graph
+        # The constraints are applied as masked writes on the stacked belief matrices
         id2node = {}
         for x in gt_graph['nodes']:
             id2node[x['id']] = x
@@ -720,9 +858,6 @@ class Belief():
                     raise Exception
                 on[x['from_id']] = x['to_id']
 
-        visible_ids = [x['id'] for x in gt_graph['nodes']]
-        edge_tuples = [(x['from_id'], x['to_id']) for x in gt_graph['edges']]
-
         for x in gt_graph['nodes']:
             try:
                 dict_state = self.node_to_state_belief[x['id']]
@@ -735,123 +870,93 @@ class Belief():
         char_node = self.agent_id
 
         visible_room = inside[char_node]
-
-        
-        deleted_edges = []
-        id_updated = []
-
-        # Keep track of things with impossible belief
-        # Objects and rooms we are just seeing
-        ids_known_info = [self.room_index_belief_dict[visible_room], []]
-        for id_node in self.edge_belief.keys():
-            id_updated.append(id_node)
-            if id_node in grabbed_object:
-                continue
-
-            if id_node in visible_ids:  
-                # TODO: what happens when object grabbed
-                assert(id_node in inside.keys())
-                inside_obj = inside[id_node]
-                
-                # Some objects have the relationship inside but they are not part of the belief because
-                # they are visible anyways like bookshelf. In that case we consider them to just be
-                # inside the room
-                if inside_obj not in self.room_ids and inside_obj not in self.container_index_belief_dict:
-                    inside_obj = inside[inside_obj]
-                
-                # If object is inside a room, for sure it is not insde another object
-                if inside_obj in self.room_ids:
-                    self.edge_belief[id_node]['INSIDE'][1][:] = self.low_prob
-                    self.edge_belief[id_node]['INSIDE'][1][0] = 1.
-                    self.room_node[id_node][1][:] = self.low_prob
-                    self.room_node[id_node][1][self.room_index_belief_dict[inside_obj]] = 1.
-                else:
-                    # If object is inside an object, for sure it is not insde another object
-                    index_inside = self.container_index_belief_dict[inside_obj]
-                    self.edge_belief[id_node]['INSIDE'][1][:] = self.low_prob
-                    self.edge_belief[id_node]['INSIDE'][1][index_inside] = 1.
-
-                if id_node in on.keys():
-                    # object is on something
-                    on_obj = on[id_node]
-                    index_on = self.surface_index_belief_dict[on_obj]
-                    self.edge_belief[id_node]['ON'][1][:] = self.low_prob
-                    self.edge_belief[id_node]['ON'][1][index_on] = 1.
-                else:
-                    # object is for suure on nothing
-                    self.edge_belief[id_node]['ON'][1][:] = self.low_prob
-                    self.edge_belief[id_node]['ON'][1][0] = 1.
-
+        visible_room_index = self.room_index_belief_dict[visible_room]
+
+        # Masks over the objects with belief (rows of inside_belief and on_belief)
+        belief_ids = np.array(self.belief_ids, dtype=np.int64)
+        visible = np.isin(belief_ids, list(id2node.keys()))
+        grabbed = np.isin(belief_ids, grabbed_object)
+        rows_room = np.array([self.room_belief_index[node_id] for node_id in self.belief_ids], dtype=np.int64)
+
+        # Visible objects: we know where they are
+        rows_in_room, cols_room, rows_in_container, cols_container, rows_on, cols_on = [], [], [], [], [], []
+        for row in np.nonzero(visible & ~grabbed)[0]:
+            id_node = self.belief_ids[row]
+            # TODO: what happens when object grabbed
+            assert(id_node in inside.keys())
+            inside_obj = inside[id_node]
+            
+            # Some objects have the relationship inside but they are not part of the belief because
+            # they are visible anyways like bookshelf. In that case we consider them to just be
+            # inside the room
+            if inside_obj not in self.room_ids and inside_obj not in self.container_index_belief_dict:
+                inside_obj = inside[inside_obj]
+            
+            if inside_obj in self.room_ids:
+                rows_in_room.append(row)
+                cols_room.append(self.room_index_belief_dict[inside_obj])
             else:
-                # If not visible. for sure not in this room
-                curr_prob = scipy.special.softmax(self.room_node[id_node][1])
-                prob_room = curr_prob[self.room_index_belief_dict[visible_room]]
-                self.room_node[id_node][1][self.room_index_belief_dict[visible_room]] = self.low_prob
-                #if (self.room_node[id_node][1] > self.low_prob).sum() == 0:
-                if prob_room > 0.99:
-                    if id_node in self.edge_belief:
-                        # If not in any room, needs to be inside something
-                        self.edge_belief[id_node]['INSIDE'][1][0] = self.low_prob
-
-        # update belief for container objects
-        for id_node in self.container_ids:
-            if id_node in visible_ids and 'OPEN' in id2node[id_node]['states']:
-                for id_node_child in self.edge_belief.keys():
-                    if id_node_child not in inside.keys() or inside[id_node_child] != id_node:
-                        ids_known_info[1].append(self.container_index_belief_dict[id_node])
-                        self.edge_belief[id_node_child]['INSIDE'][1][self.container_index_belief_dict[id_node]] = self.low_prob
+                rows_in_container.append(row)
+                cols_container.append(self.container_index_belief_dict[inside_obj])
+
+            rows_on.append(row)
+            cols_on.append(self.surface_index_belief_dict[on[id_node]] if id_node in on.keys() else 0)
+
+        # If object is inside a room, for sure it is not insde another object
+        # If object is inside an object, for sure it is not insde another object
+        rows_visible = rows_in_room + rows_in_container
+        self.inside_belief[rows_visible] = self.low_prob
+        self.inside_belief[rows_in_room, 0] = 1.
+        self.inside_belief[rows_in_container, cols_container] = 1.
+        self.room_belief[rows_room[rows_in_room]] = self.low_prob
+        self.room_belief[rows_room[rows_in_room], cols_room] = 1.
+        # The object is on a surface, or for sure on nothing
+        self.on_belief[rows_on] = self.low_prob
+        self.on_belief[rows_on, cols_on] = 1.
+
+        # If not visible, for sure not in this room
+        rows_not_visible = np.nonzero(~visible & ~grabbed)[0]
+        prob_room = scipy.special.softmax(self.room_belief[rows_room[rows_not_visible]], axis=-1)[:, visible_room_index]
+        self.room_belief[rows_room[rows_not_visible], visible_room_index] = self.low_prob
+        # If not in any room, needs to be inside something
+        self.inside_belief[rows_not_visible[prob_room > 0.99], 0] = self.low_prob
+
+        # update belief for container objects: open containers only have what we see inside
+        inside_of = np.array([inside.get(node_id, -1) for node_id in self.belief_ids], dtype=np.int64)
+        for id_node in self.container_ids[1:]:
+            if id_node in id2node and 'OPEN' in id2node[id_node]['states']:
+                self.inside_belief[inside_of != id_node, self.container_index_belief_dict[id_node]] = self.low_prob
                 
         # Update belief for surface objects
-        for id_node in self.surface_ids:
-            if id_node in visible_ids:
-                for id_node_child in self.edge_belief.keys():
-                    if id_node_child not in on.keys() or on[id_node_child] != id_node:
-                        ids_known_info[1].append(self.surface_index_belief_dict[id_node])
-                        self.edge_belief[id_node_child]['ON'][1][self.surface_index_belief_dict[id_node]] = self.low_prob
-
+        on_of = np.array([on.get(node_id, -1) for node_id in self.belief_ids], dtype=np.int64)
+        for id_node in self.surface_ids[1:]:
+            if id_node in id2node:
+                self.on_belief[on_of != id_node, self.surface_index_belief_dict[id_node]] = self.low_prob
 
         # Some furniture has no edges, only has info about inside rooms
         # We need to udpate its location
-        for id_node in self.room_node.keys():
-            if id_node not in id_updated:
-                if id_node in visible_ids:
-                    inside_obj = inside[id_node]
-                    if inside_obj == visible_room:
-                        self.room_node[id_node][1][:]  = self.low_prob
-                        self.room_node[id_node][1][self.room_index_belief_dict[visible_room]] = 1.
-                    else:
-                        assert('Error: A grabbable object is inside something else than a room')
-                else:
-                    # Either the node goes inside somehting in the room... or ti should not be
-                    # in this room
-                    self.room_node[id_node][1][self.room_index_belief_dict[visible_room]] = self.low_prob
-
-        mask_house = np.ones(len(self.room_nodes))
-        mask_obj = np.ones(len(self.container_ids))
-        mask_house[ids_known_info[0]] = 0
-
+        furniture_ids = [node_id for node_id in self.room_belief_ids if node_id not in self.edge_belief]
+        rows_furniture = np.array([self.room_belief_index[node_id] for node_id in furniture_ids], dtype=np.int64)
+        furniture_visible = np.array([node_id in id2node for node_id in furniture_ids], dtype=bool)
+        furniture_in_room = np.array([node_id in id2node and inside[node_id] == visible_room for node_id in furniture_ids], dtype=bool)
+        self.room_belief[rows_furniture[furniture_in_room]] = self.low_prob
+        self.room_belief[rows_furniture[furniture_in_room], visible_room_index] = 1.
+        # Either the node goes inside somehting in the room... or ti should not be in this room
+        self.room_belief[rows_furniture[~furniture_visible], visible_room_index] = self.low_prob
+
+        mask_house = np.ones(len(self.room_nodes), dtype=bool)
+        mask_house[visible_room_index] = False
         assert (len(self.room_nodes) > 0)
-        if len(ids_known_info[1]):
-            mask_obj[np.array(ids_known_info[1])] = 0
-
-        mask_obj = (mask_obj == 1)
-        mask_house = (mask_house == 1)
 
         # Check for impossible beliefs
-        for id_node in self.room_node.keys():
-            if id_node in self.edge_belief.keys():
-                # the object should be in a room or inside something
-                if np.max(self.edge_belief[id_node]['INSIDE'][1]) == self.low_prob:
-                    # Sample locations except for marked ones
-                    self.edge_belief[id_node]['INSIDE'][1] = self.first_belief[id_node]['INSIDE'][1]
-                    # Sample rooms except marked
-                    try:
-                        self.room_node[id_node][1][mask_house] = self.first_room[id_node][1][mask_house]
-                    except:
-                        pdb.set_trace()
-            else:
-                if np.max(self.room_node[id_node][1]) == self.low_prob:
-                    self.room_node[id_node][1][mask_house] = self.first_room[id_node][1][mask_house]
+        # the object should be in a room or inside something
+        in_room_belief = np.isin(belief_ids, self.room_belief_ids)
+        impossible = in_room_belief & (np.max(self.inside_belief, 1) == self.low_prob)
+        # Sample locations except for marked ones
+        self.inside_belief[impossible] = self.first_inside_belief[impossible]
+        # Sample rooms except marked
+        rows_reset = np.concatenate([rows_room[impossible], rows_furniture[np.max(self.room_belief[rows_furniture], 1) == self.low_prob]])
+        self.room_belief[np.ix_(rows_reset, mask_house)] = self.first_room_belief[np.ix_(rows_reset, mask_house)]
 
         # print("New belief", self.edge_belief[458]['ON'])
 
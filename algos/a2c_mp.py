@@ -108,7 +108,10 @@ class A2C:
 
         # Reset hidden state of agents
         # TODO: uncomment
-        if self.args.num_processes == 1:
+        if self.args.num_processes == 1 and getattr(self.args, 'num_envs', 1) > 1:
+            # VecArena, one rollout per environment
+            info_envs = self.arenas[0].rollout(logging_value, record, episode_id=episode_id, is_train=train, goals=goals)
+        elif self.args.num_processes == 1:
             info_envs = [self.arenas[0].rollout(logging_value, record, episode_id=episode_id, is_train=train, goals=goals)]
         else:
             async_routs = []
@@ -124,6 +127,10 @@ class A2C:
         # info_envs = []
         # info_envs.append(self.arenas[0].rollout(logging, record))
 
+        return self.add_rollouts(info_envs, train)
+
+    def add_rollouts(self, info_envs, train=True):
+        """Rewards and info of the rollouts of the arenas, their trajectories are added to the memory if train"""
         rewards = []
         info_rollout = []
         for process_data in info_envs:
@@ -161,9 +168,12 @@ class A2C:
 
     def eval(self, episode_id, goals=None):
         self.actor_critic.eval()
-        for agent in self.arenas[0].agents:
-            if 'RL' in agent.agent_type:
-                agent.epsilon = 0.
+        if hasattr(self.arenas[0], 'set_epsilon'):
+            self.arenas[0].set_epsilon(0.)
+        else:
+            for agent in self.arenas[0].agents:
+                if 'RL' in agent.agent_type:
+                    agent.epsilon = 0.
         with torch.no_grad():
             c_r_all, info_rollout = self.rollout(episode_id=episode_id, logging_value=2, train=False, goals=goals)
         return c_r_all, info_rollout
@@ -171,6 +181,8 @@ class A2C:
 
     def train(self, trainable_agents=None):
         # pdb.set_trace()
+        if getattr(self.args, 'async_learner', False):
+            return self.train_async()
         if len(self.args.load_model):
             self.load_model(self.args.load_model)
         self.memory_all = MemoryMask(self.memory_capacity_episodes)
@@ -191,12 +203,11 @@ class A2C:
 
             # TODO: Uncomment
             if self.args.num_processes > 1:
-                curr_model = self.actor_critic.state_dict()
-                for k, v in curr_model.items():
-                   curr_model[k] = v.cpu()
-                m_id = ray.put(curr_model)
+                m_id = self.get_weights()
                 # TODO: Uncomment
                 ray.get([arena.set_weigths.remote(eps, m_id) for arena in self.arenas])
+            elif hasattr(self.arenas[0], 'set_epsilon'):
+                self.arenas[0].set_epsilon(eps)
             else:
                 for agent in self.arenas[0].agents:
                     if 'RL' in agent.agent_type:
@@ -212,201 +223,283 @@ class A2C:
 
 
 
-            end_time = time.time()
-
-            action_space = []
-            obs_space = []
-            successes = []
-            num_steps = []
-            episode_rewards = [c_r_all_roll[0] for c_r_all_roll in c_r_all]
-
+            total_num_steps = self.log_rollout(episode_id, c_r_all, info_rollout, start_time, total_num_steps)
 
-            for info_rollout_ep in info_rollout:
-                num_steps.append(info_rollout_ep['nsteps'])
-                action_space.append(info_rollout_ep['action_space'])
-                obs_space.append(info_rollout_ep['observation_space'])
-                successes.append(info_rollout_ep['success'])
-
-            total_num_steps += np.sum(num_steps)
-            fps = total_num_steps*1.0/(end_time-start_time)
-            print("episode: #{} steps: {} reward: {} finished: {}/{} FPS {} #Objects {} #Objects actions {}".format(
-                episode_id, np.mean(num_steps),
-                np.mean(episode_rewards),
-                np.sum(successes), len(episode_rewards),
-                fps, np.mean(obs_space), np.mean(action_space)))
+            # ===================== off-policy training =====================
+            if not self.args.on_policy and episode_id - start_episode_id + 1 >= self.args.replay_start:
+                self.update()
 
-            if episode_id % self.args.log_interval == 0:
+            if not self.args.debug and episode_id % self.args.save_interval == 0:
+                self.logger.save_model(episode_id, self.actor_critic)
 
-                print(info_rollout_ep['goals'])
-                # Auxiliary task
-                if 'pred_close' in info_rollout[0].keys() and \
-                        len(info_rollout[0]['pred_close']) > 0:
 
-                    pred_close = torch.cat(info_rollout[0]['pred_close'], 0)
-                    gt_close = torch.cat(info_rollout[0]['gt_close'], 0)
-                    pred_goal = torch.cat(info_rollout[0]['pred_goal'], 0)
-                    gt_goal = torch.cat(info_rollout[0]['gt_goal'], 0)
-                    mask_nodes = torch.cat(info_rollout[0]['mask_nodes'], 0)
+    def get_weights(self):
+        curr_model = self.actor_critic.state_dict()
+        for k, v in curr_model.items():
+            curr_model[k] = v.cpu()
+        return ray.put(curr_model)
 
-                if episode_id % self.args.long_log == 0:
-                    # print("Target:")
-                    # print(info_rollout[0]['target'][1])
-                    script_done = info_rollout[0]['script']
-                    script_tried = info_rollout[0]['action_tried']
-                    for iti, (script_t, script_d) in enumerate(zip(script_tried, script_done)):
-                        info_step = ''
-                        for relation in ['CLOSE', 'INSIDE', 'ON']:
-                            if relation == 'INSIDE':
-                                if len([x for x in info_rollout[0]['step_info'][iti][1] if x[2] == relation]) == 0:
-                                    pdb.set_trace()
-
-                            info_step += '  {}:  {}'.format(relation, ' '.join(
-                                ['{}.{}'.format(x[0], x[1]) for x in info_rollout[0]['step_info'][iti][1] if x[2] == relation]))
-
-                        if script_d is None:
-                            script_d = ''
-
-                        if False: #info_rollout[0]['step_info'][iti][0] is not None:
-                            char_info = '{:07.3f} {:07.3f}'.format(info_rollout[0]['step_info'][iti][0]['center'][0],
-                                                                   info_rollout[0]['step_info'][iti][0]['center'][2])
-                            print('{: <36} --> {: <36} | char: {}  {}'.format(script_t, script_d, char_info, info_step))
-                        else:
-                            print('{: <36} --> {: <36}'.format(script_t, script_d))
-
-                    if self.logger:
-
-                        info_episode = {
-                            'episode': episode_id,
-                            'success': successes[0],
-                            'reward': episode_rewards[0],
-                            'script_tried': info_rollout[0]['action_tried'],
-                            'script_done': info_rollout[0]['script'],
-                            'target': info_rollout[0]['target'],
-                            'info_step': info_rollout[0]['step_info'],
-                            'graph': info_rollout[0]['graph'],
-                            'visible_ids': info_rollout[0]['visible_ids'],
-                            'action_ids': info_rollout[0]['action_space_ids'],
-                        }
-                        if 'pred_close' in info_rollout[0].keys():
-                            info_episode['pred_close'] = info_rollout[0]['pred_close']
-                        self.logger.log_info(info_episode)
-
-
-            if self.logger:
-                if episode_id % self.args.log_interval == 0:
-                    epsilon = info_rollout[0]['epsilon']
-
-                    dist_entropy = (np.mean([np.mean(info_rollout[it]['entropy'][0]) for it in range(len(info_rollout))]),
-                                    np.mean([np.mean(info_rollout[it]['entropy'][1]) for it in range(len(info_rollout))]))
-                    # pdb.set_trace()
-                    info_aux = {}
-
-                    if 'pred_close' in info_rollout[0].keys() and \
-                            len(info_rollout[0]['pred_close']) > 0:
-                        pred_closem = (pred_close.squeeze(-1) > 0.5).float().cpu()
-                        tp = (mask_nodes.float() * gt_close.float() * pred_closem.float()).sum()
-                        p = (mask_nodes.float() * gt_close.float()).sum()
-                        fp = (mask_nodes.float() * (1. - gt_close.float()) * pred_closem.float()).sum()
-
-                        info_aux['accuracy_goal'] = (gt_goal.cpu() == pred_goal.argmax(1).cpu()).float().mean().numpy()
-                        info_aux['precision_close'] = (tp/(1e-9 + tp + fp)).numpy()
-                        info_aux['recall_close'] = (tp/(1e-9 + p)).numpy()
-                        info_aux['loss_close'] = nn.functional.binary_cross_entropy_with_logits(pred_close.squeeze(-1).cpu(),
-                                                                                                gt_close,
-                                                                                                mask_nodes).detach().numpy()
-                        info_aux['loss_goal'] = nn.functional.cross_entropy(pred_goal.cpu(), gt_goal).detach().numpy()
-                    self.logger.log_data(episode_id, episode_id, fps, episode_rewards,
-                                         dist_entropy, epsilon, successes, num_steps, info_aux)
+    def train_async(self):
+        """
+        Asynchronous version of train. Every arena runs episodes one after the other with the last weights
+        published by the learner, and the learner trains on every finished episode without waiting for
+        the other arenas. The weights get a new version every weights_interval updates, the episodes are
+        off-policy (collected by older versions) and corrected with V-trace in _train.
+        """
+        if self.args.num_processes == 1:
+            raise Exception('The asynchronous learner needs the ray arenas of --num-processes > 1')
+        if len(self.args.load_model):
+            self.load_model(self.args.load_model)
+        self.memory_all = MemoryMask(self.memory_capacity_episodes)
+        self.memory_all.reset()
 
+        start_episode_id = 1
+        start_time = time.time()
+        total_num_steps = 0
+        num_updates = 0
+        weights_version = 0
+        weights = self.get_weights()
 
+        # rollout being run: (arena, episode id, version of the weights)
+        running = {}
+        next_episode_id = start_episode_id
 
-            # ===================== off-policy training =====================
-            if not self.args.on_policy and episode_id - start_episode_id + 1 >= self.args.replay_start:
-                nb_replays = 1
-                for replay_id in range(nb_replays):
-                    if self.args.balanced_sample:
-                        trajs = self.memory_all.sample_batch_balanced_multitask(
-                            self.args.batch_size,
-                            self.args.neg_ratio,
-                            maxlen=self.args.max_number_steps,
-                            cutoff_positive=5.0)
+        def start_rollout(arena):
+            eps = utils_models.get_epsilon(self.args.init_epsilon,
+                                           self.args.final_epsilon,
+                                           self.args.max_exp_episodes,
+                                           next_episode_id)
+            logging_value = 0
+            if next_episode_id % self.args.log_interval == 0:
+                logging_value = 1
+                if next_episode_id % self.args.long_log == 0:
+                    logging_value = 2
+            # The calls to an arena run in order, the rollout uses the weights set before
+            arena.set_weigths.remote(eps, weights)
+            rollout = arena.rollout_reset.remote(logging_value, False, is_train=True)
+            running[rollout] = (arena, next_episode_id, weights_version)
+
+        for arena in self.arenas:
+            if next_episode_id < self.args.nb_episodes:
+                start_rollout(arena)
+                next_episode_id += 1
+
+        for it_episode in range(start_episode_id, self.args.nb_episodes):
+            ready, _ = ray.wait(list(running.keys()), num_returns=1)
+            arena, episode_id, episode_version = running.pop(ready[0])
+            c_r_all, info_rollout = self.add_rollouts([ray.get(ready[0])], train=True)
+
+            # The arena starts its next episode while the learner trains
+            if next_episode_id < self.args.nb_episodes:
+                start_rollout(arena)
+                next_episode_id += 1
+
+            print("Weights version: {} (episode collected with version {})".format(weights_version, episode_version))
+            total_num_steps = self.log_rollout(episode_id, c_r_all, info_rollout, start_time, total_num_steps)
+
+            if not self.args.on_policy and it_episode - start_episode_id + 1 >= self.args.replay_start:
+                self.update(vtrace=True)
+                num_updates += 1
+                if num_updates % self.args.weights_interval == 0:
+                    weights_version += 1
+                    weights = self.get_weights()
+
+            if not self.args.debug and it_episode % self.args.save_interval == 0:
+                self.logger.save_model(it_episode, self.actor_critic)
+
+    def log_rollout(self, episode_id, c_r_all, info_rollout, start_time, total_num_steps):
+        """Prints and logs the rollouts of an episode, returns the updated total_num_steps"""
+        end_time = time.time()
+
+        action_space = []
+        obs_space = []
+        successes = []
+        num_steps = []
+        episode_rewards = [c_r_all_roll[0] for c_r_all_roll in c_r_all]
+
+
+        for info_rollout_ep in info_rollout:
+            num_steps.append(info_rollout_ep['nsteps'])
+            action_space.append(info_rollout_ep['action_space'])
+            obs_space.append(info_rollout_ep['observation_space'])
+            successes.append(info_rollout_ep['success'])
+
+        total_num_steps += np.sum(num_steps)
+        fps = total_num_steps*1.0/(end_time-start_time)
+        print("episode: #{} steps: {} reward: {} finished: {}/{} FPS {} #Objects {} #Objects actions {}".format(
+            episode_id, np.mean(num_steps),
+            np.mean(episode_rewards),
+            np.sum(successes), len(episode_rewards),
+            fps, np.mean(obs_space), np.mean(action_space)))
+
+        if episode_id % self.args.log_interval == 0:
+
+            print(info_rollout_ep['goals'])
+            # Auxiliary task
+            if 'pred_close' in info_rollout[0].keys() and \
+                    len(info_rollout[0]['pred_close']) > 0:
+
+                pred_close = torch.cat(info_rollout[0]['pred_close'], 0)
+                gt_close = torch.cat(info_rollout[0]['gt_close'], 0)
+                pred_goal = torch.cat(info_rollout[0]['pred_goal'], 0)
+                gt_goal = torch.cat(info_rollout[0]['gt_goal'], 0)
+                mask_nodes = torch.cat(info_rollout[0]['mask_nodes'], 0)
+
+            if episode_id % self.args.long_log == 0:
+                # print("Target:")
+                # print(info_rollout[0]['target'][1])
+                script_done = info_rollout[0]['script']
+                script_tried = info_rollout[0]['action_tried']
+                for iti, (script_t, script_d) in enumerate(zip(script_tried, script_done)):
+                    info_step = ''
+                    for relation in ['CLOSE', 'INSIDE', 'ON']:
+                        if relation == 'INSIDE':
+                            if len([x for x in info_rollout[0]['step_info'][iti][1] if x[2] == relation]) == 0:
+                                pdb.set_trace()
+
+                        info_step += '  {}:  {}'.format(relation, ' '.join(
+                            ['{}.{}'.format(x[0], x[1]) for x in info_rollout[0]['step_info'][iti][1] if x[2] == relation]))
+
+                    if script_d is None:
+                        script_d = ''
+
+                    if False: #info_rollout[0]['step_info'][iti][0] is not None:
+                        char_info = '{:07.3f} {:07.3f}'.format(info_rollout[0]['step_info'][iti][0]['center'][0],
+                                                               info_rollout[0]['step_info'][iti][0]['center'][2])
+                        print('{: <36} --> {: <36} | char: {}  {}'.format(script_t, script_d, char_info, info_step))
                     else:
-                        trajs = self.memory_all.sample_batch(
-                            self.args.batch_size,
-                            maxlen=self.args.max_number_steps)
-                    N = len(trajs[0])
-                    policies, actions, rewards, Vs, old_policies, dones, masks, loss_closes, loss_goals, nsteps_s = \
-                        [], [], [], [], [], [], [], [], [], []
-
-                    hx = torch.zeros(N, self.actor_critic.hidden_size).to(self.device)
-                    cx = torch.zeros(N, self.actor_critic.hidden_size).to(self.device)
-
-                    state_keys = trajs[0][0].state.keys()
-                    print("Length trajectory: ", len(trajs))
-                    for t in range(len(trajs) - 1):
-
-                        # TODO: decompose here
-                        inputs = {state_key: torch.cat([trajs[t][i].state[state_key] for i in range(N)]).to(self.device) for state_key in state_keys}
-
-                        action = [torch.cat([torch.LongTensor([trajs[t][i].action[action_index]]).unsqueeze(0).to(self.device)
-                                            for i in range(N)]) for action_index in range(2)]
-
-
-                        old_policy = [torch.cat([trajs[t][i].policy[policy_index].to(self.device)
-                                                for i in range(N)]) for policy_index in range(2)]
-                        done = torch.cat([torch.Tensor([trajs[t + 1][i].action is None]).unsqueeze(1).unsqueeze(
-                            0).to(self.device)
-                                          for i in range(N)])
-                        mask = torch.cat([torch.Tensor([trajs[t][i].mask]).unsqueeze(1).to(self.device)
-                                          for i in range(N)])
-                        reward = np.array([trajs[t][i].reward for i in range(N)]).reshape((N, 1))
-                        nsteps = np.array([trajs[t][i].nsteps for i in range(N)]).reshape((N, 1))
-                        # policy, v, (hx, cx) = self.agents[agent_id].act(inputs, hx, mask)
-                        v, _, policy, (hx, cx), out_dict = self.actor_critic.act(inputs, (hx, cx), mask, action_indices=action)
-
-                        if hasattr(self.actor_critic, 'auxiliary_pred'):
-                            auxiliary_out = self.actor_critic.auxiliary_pred((out_dict))
-                        else:
-                            auxiliary_out = {}
-                        if 'pred_goal' in auxiliary_out:
-                            pred_goal, pred_close = auxiliary_out['pred_goal'], auxiliary_out['pred_close']
-                            gt_close = inputs['gt_close']
-                            gt_goal = inputs['gt_goal']
-                            mask_nodes = inputs['mask_object']
-                            loss_close = nn.functional.binary_cross_entropy_with_logits(pred_close.squeeze(-1), gt_close, mask_nodes)
-                            loss_goal = nn.functional.cross_entropy(pred_goal, gt_goal)
-                        else:
-                            loss_close = None
-                            loss_goal = None
-
-                        [array.append(element) for array, element in
-                         zip((policies, actions, rewards, Vs, old_policies, dones, masks, nsteps_s, loss_closes, loss_goals),
-                             (policy, action, reward, v, old_policy, done, mask, nsteps, loss_close, loss_goal))]
-
-
-                        dones.append(done)
-
-                        if (t + 1) % self.args.t_max == 0:  # maximum bptt length
-                            hx = hx.detach()
-                            cx = cx.detach()
-
-                    self._train(self.actor_critic,
-                                self.optimizer,
-                                policies,
-                                Vs,
-                                actions,
-                                rewards,
-                                dones,
-                                masks,
-                                loss_closes,
-                                loss_goals,
-                                old_policies,
-                                nsteps_s,
-                                verbose=1)
+                        print('{: <36} --> {: <36}'.format(script_t, script_d))
+
+                if self.logger:
+
+                    info_episode = {
+                        'episode': episode_id,
+                        'success': successes[0],
+                        'reward': episode_rewards[0],
+                        'script_tried': info_rollout[0]['action_tried'],
+                        'script_done': info_rollout[0]['script'],
+                        'target': info_rollout[0]['target'],
+                        'info_step': info_rollout[0]['step_info'],
+                        'graph': info_rollout[0]['graph'],
+                        'visible_ids': info_rollout[0]['visible_ids'],
+                        'action_ids': info_rollout[0]['action_space_ids'],
+                    }
+                    if 'pred_close' in info_rollout[0].keys():
+                        info_episode['pred_close'] = info_rollout[0]['pred_close']
+                    self.logger.log_info(info_episode)
+
+
+        if self.logger:
+            if episode_id % self.args.log_interval == 0:
+                epsilon = info_rollout[0]['epsilon']
 
-            if not self.args.debug and episode_id % self.args.save_interval == 0:
-                self.logger.save_model(episode_id, self.actor_critic)
+                dist_entropy = (np.mean([np.mean(info_rollout[it]['entropy'][0]) for it in range(len(info_rollout))]),
+                                np.mean([np.mean(info_rollout[it]['entropy'][1]) for it in range(len(info_rollout))]))
+                # pdb.set_trace()
+                info_aux = {}
 
+                if 'pred_close' in info_rollout[0].keys() and \
+                        len(info_rollout[0]['pred_close']) > 0:
+                    pred_closem = (pred_close.squeeze(-1) > 0.5).float().cpu()
+                    tp = (mask_nodes.float() * gt_close.float() * pred_closem.float()).sum()
+                    p = (mask_nodes.float() * gt_close.float()).sum()
+                    fp = (mask_nodes.float() * (1. - gt_close.float()) * pred_closem.float()).sum()
+
+                    info_aux['accuracy_goal'] = (gt_goal.cpu() == pred_goal.argmax(1).cpu()).float().mean().numpy()
+                    info_aux['precision_close'] = (tp/(1e-9 + tp + fp)).numpy()
+                    info_aux['recall_close'] = (tp/(1e-9 + p)).numpy()
+                    info_aux['loss_close'] = nn.functional.binary_cross_entropy_with_logits(pred_close.squeeze(-1).cpu(),
+                                                                                            gt_close,
+                                                                                            mask_nodes).detach().numpy()
+                    info_aux['loss_goal'] = nn.functional.cross_entropy(pred_goal.cpu(), gt_goal).detach().numpy()
+                self.logger.log_data(episode_id, episode_id, fps, episode_rewards,
+                                     dist_entropy, epsilon, successes, num_steps, info_aux)
+        return total_num_steps
+
+    def update(self, vtrace=False):
+        """Trains the policy on a batch of trajectories of the replay memory"""
+        nb_replays = 1
+        for replay_id in range(nb_replays):
+            if self.args.balanced_sample:
+                trajs = self.memory_all.sample_batch_balanced_multitask(
+                    self.args.batch_size,
+                    self.args.neg_ratio,
+                    maxlen=self.args.max_number_steps,
+                    cutoff_positive=5.0)
+            else:
+                trajs = self.memory_all.sample_batch(
+                    self.args.batch_size,
+                    maxlen=self.args.max_number_steps)
+            N = len(trajs[0])
+            policies, actions, rewards, Vs, old_policies, dones, masks, loss_closes, loss_goals, nsteps_s = \
+                [], [], [], [], [], [], [], [], [], []
+
+            hx = torch.zeros(N, self.actor_critic.hidden_size).to(self.device)
+            cx = torch.zeros(N, self.actor_critic.hidden_size).to(self.device)
+
+            state_keys = trajs[0][0].state.keys()
+            print("Length trajectory: ", len(trajs))
+            for t in range(len(trajs) - 1):
+
+                # TODO: decompose here
+                inputs = {state_key: torch.cat([trajs[t][i].state[state_key] for i in range(N)]).to(self.device) for state_key in state_keys}
+
+                action = [torch.cat([torch.LongTensor([trajs[t][i].action[action_index]]).unsqueeze(0).to(self.device)
+                                    for i in range(N)]) for action_index in range(2)]
+
+
+                old_policy = [torch.cat([trajs[t][i].policy[policy_index].to(self.device)
+                                        for i in range(N)]) for policy_index in range(2)]
+                done = torch.cat([torch.Tensor([trajs[t + 1][i].action is None]).unsqueeze(1).unsqueeze(
+                    0).to(self.device)
+                                  for i in range(N)])
+                mask = torch.cat([torch.Tensor([trajs[t][i].mask]).unsqueeze(1).to(self.device)
+                                  for i in range(N)])
+                reward = np.array([trajs[t][i].reward for i in range(N)]).reshape((N, 1))
+                nsteps = np.array([trajs[t][i].nsteps for i in range(N)]).reshape((N, 1))
+                # policy, v, (hx, cx) = self.agents[agent_id].act(inputs, hx, mask)
+                v, _, policy, (hx, cx), out_dict = self.actor_critic.act(inputs, (hx, cx), mask, action_indices=action)
+
+                if hasattr(self.actor_critic, 'auxiliary_pred'):
+                    auxiliary_out = self.actor_critic.auxiliary_pred((out_dict))
+                else:
+                    auxiliary_out = {}
+                if 'pred_goal' in auxiliary_out:
+                    pred_goal, pred_close = auxiliary_out['pred_goal'], auxiliary_out['pred_close']
+                    gt_close = inputs['gt_close']
+                    gt_goal = inputs['gt_goal']
+                    mask_nodes = inputs['mask_object']
+                    loss_close = nn.functional.binary_cross_entropy_with_logits(pred_close.squeeze(-1), gt_close, mask_nodes)
+                    loss_goal = nn.functional.cross_entropy(pred_goal, gt_goal)
+                else:
+                    loss_close = None
+                    loss_goal = None
+
+                [array.append(element) for array, element in
+                 zip((policies, actions, rewards, Vs, old_policies, dones, masks, nsteps_s, loss_closes, loss_goals),
+                     (policy, action, reward, v, old_policy, done, mask, nsteps, loss_close, loss_goal))]
+
+
+                dones.append(done)
+
+                if (t + 1) % self.args.t_max == 0:  # maximum bptt length
+                    hx = hx.detach()
+                    cx = cx.detach()
+
+            self._train(self.actor_critic,
+                        self.optimizer,
+                        policies,
+                        Vs,
+                        actions,
+                        rewards,
+                        dones,
+                        masks,
+                        loss_closes,
+                        loss_goals,
+                        old_policies,
+                        nsteps_s,
+                        verbose=1,
+                        vtrace=vtrace)
 
     def _train(self,
                model,
@@ -421,8 +514,9 @@ class A2C:
                loss_goals,
                old_policies,
                nsteps_s,
-               verbose=0):
-        """training"""
+               verbose=0,
+               vtrace=False):
+        """training, with the V-trace targets of the asynchronous learner if vtrace"""
 
         off_policy = old_policies is not None
         policy_loss, value_loss, entropy_loss, loss_close, loss_goal = 0, 0, 0, 0, 0
@@ -433,6 +527,7 @@ class A2C:
         # print("episode_length:", episode_length)
         N = args.batch_size
         Vret = torch.from_numpy(np.zeros((N, 1))).float()
+        v_next, vs_next = torch.zeros(N, 1).to(self.device), torch.zeros(N, 1).to(self.device)
 
         for i in reversed(range(episode_length)):
             # v_next = Vs[i + 1].data.cpu().numpy()[0][0] if i < episode_length - 1 else 0
@@ -465,6 +560,24 @@ class A2C:
             else:
                 rho = 1.0
 
+            A_policy = A
+            if vtrace:
+                # V-trace targets (IMPALA), with the policy that collected the trajectory in old_policies.
+                # A transition is a high level action of nsteps steps, the next one is not valid after the episode end
+                if i + 1 < episode_length:
+                    discount = torch.from_numpy(np.power(args.gamma, nsteps_s[i])).float().to(self.device) * masks[i + 1]
+                else:
+                    discount = torch.zeros(N, 1).to(self.device)
+                reward = torch.from_numpy(rewards[i]).float().to(self.device)
+                rho = (prob / prob_old).clamp(max=args.vtrace_rho)
+                c = (prob / prob_old).clamp(max=args.vtrace_c)
+                v = Vs[i].data
+                vs = v + rho * (reward + discount * v_next - v) + discount * c * (vs_next - v_next)
+
+                A = vs - Vs[i]
+                A_policy = reward + discount * vs_next - Vs[i]
+                v_next, vs_next = v, vs
+
             if verbose > 1:
                 print("Vret:", Vret)
                 print("reward:", rewards[i])
@@ -474,7 +587,7 @@ class A2C:
             num_masks = float(masks[i].sum(0).data.cpu().numpy()[0])
 
             single_step_policy_loss = -(log_prob \
-                                        * A.data \
+                                        * A_policy.data \
                                         * rho.data * masks[i]).sum(0) \
                                       / max(1.0, num_masks)
 
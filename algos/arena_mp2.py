@@ -3,6 +3,7 @@ import cv2
 import logging
 import torch
 from utils import utils_exception
+from utils import utils_episode_log
 import copy
 import numpy as np
 from tqdm import tqdm
@@ -61,39 +62,43 @@ class ArenaMP(object):
                 agent.epsilon = epsilon
                 agent.actor_critic.load_state_dict(weights)
 
+    def get_goal_spec(self, agent_index):
+        if self.task_goal is None:
+            return self.env.get_goal(self.env.task_goal[agent_index], self.env.agent_goals[agent_index])
+        else:
+            return self.env.get_goal(self.task_goal[agent_index], self.env.agent_goals[agent_index])
+
     def get_actions(self, obs, action_space=None, true_graph=False):
         # ipdb.set_trace()
         dict_actions, dict_info = {}, {}
-        op_subgoal = {0: None, 1: None}
         # pdb.set_trace()
 
         for it, agent in enumerate(self.agents):
-            if self.task_goal is None:
-                goal_spec = self.env.get_goal(self.env.task_goal[it], self.env.agent_goals[it])
+            dict_actions[it], dict_info[it] = self.get_agent_action(it, obs, action_space, true_graph=true_graph)
+        return dict_actions, dict_info
 
-            else:
-                goal_spec = self.env.get_goal(self.task_goal[it], self.env.agent_goals[it])
-            
-            if agent.agent_type in ['MCTS', 'Random']:
-                opponent_subgoal = None
-                if agent.recursive:
-                    opponent_subgoal = self.agents[1 - it].last_subgoal
-                
-                dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec, opponent_subgoal)
-                
-            elif 'RL' in agent.agent_type:
-                if 'MCTS' in agent.agent_type or 'Random' in agent.agent_type:
-                    if true_graph:
-                        full_graph = self.env.get_graph()
-                    else:
-                        full_graph = None
-                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], goal_spec,
-                                                                       action_space_ids=action_space[it], full_graph=full_graph)
+    def get_agent_action(self, it, obs, action_space=None, true_graph=False):
+        agent = self.agents[it]
+        goal_spec = self.get_goal_spec(it)
 
+        if agent.agent_type in ['MCTS', 'Random']:
+            opponent_subgoal = None
+            if agent.recursive:
+                opponent_subgoal = self.agents[1 - it].last_subgoal
+
+            return agent.get_action(obs[it], goal_spec, opponent_subgoal)
+
+        elif 'RL' in agent.agent_type:
+            if 'MCTS' in agent.agent_type or 'Random' in agent.agent_type:
+                if true_graph:
+                    full_graph = self.env.get_graph()
                 else:
-                    # RL_RL agemt
-                    dict_actions[it], dict_info[it] = agent.get_action(obs[it], self.task_goal, action_space_ids=action_space[it])
-        return dict_actions, dict_info
+                    full_graph = None
+                return agent.get_action(obs[it], goal_spec, action_space_ids=action_space[it], full_graph=full_graph)
+
+            else:
+                # RL_RL agemt
+                return agent.get_action(obs[it], self.task_goal, action_space_ids=action_space[it])
 
     def reset_env(self):
         self.env.close()
@@ -121,6 +126,20 @@ class ArenaMP(object):
             return self.rollout(logging, record, episode_id=episode_id, is_train=is_train, goals=goals)
 
     def rollout(self, logging=0, record=False, episode_id=None, is_train=True, goals=None):
+        episode = self.rollout_episode(logging, record, episode_id=episode_id, is_train=is_train, goals=goals)
+        try:
+            true_graph = next(episode)
+            while True:
+                true_graph = episode.send(self.step(true_graph=true_graph))
+        except StopIteration as stop:
+            return stop.value
+
+    def rollout_episode(self, logging=0, record=False, episode_id=None, is_train=True, goals=None):
+        """
+        Episode of rollout as a generator: it yields true_graph every time it needs a step, and is sent
+        the output of step. rollout runs the steps one by one, algos/vec_arena.py in lockstep with other arenas.
+        Returns c_r_all, info_rollout, rollout_agent
+        """
         t1 = time.time()
         print("rollout", episode_id, is_train)
         if episode_id is not None:
@@ -198,7 +217,7 @@ class ArenaMP(object):
         if not is_train:
             pbar = tqdm(total=self.max_episode_length)
         while not done and nb_steps < self.max_episode_length and agent_steps < self.max_number_steps:
-            (obs, reward, done, env_info), agent_actions, agent_info = self.step(true_graph=is_train)
+            (obs, reward, done, env_info), agent_actions, agent_info = yield is_train
             step_failed = env_info['failed_exec']
             if step_failed:
                 print("FAILING in task")
@@ -363,10 +382,12 @@ class ArenaMP(object):
         return step_info, dict_actions, dict_info
 
 
-    def run(self, random_goal=False, pred_goal=None, save_img=None):
+    def run(self, random_goal=False, pred_goal=None, save_img=None, delta_log=False):
         """
         self.task_goal: goal inference
         self.env.task_goal: ground-truth goal
+        delta_log: keep the graphs and beliefs of saved_info as utils_episode_log.DeltaSequence,
+        to save them with utils_episode_log.save_episode_log
         """
         self.task_goal = copy.deepcopy(self.env.task_goal)
         if random_goal:
@@ -393,6 +414,8 @@ class ArenaMP(object):
                       'belief_graph': {0: [], 1: []},
                       'graph': [self.env.init_unity_graph],
                       'obs': []}
+        if delta_log:
+            saved_info = utils_episode_log.to_sequences(saved_info)
         success = False
         num_failed = 0
         num_repeated = 0
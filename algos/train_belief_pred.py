@@ -10,11 +10,15 @@ import pickle as pkl
 from tqdm import tqdm
 import ipdb
 from dataloader.dataloader_v3 import AgentTypeDataset
+from dataloader.dataloader_memmap import MemmapAgentTypeDataset, memmap_path
+from dataloader.dataloader_stream import StreamingAgentTypeDataset, shards_path
+from dataloader.dataloader_packed import LengthBucketSampler, collate_packed, get_episode_lengths
 from arguments import *
 from torch import nn
 import torch.optim as optim
 from models import agent_pref_policy, agent_belief_inference
 import utils.utils_models as utils_models
+from utils import distributed_train
 from utils.utils_models import AverageMeter, ProgressMeter, LoggerSteps
 
 import hydra
@@ -558,6 +562,9 @@ def train_epoch(data_loader, model, epoch, args, criterion, optimizer, logger):
         batch_time.update(time.time() - end)
         end = time.time()
 
+        if logger is None:
+            # Only rank 0 logs
+            continue
         if it % args['log']['print_every'] == 0:
             progress.display(it)
         if it % args['log']['print_long_every'] == 0:
@@ -648,15 +655,43 @@ def train_epoch(data_loader, model, epoch, args, criterion, optimizer, logger):
 
 
 def get_loaders(args):
-    dataset = AgentTypeDataset(path_init='../dataset/{}'.format(args['data']['train_data']), args_config=args)
-    dataset_test = AgentTypeDataset(path_init='../dataset/{}'.format(args['data']['test_data']), args_config=args)
+    if args['data'].get('memmap', False):
+        # Preprocessed with dataloader/dataloader_memmap.py
+        dataset = MemmapAgentTypeDataset(memmap_path('../dataset/{}'.format(args['data']['train_data'])), args_config=args)
+        dataset_test = MemmapAgentTypeDataset(memmap_path('../dataset/{}'.format(args['data']['test_data'])), args_config=args)
+    elif args['data'].get('stream', False):
+        # Sharded with dataloader/dataloader_stream.py, the dataset does the shuffling.
+        # Evaluation is done by rank 0 alone, on all the test shards
+        dataset = StreamingAgentTypeDataset(shards_path('../dataset/{}'.format(args['data']['train_data'])), args_config=args)
+        dataset_test = StreamingAgentTypeDataset(shards_path('../dataset/{}'.format(args['data']['test_data'])), args_config=args,
+                                                 shuffle=not args['eval'], split_ranks=False)
+    else:
+        dataset = AgentTypeDataset(path_init='../dataset/{}'.format(args['data']['train_data']), args_config=args)
+        dataset_test = AgentTypeDataset(path_init='../dataset/{}'.format(args['data']['test_data']), args_config=args)
+    is_stream = isinstance(dataset, torch.utils.data.IterableDataset)
+    # With several processes, every one of them gets a part of the batch. Evaluation is done by rank 0
+    batch_size = max(1, args['train']['batch_size'] // distributed_train.get_world_size())
+    if args['data'].get('bucket_batches', False) and not is_stream:
+        # Batches of episodes of similar length, with the padding cut
+        train_sampler = LengthBucketSampler(get_episode_lengths(dataset), batch_size,
+                                            num_replicas=distributed_train.get_world_size(), rank=distributed_train.get_rank())
+        test_sampler = LengthBucketSampler(get_episode_lengths(dataset_test), batch_size, shuffle=not args['eval'])
+        train_loader = torch.utils.data.DataLoader(
+                dataset, batch_sampler=train_sampler, collate_fn=collate_packed,
+                num_workers=args['train']['num_workers'], pin_memory=True)
+        test_loader = torch.utils.data.DataLoader(
+                dataset_test, batch_sampler=test_sampler, collate_fn=collate_packed,
+                num_workers=args['train']['num_workers'], pin_memory=True)
+        return train_loader, test_loader
+
+    train_sampler = None if is_stream else distributed_train.get_sampler(dataset)
     train_loader = torch.utils.data.DataLoader(
-            dataset, batch_size=args['train']['batch_size'], 
-            shuffle=True, num_workers=args['train']['num_workers'], pin_memory=True)
+            dataset, batch_size=batch_size, sampler=train_sampler,
+            shuffle=not is_stream and train_sampler is None, num_workers=args['train']['num_workers'], pin_memory=True)
 
     test_loader = torch.utils.data.DataLoader(
-            dataset_test, batch_size=args['train']['batch_size'], 
-            shuffle=not args['eval'], num_workers=args['train']['num_workers'], pin_memory=True)
+            dataset_test, batch_size=batch_size, 
+            shuffle=not args['eval'] and not is_stream, num_workers=args['train']['num_workers'], pin_memory=True)
     return train_loader, test_loader
 
 
@@ -668,14 +703,25 @@ def main(cfg: DictConfig):
     print(OmegaConf.to_yaml(cfg))
     # ipdb.set_trace()
 
+    num_processes = config['train'].get('num_processes', 1)
+    if num_processes > 1:
+        # CPU training in several processes, with gloo
+        distributed_train.launch(run, num_processes, fn_args=(config,))
+    else:
+        run(0, 1, config)
+
+
+def run(rank, world_size, config):
     train_loader, test_loader = get_loaders(config)
     if config.model.gated:
         model = agent_belief_inference.ActionGatedPredNetwork(config)
     else:
         model = agent_belief_inference.ActionPredNetwork(config)
 
-    print("CUDA: {}".format(cfg.cuda))
-    if cfg.cuda:
+    print("CUDA: {}".format(config.cuda))
+    if world_size > 1:
+        model = distributed_train.distributed_model(model)
+    elif config.cuda:
         model = model.cuda()
         model = nn.DataParallel(model)
     criterion = nn.CrossEntropyLoss(reduction='none')
@@ -690,16 +736,24 @@ def main(cfg: DictConfig):
     print("Failures: ", train_loader.dataset.get_failures())
     
     if not config['eval']:
-        logger = LoggerSteps(config)
-
-        logger.save_model(0, model, optimizer)
+        logger = None
+        if distributed_train.is_main_process():
+            logger = LoggerSteps(config)
+            logger.save_model(0, model, optimizer)
 
         for epoch in range(config['train']['epochs']):
-            train_epoch(train_loader, model, epoch, config, criterion, optimizer, logger)
-            evaluate(test_loader, train_loader, model, epoch, config, criterion, logger)
-            if epoch % 10 == 0:
-                logger.save_model(epoch, model, optimizer)
-    else:
+            for epoch_holder in [train_loader.dataset, train_loader.sampler, train_loader.batch_sampler]:
+                if hasattr(epoch_holder, 'set_epoch'):
+                    epoch_holder.set_epoch(epoch)
+            # The shards of a stream give the processes different numbers of batches
+            with distributed_train.join(model, enable=isinstance(train_loader.dataset, torch.utils.data.IterableDataset)):
+                train_epoch(train_loader, model, epoch, config, criterion, optimizer, logger)
+            if distributed_train.is_main_process():
+                evaluate(test_loader, train_loader, model, epoch, config, criterion, logger)
+                if epoch % 10 == 0:
+                    logger.save_model(epoch, model, optimizer)
+            distributed_train.barrier()
+    elif distributed_train.is_main_process():
         epoch = 0
         evaluate(test_loader, train_loader, model, epoch, config, criterion, None, save_folder=config['save_folder'])
 
@@ -30,8 +30,15 @@ def unmerge(tensor, firstdim):
     dim = list(tensor.shape)
     return tensor.reshape([firstdim, -1] + dim[1:])
 
+def refresh_context_cache(model):
+    # Context vectors are recomputed when the weights changed enough since they were cached
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model.refresh_context_cache()
+
 def evaluate(data_loader, data_loader_train, model, epoch, args, criterion, logger, save_folder=None):
     model.eval()
+    refresh_context_cache(model)
 
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
@@ -373,6 +380,7 @@ def train_epoch(data_loader, model, epoch, args, criterion, optimizer, logger):
         prefix="Epoch: [{}]".format(epoch))
 
     model.train()
+    refresh_context_cache(model)
     
     end = time.time()
 
@@ -423,6 +423,9 @@ def train_epoch(data_loader, model, epoch, args, criterion, optimizer, logger):
         batch_time.update(time.time() - end)
         end = time.time()
 
+        if logger is None:
+            # Only rank 0 logs
+            continue
         if it % args['log']['print_every'] == 0:
             progress.display(it)
         if it % args['log']['print_long_every'] == 0:
@@ -461,7 +464,8 @@ def train_epoch(data_loader, model, epoch, args, criterion, optimizer, logger):
             }
             logger.log_info(info_res)
 
-    logger.log_embeds(len(data_loader) * epoch, model.module.agent_embedding)
+    if logger is not None:
+        logger.log_embeds(len(data_loader) * epoch, model.module.agent_embedding)
     print("Failed Elements...", data_loader.dataset.get_failures())
 
 
@@ -470,12 +474,15 @@ def get_loaders(args):
     dataset_test = AgentTypeDataset(path_init='../dataset/{}'.format(args['data']['test_data']), args_config=args)
     if args['model']['state_encoder'] == 'GNN':
         collate_fn = dataloader_v2.collate_fn
+    # With several processes, every one of them gets a part of the batch. Evaluation is done by rank 0
+    batch_size = max(1, args['train']['batch_size'] // distributed_train.get_world_size())
+    train_sampler = distributed_train.get_sampler(dataset)
     train_loader = torch.utils.data.DataLoader(
-            dataset, batch_size=args['train']['batch_size'], 
-            shuffle=True, num_workers=args['train']['num_workers'], pin_memory=True, collate_fn=collate_fn)
+            dataset, batch_size=batch_size, sampler=train_sampler,
+            shuffle=train_sampler is None, num_workers=args['train']['num_workers'], pin_memory=True, collate_fn=collate_fn)
 
     test_loader = torch.utils.data.DataLoader(
-            dataset_test, batch_size=args['train']['batch_size'], 
+            dataset_test, batch_size=batch_size, 
             shuffle=True, num_workers=args['train']['num_workers'], pin_memory=True, collate_fn=collate_fn)
     return train_loader, test_loader
 
@@ -488,29 +495,45 @@ def main(cfg: DictConfig):
     print(OmegaConf.to_yaml(cfg))
     # ipdb.set_trace()
 
+    num_processes = config['train'].get('num_processes', 1)
+    if num_processes > 1:
+        # CPU training in several processes, with gloo
+        distributed_train.launch(run, num_processes, fn_args=(config,))
+    else:
+        run(0, 1, config)
+
+
+def run(rank, world_size, config):
     train_loader, test_loader = get_loaders(config)
     if config.model.gated:
         model = agent_pref_policy.ActionGatedPredNetwork(config)
     else:
         model = agent_pref_policy.ActionPredNetwork(config)
 
-    print("CUDA: {}".format(cfg.cuda))
-    if cfg.cuda:
+    print("CUDA: {}".format(config.cuda))
+    if world_size > 1:
+        model = distributed_train.distributed_model(model)
+    elif config.cuda:
         model = model.cuda()
         model = nn.DataParallel(model)
     criterion = nn.CrossEntropyLoss(reduction='none')
     optimizer = optim.Adam(model.parameters(), lr=config['train']['lr'])
     print("Failures: ", train_loader.dataset.get_failures())
 
-    logger = LoggerSteps(config)
-
-    logger.save_model(0, model, optimizer)
+    logger = None
+    if distributed_train.is_main_process():
+        logger = LoggerSteps(config)
+        logger.save_model(0, model, optimizer)
 
     for epoch in range(config['train']['epochs']):
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
         train_epoch(train_loader, model, epoch, config, criterion, optimizer, logger)
-        evaluate(test_loader, train_loader, model, epoch, config, criterion, logger)
-        if epoch % 10 == 0:
-            logger.save_model(epoch, model, optimizer)
+        if distributed_train.is_main_process():
+            evaluate(test_loader, train_loader, model, epoch, config, criterion, logger)
+            if epoch % 10 == 0:
+                logger.save_model(epoch, model, optimizer)
+        distributed_train.barrier()
 
 
 if __name__ == '__main__':
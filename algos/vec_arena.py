@@ -0,0 +1,181 @@
+import traceback
+from utils import utils_rl_agent
+from algos.arena_mp2 import ArenaMP
+
+# Runs the episodes of num_envs ArenaMP in lockstep, in a single process. In every step the RL agents of
+# all the environments build their inputs (belief, GraphHelper.build_graph), the policy runs once for
+# the whole batch with ActorCritic.act_batch, and the actions are sent to every environment. The
+# episodes are the ArenaMP.rollout_episode generators, so the logging and memory of every episode are the
+# ones of ArenaMP.rollout. When an episode finishes, its environment starts the next one. The RL agents of
+# all the arenas share the models of the first one.
+#
+# Meant for the python simulator (GraphEnvironment, PythonEnvironment), where most of the time of a
+# step is spent in the agents: python training_agents/train_a2c.py --num-envs 8 --simulator-type python
+
+# Models that the RL agents of all the arenas share
+shared_models = ['actor_critic', 'actor_critic_low_level', 'actor_critic_low_level_put']
+
+
+class VecArena(object):
+    def __init__(self, max_number_steps, environment_fn, agent_fn, num_envs, max_restarts=3):
+        self.arenas = [ArenaMP(max_number_steps, arena_id, environment_fn, agent_fn) for arena_id in range(num_envs)]
+        self.num_envs = num_envs
+        self.num_agents = len(agent_fn)
+        self.max_restarts = max_restarts
+
+        for arena in self.arenas[1:]:
+            for agent, main_agent in zip(arena.agents, self.agents):
+                if 'RL' not in agent.agent_type:
+                    continue
+                for model_name in shared_models:
+                    if hasattr(main_agent, model_name):
+                        setattr(agent, model_name, getattr(main_agent, model_name))
+                if hasattr(main_agent, 'policies'):
+                    agent.policies = main_agent.policies
+
+    @property
+    def agents(self):
+        return self.arenas[0].agents
+
+    def close(self):
+        for arena in self.arenas:
+            arena.close()
+
+    def set_epsilon(self, epsilon):
+        for arena in self.arenas:
+            for agent in arena.agents:
+                if 'RL' in agent.agent_type:
+                    agent.epsilon = epsilon
+
+    def set_weigths(self, epsilon, weights):
+        # The models are shared, loading them in one arena is enough
+        self.arenas[0].set_weigths(epsilon, weights)
+        self.set_epsilon(epsilon)
+
+    def start_episode(self, arena, logging, record, episode_id, is_train, goals):
+        """Resets the environment of arena, restarting it if it fails. Returns the episode and its first true_graph"""
+        for num_restarts in range(self.max_restarts + 1):
+            try:
+                episode = arena.rollout_episode(logging, record, episode_id=episode_id, is_train=is_train, goals=goals)
+                return episode, next(episode)
+            except Exception:
+                traceback.print_exc()
+                if num_restarts == self.max_restarts:
+                    raise
+                arena.reset_env()
+
+    def batchable(self, agent):
+        # Agents with the high level policy of HRL_agent, the others act as in ArenaMP.get_actions
+        return 'RL' in agent.agent_type and 'MCTS' in agent.agent_type and hasattr(agent, 'prepare_action')
+
+    def get_actions(self, running):
+        """
+        Actions of all the agents of the running arenas, running the policy once for every group of agents
+        with the same model. Returns {arena_id: (dict_actions, dict_info)}, or None for arenas whose environment failed
+        """
+        actions = {}
+        to_finish = []
+        batches = {}
+        for arena_id, (episode, true_graph, _) in running.items():
+            arena = self.arenas[arena_id]
+            try:
+                obs = arena.env.get_observations()
+                action_space = arena.env.get_action_space()
+                dict_actions, dict_info = {}, {}
+                for it, agent in enumerate(arena.agents):
+                    if not self.batchable(agent):
+                        dict_actions[it], dict_info[it] = arena.get_agent_action(it, obs, action_space, true_graph=true_graph)
+                        continue
+                    full_graph = arena.env.get_graph() if true_graph else None
+                    step_inputs = agent.prepare_action(obs[it], arena.get_goal_spec(it),
+                                                       action_space_ids=action_space[it], full_graph=full_graph)
+                    to_finish.append((arena_id, it, step_inputs))
+                    if step_inputs['act']:
+                        policy = agent.policies['high_level']
+                        batches.setdefault((id(policy), agent.deterministic), (policy, []))[1].append(len(to_finish) - 1)
+                actions[arena_id] = (dict_actions, dict_info)
+            except Exception:
+                traceback.print_exc()
+                actions[arena_id] = None
+
+        policy_outputs = {}
+        for (_, deterministic), (policy, batch) in batches.items():
+            agents = [self.arenas[to_finish[index][0]].agents[to_finish[index][1]] for index in batch]
+            inputs = [to_finish[index][2] for index in batch]
+            outputs = policy.act_batch(
+                utils_rl_agent.cat_batch([step_inputs['inputs_tensor'] for step_inputs in inputs]),
+                utils_rl_agent.cat_batch([step_inputs['rnn_hxs'] for step_inputs in inputs]),
+                utils_rl_agent.cat_batch([step_inputs['masks'] for step_inputs in inputs]),
+                deterministic=deterministic,
+                epsilon=[agent.epsilon for agent in agents])
+            policy_outputs.update(zip(batch, outputs))
+
+        for index, (arena_id, it, step_inputs) in enumerate(to_finish):
+            if actions[arena_id] is None:
+                continue
+            dict_actions, dict_info = actions[arena_id]
+            try:
+                agent = self.arenas[arena_id].agents[it]
+                dict_actions[it], dict_info[it] = agent.finish_action(step_inputs, policy_outputs.get(index, None))
+            except Exception:
+                traceback.print_exc()
+                actions[arena_id] = None
+        return actions
+
+    def rollout(self, logging=0, record=False, episode_id=None, is_train=True, goals=None, num_episodes=None):
+        """
+        Runs num_episodes episodes (num_envs by default) with the environments in lockstep. episode_id is an
+        episode, a list with the episode of every rollout or None (random episodes). Only the first episode is
+        logged. Returns the list of (c_r_all, info_rollout, rollout_agent) of ArenaMP.rollout
+        """
+        if episode_id is None:
+            if num_episodes is None:
+                num_episodes = self.num_envs
+            episode_ids = [None] * num_episodes
+        elif isinstance(episode_id, (list, tuple)):
+            episode_ids = list(episode_id)
+        else:
+            episode_ids = [episode_id]
+
+        results = [None] * len(episode_ids)
+        num_restarts = [0] * len(episode_ids)
+        next_episode = 0
+        # arena_id: (episode generator, true_graph, episode index)
+        running = {}
+        while next_episode < len(episode_ids) or len(running) > 0:
+            for arena_id, arena in enumerate(self.arenas):
+                if arena_id in running or next_episode >= len(episode_ids):
+                    continue
+                curr_log = logging if next_episode == 0 else 0
+                episode, true_graph = self.start_episode(arena, curr_log, record, episode_ids[next_episode], is_train, goals)
+                running[arena_id] = (episode, true_graph, next_episode)
+                next_episode += 1
+
+            actions = self.get_actions(running)
+            for arena_id in list(running.keys()):
+                arena = self.arenas[arena_id]
+                episode, _, episode_index = running[arena_id]
+                try:
+                    if actions[arena_id] is None:
+                        raise Exception('Failed to get the actions of arena {}'.format(arena_id))
+                    dict_actions, dict_info = actions[arena_id]
+                    step_info = arena.env.step(dict_actions)
+                    true_graph = episode.send((step_info, dict_actions, dict_info))
+                    running[arena_id] = (episode, true_graph, episode_index)
+
+                except StopIteration as stop:
+                    results[episode_index] = stop.value
+                    del running[arena_id]
+
+                except Exception:
+                    # As in ArenaMP.rollout_reset, the environment is restarted and the episode run again
+                    traceback.print_exc()
+                    num_restarts[episode_index] += 1
+                    if num_restarts[episode_index] > self.max_restarts:
+                        raise
+                    arena.reset_env()
+                    curr_log = logging if episode_index == 0 else 0
+                    episode, true_graph = self.start_episode(arena, curr_log, record, episode_ids[episode_index], is_train, goals)
+                    running[arena_id] = (episode, true_graph, episode_index)
+
+        return results
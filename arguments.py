@@ -34,6 +34,12 @@ def get_args():
     parser.add_argument('--load-model', type=str, default='',
                         help='whether the model is loaded')
 
+    parser.add_argument('--delta-log', action='store_true', default=False,
+                        help='save the episode logs in the delta encoded format of utils/utils_episode_log.py')
+
+    parser.add_argument('--compiled-policy', type=str, default='',
+                        help='folder with the TorchScript policies exported by models/policy_export.py, used by the RL agents to act')
+
     parser.add_argument('--num-per-apartment', type=int, default=3, help='Maximum #episodes/apartment')
     parser.add_argument(
         '--algo', default='a2c', help='algorithm to use: a2c | ppo | acktr')
@@ -290,6 +296,18 @@ def get_args():
     parser.add_argument('--on-policy', action='store_true', default=False,
                         help='whether to run on or off policy')
 
+    parser.add_argument('--async-learner', action='store_true', default=False,
+                        help='train while the arenas (--num-processes) collect episodes, with V-trace')
+
+    parser.add_argument('--weights-interval', type=int, default=1,
+                        help='updates between two versions of the weights sent to the arenas, with --async-learner')
+
+    parser.add_argument('--vtrace-rho', type=float, default=1.0,
+                        help='truncation of the importance weights of the V-trace targets (rho bar)')
+
+    parser.add_argument('--vtrace-c', type=float, default=1.0,
+                        help='truncation of the traces of the V-trace targets (c bar)')
+
     parser.add_argument('--add-timestep', action='store_true', default=False,
                         help='add timestep to observations')
 
@@ -319,6 +337,17 @@ def get_args():
     parser.add_argument(
             '--agenttype', type=str, default="all")
 
+    # Episode generation with testing_agents/schedule_single_agent_v2.py
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='episode generation workers, each with its own simulator. 0 uses all the cores')
+    parser.add_argument('--num-planner-processes', type=int, default=10,
+                        help='planner processes of the agent of every worker')
+    parser.add_argument('--jobs-db', type=str, default='', help='SQLite file with the episode generation jobs')
+    parser.add_argument('--max-attempts', type=int, default=3, help='attempts before a job is marked as failed')
+    parser.add_argument('--retry-backoff', type=float, default=30., help='seconds before retrying a failed job, doubled every attempt')
+    parser.add_argument('--retry-failed', action='store_true', default=False, help='retry the jobs marked as failed')
+    parser.add_argument('--report', action='store_true', default=False, help='print the progress of the jobs and exit')
+
     parser.add_argument(
         '--env-name',
         default='virtualhome',
@@ -328,13 +357,19 @@ def get_args():
         '--simulator-type',
         default='unity',
         choices=['unity', 'python'],
-        help='whether to use unity or python sim')
+        help='whether to use unity or python sim (envs/graph_environment.py in the testing scripts)')
 
     parser.add_argument(
         '--num-processes',
         type=int,
         default=1,
         help='how many training CPU processes to use (default: 1)')
+    parser.add_argument(
+        '--num-envs',
+        type=int,
+        default=1,
+        help='environments stepped in lockstep by algos/vec_arena.py in the training process, '
+             'with batched policy inference (default: 1, uses ArenaMP)')
 
     parser.add_argument('--saveimg', action='store_true', default=False,
             help='whether we save images')
@@ -0,0 +1,372 @@
+"""
+Micro-benchmarks of the python planner, run offline on the graphs bundled in analysis/wah_data.
+
+Times the env transition, observation masking, check_progress, belief sampling/update,
+each heuristic and full MCTS_particles_v2 decisions for several num_simulation / particle counts.
+
+Usage (from the repo root):
+    python benchmarks/run_benchmarks.py --output benchmarks/results.json
+    python benchmarks/run_benchmarks.py --save_baseline                      # stores benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --flags compact_graph,heuristic_cache  # compare the planner flags
+
+Results are written as json. If a baseline exists, every benchmark is compared against it and the ones
+slower than (1 + tolerance) times the baseline mean are reported as regressions.
+"""
+import sys
+import os
+import copy
+import json
+import time
+import random
+import argparse
+import importlib
+import platform
+import subprocess
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+base_path = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(base_path))
+
+from utils import utils_environment as utils_env
+from utils.utils_graph import CompactGraph
+
+
+default_data_dir = base_path / 'analysis/wah_data/planner_truegoal/logs_agent_58_prepare_food_0'
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Planner micro-benchmarks')
+    parser.add_argument('--data_dir', type=str, default=str(default_data_dir), help='Folder with init_graph.json and the episode files')
+    parser.add_argument('--episode', type=int, default=0, help='Episode file used to build the goal')
+    parser.add_argument('--repeat', type=int, default=20, help='Repetitions of every micro-benchmark')
+    parser.add_argument('--repeat_mcts', type=int, default=3, help='Repetitions of every MCTS decision')
+    parser.add_argument('--num_simulation', type=str, default='10,50', help='Comma separated num_simulation values')
+    parser.add_argument('--num_particles', type=str, default='1,5', help='Comma separated particle counts')
+    parser.add_argument('--max_rollout_steps', type=int, default=5)
+    parser.add_argument('--flags', type=str, default='', help='Comma separated agent_params flags to enable, e.g. compact_graph,heuristic_cache')
+    parser.add_argument('--only', type=str, default='', help='Comma separated benchmark groups to run: {}'.format(','.join(benchmark_groups)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=str(base_path / 'benchmarks/results.json'))
+    parser.add_argument('--baseline', type=str, default=str(base_path / 'benchmarks/baseline.json'))
+    parser.add_argument('--save_baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative slowdown reported as a regression')
+    parser.add_argument('--strict', action='store_true', help='Exit with an error if there are regressions')
+    return parser.parse_args()
+
+
+def load_graph(data_dir):
+    """
+    init_graph.json stores every INSIDE edge of the containment chain and does not place the character.
+    Keep the closest container of every object and put the character in the first room.
+    """
+    with open(os.path.join(data_dir, 'init_graph.json'), 'r') as f:
+        graph = json.load(f)['graph']
+    id2node = {node['id']: node for node in graph['nodes']}
+    rooms = [node['id'] for node in graph['nodes'] if node['category'] == 'Rooms']
+
+    inside = {}
+    for edge in graph['edges']:
+        if edge['relation_type'] == 'INSIDE':
+            inside.setdefault(edge['from_id'], []).append(edge['to_id'])
+    closest = {}
+    for from_id, to_ids in inside.items():
+        non_rooms = [to_id for to_id in to_ids if to_id not in rooms]
+        closest[from_id] = non_rooms[0] if len(non_rooms) > 0 else to_ids[0]
+
+    edges = [edge for edge in graph['edges'] if edge['relation_type'] != 'INSIDE']
+    edges += [{'from_id': from_id, 'relation_type': 'INSIDE', 'to_id': to_id} for from_id, to_id in closest.items()]
+    for node in graph['nodes']:
+        if node['category'] == 'Characters' and node['id'] not in closest:
+            edges.append({'from_id': node['id'], 'relation_type': 'INSIDE', 'to_id': rooms[0]})
+    graph['edges'] = [edge for edge in edges if edge['from_id'] in id2node and edge['to_id'] in id2node]
+    return graph
+
+
+def load_goal(data_dir, episode):
+    with open(os.path.join(data_dir, 'file_{}.json'.format(episode)), 'r') as f:
+        predicates = json.load(f)['predicates']
+    return {pred: [count, True, 1] for pred, count in predicates.items() if count > 0}
+
+
+def timeit(fn, repeat, setup=None):
+    """Runs fn repeat times, setup (not timed) builds the arguments of every call"""
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        'mean': float(times.mean()),
+        'std': float(times.std()),
+        'min': float(times.min()),
+        'median': float(np.median(times)),
+        'n': int(len(times))
+    }
+
+
+class Context():
+    def __init__(self, args):
+        self.args = args
+        self.graph = load_graph(args.data_dir)
+        self.goal_spec = load_goal(args.data_dir, args.episode)
+        self.id2node = {node['id']: node for node in self.graph['nodes']}
+        self.agent_id = [node['id'] for node in self.graph['nodes'] if node['category'] == 'Characters'][0]
+        self.rooms = [node['id'] for node in self.graph['nodes'] if node['category'] == 'Rooms']
+        self.agent_params = {
+            'obs_type': 'partial',
+            'open_cost': 0,
+            'should_close': False,
+            'walk_cost': 0.05,
+            'belief': {'forget_rate': 0, 'belief_type': 'uniform'}
+        }
+        for flag in args.flags.split(','):
+            if len(flag) > 0:
+                self.agent_params[flag] = True
+
+        # Objects of the goal and where they should go
+        goal_elements = [pred.split('_') for pred in self.goal_spec]
+        goal_classes = [elements[1] for elements in goal_elements]
+        self.goal_objects = [node['id'] for node in self.graph['nodes'] if node['class_name'] in goal_classes]
+        self.goal_target = int(goal_elements[0][2])
+        inside = {edge['from_id']: edge['to_id'] for edge in self.graph['edges'] if edge['relation_type'] == 'INSIDE'}
+        self.containers = sorted(set([inside[obj_id] for obj_id in self.goal_objects if obj_id in inside]) - set(self.rooms))
+        self.inside = inside
+
+    def get_env(self):
+        from envs.graph_env import VhGraphEnv
+        env = VhGraphEnv()
+        env.pomdp = True
+        env.reset(copy.deepcopy(self.graph))
+        return env
+
+    def node_with_property(self, prop):
+        return [node['id'] for node in self.graph['nodes'] if prop in node['properties']][0]
+
+
+def bench_transition(ctx):
+    env = ctx.get_env()
+    obj_id = ctx.goal_objects[0]
+    container_id = ctx.inside[obj_id]
+    scripts = {
+        'walk': '[walk] <{}> ({})'.format(ctx.id2node[obj_id]['class_name'], obj_id),
+        'open': '[open] <{}> ({})'.format(ctx.id2node[container_id]['class_name'], container_id),
+        'grab': '[grab] <{}> ({})'.format(ctx.id2node[obj_id]['class_name'], obj_id),
+    }
+    results = {}
+    for name, script in scripts.items():
+        results['transition/{}'.format(name)] = timeit(
+            lambda: env.transition(env.vh_state, {0: script}), ctx.args.repeat)
+    results['get_vh_state'] = timeit(lambda: env.get_vh_state(env.state), ctx.args.repeat)
+    return results
+
+
+def bench_mask_state(ctx):
+    env = ctx.get_env()
+    state = env.state
+    compact = CompactGraph.from_dict(state)
+    return {
+        'mask_state': timeit(lambda: env._mask_state(state, 0), ctx.args.repeat),
+        # New graph every call, includes building the VisibilityEngine
+        'mask_state/new_graph': timeit(lambda graph: env._mask_state(graph, 0), ctx.args.repeat,
+                                       setup=lambda: (copy.copy(state),)),
+        'mask_state/full': timeit(lambda: env._mask_state_full(state, 0), ctx.args.repeat),
+        'mask_state/compact': timeit(lambda: env._mask_state(compact, 0), ctx.args.repeat),
+        # New compact graph every call, includes building the adjacency
+        'mask_state/compact_new_graph': timeit(lambda graph: env._mask_state(graph, 0), ctx.args.repeat,
+                                               setup=lambda: (CompactGraph.from_dict(state),)),
+    }
+
+
+def bench_check_progress(ctx):
+    compact = CompactGraph.from_dict(ctx.graph)
+    return {
+        'check_progress': timeit(lambda: utils_env.check_progress(ctx.graph, ctx.goal_spec), ctx.args.repeat),
+        'check_progress/compact': timeit(lambda: utils_env.check_progress(compact, ctx.goal_spec), ctx.args.repeat),
+    }
+
+
+def bench_belief(ctx):
+    from agents import belief
+    env = ctx.get_env()
+    obs = env.observable_state_n[0]
+    belief_params = ctx.agent_params['belief']
+    bel = belief.Belief(copy.deepcopy(env.state), agent_id=ctx.agent_id, seed=ctx.args.seed, belief_params=belief_params)
+    results = {
+        'belief/init': timeit(lambda: belief.Belief(env.state, agent_id=ctx.agent_id, belief_params=belief_params), ctx.args.repeat),
+        'belief/sample_from_belief': timeit(lambda: bel.sample_from_belief(), ctx.args.repeat),
+        'belief/update_from_gt_graph': timeit(lambda: bel.update_from_gt_graph(obs), ctx.args.repeat),
+        'belief/update_graph_from_gt_graph': timeit(
+            lambda: bel.update_graph_from_gt_graph(obs, resample_unseen_nodes=True, update_belief=False), ctx.args.repeat),
+    }
+    for num_particles in parse_list(ctx.args.num_particles):
+        results['belief/sample_particles/p{}'.format(num_particles)] = timeit(
+            lambda: bel.sample_particles(num_particles, obs), ctx.args.repeat)
+    return results
+
+
+def bench_heuristics(ctx):
+    # agents/__init__ exports the classes with the module names
+    agent_module = importlib.import_module('agents.MCTS_agent_particle_v2')
+    env = ctx.get_env()
+    state = env.state
+    _, unsatisfied = utils_env.check_progress(state, ctx.goal_spec)
+    obj_id = ctx.goal_objects[0]
+    container_id = ctx.containers[0] if len(ctx.containers) > 0 else ctx.goal_target
+    subgoals = {
+        'find': 'find_{}'.format(obj_id),
+        'grab': 'grab_{}'.format(obj_id),
+        'touch': 'touch_{}'.format(obj_id),
+        'put': 'put_{}_{}'.format(obj_id, ctx.goal_target),
+        'putIn': 'putIn_{}_{}'.format(obj_id, container_id),
+        'sit': 'sit_{}'.format(ctx.node_with_property('SITTABLE')),
+        'turnOn': 'turnOn_{}'.format(ctx.node_with_property('HAS_SWITCH')),
+    }
+    results = {}
+    for name, heuristic in agent_module.heuristic_dict.items():
+        subgoal = subgoals[name]
+        results['heuristic/{}'.format(name)] = timeit(
+            lambda: heuristic(ctx.agent_id, 0, unsatisfied, state, env, subgoal), ctx.args.repeat)
+    return results
+
+
+def bench_mcts(ctx):
+    from MCTS.MCTS_particles_v2 import MCTS_particles_v2
+    from agents import belief
+    agent_module = importlib.import_module('agents.MCTS_agent_particle_v2')
+    env = ctx.get_env()
+    obs = env.observable_state_n[0]
+
+    results = {}
+    for num_particles in parse_list(ctx.args.num_particles):
+        bel = belief.Belief(copy.deepcopy(env.state), agent_id=ctx.agent_id, seed=ctx.args.seed,
+                            belief_params=ctx.agent_params['belief'])
+        bel.update_belief(obs)
+        particles = []
+        for _ in range(num_particles):
+            new_graph = bel.update_graph_from_gt_graph(obs, resample_unseen_nodes=True, update_belief=False)
+            init_state = agent_module.clean_graph(new_graph, ctx.goal_spec, None)
+            satisfied, unsatisfied = utils_env.check_progress(init_state, ctx.goal_spec)
+            particles.append((env.get_vh_state(init_state), init_state, satisfied, unsatisfied))
+
+        for num_simulation in parse_list(ctx.args.num_simulation):
+            def setup():
+                random.seed(ctx.args.seed)
+                np.random.seed(ctx.args.seed)
+                mcts = MCTS_particles_v2(ctx.graph, ctx.agent_id, 0, 250, num_simulation, ctx.args.max_rollout_steps,
+                                         0.1, 1000000, ctx.agent_params, seed=ctx.args.seed, add_bp=True)
+                return (mcts,)
+
+            def decision(mcts):
+                agent_module.get_plan(mcts, particles, env, 0, ctx.goal_spec, None, None, None,
+                                      num_process=0, verbose=False)
+
+            results['mcts/sim{}/p{}'.format(num_simulation, num_particles)] = timeit(
+                decision, ctx.args.repeat_mcts, setup=setup)
+    return results
+
+
+benchmark_groups = {
+    'transition': bench_transition,
+    'mask_state': bench_mask_state,
+    'check_progress': bench_check_progress,
+    'belief': bench_belief,
+    'heuristics': bench_heuristics,
+    'mcts': bench_mcts,
+}
+
+
+def parse_list(values):
+    return [int(x) for x in values.split(',') if len(x) > 0]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(base_path),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    comparison = {}
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['mean'] / max(baseline[name]['mean'], 1e-12)
+        comparison[name] = {
+            'baseline_mean': baseline[name]['mean'],
+            'mean': res['mean'],
+            'ratio': ratio,
+            'regression': ratio > 1. + tolerance
+        }
+    return comparison
+
+
+def main():
+    args = get_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    groups = [group for group in args.only.split(',') if len(group) > 0]
+    if len(groups) == 0:
+        groups = list(benchmark_groups.keys())
+
+    ctx = Context(args)
+    results, skipped = {}, {}
+    for group in groups:
+        print('Running {}...'.format(group))
+        try:
+            results.update(benchmark_groups[group](ctx))
+        except ImportError as e:
+            # virtualhome is not installed, the groups needing the executor can not run
+            print('Skipping {}: {}'.format(group, e))
+            skipped[group] = str(e)
+        except Exception:
+            traceback.print_exc()
+            skipped[group] = traceback.format_exc(limit=1)
+
+    output = {
+        'meta': {
+            'commit': get_commit(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'args': vars(args),
+        },
+        'results': results,
+        'skipped': skipped
+    }
+
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        output['comparison'] = compare(results, baseline, args.tolerance)
+
+    for name, res in results.items():
+        line = '{:45s} {:10.3f}ms +- {:.3f}'.format(name, res['mean'] * 1000, res['std'] * 1000)
+        if name in output.get('comparison', {}):
+            comp = output['comparison'][name]
+            line += '  x{:.2f} baseline{}'.format(comp['ratio'], '  REGRESSION' if comp['regression'] else '')
+        print(line)
+
+    out_file = args.baseline if args.save_baseline else args.output
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, 'w+') as f:
+        json.dump(output, f, indent=4)
+    print('Results saved in {}'.format(out_file))
+
+    regressions = [name for name, comp in output.get('comparison', {}).items() if comp['regression']]
+    if len(regressions) > 0:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        if args.strict:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
 from arguments import *
 import yaml
 import torch.nn.functional as F
@@ -82,8 +83,7 @@ class AgentTypeDataset(Dataset):
     def __getitem__(self, index):
         if self.overfit:
             index = 0
-        with open(self.pkl_files[index], 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(self.pkl_files[index])
 
 
 
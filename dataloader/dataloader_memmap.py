@@ -0,0 +1,212 @@
+from torch.utils.data import Dataset
+import os
+import json
+import argparse
+import torch
+import yaml
+import numpy as np
+from tqdm import tqdm
+from utils import utils_rl_agent
+
+# Format of the preprocessed datasets. Every split is a folder with an index.json and shards of
+# shard_size episodes. A shard stores every tensor returned by AgentTypeDataset as a .npy array
+# with a leading episode dimension, so the episodes can be read from memory maps without unpickling.
+MEMMAP_VERSION = 1
+
+# Keys of the nested outputs of AgentTypeDataset.__getitem__
+output_names = ['time_graph', 'program_batch', 'label_one_hot', 'length_mask', 'goal', 'label_agent', 'real_label', 'belief_info']
+
+def flatten_item(item):
+    flat = {}
+    for name, value in zip(output_names, item):
+        if isinstance(value, dict):
+            for key, tensor in value.items():
+                flat['{}.{}'.format(name, key)] = tensor
+        else:
+            flat[name] = value
+    out = {}
+    for key, value in flat.items():
+        if torch.is_tensor(value):
+            out[key] = value.numpy()
+        else:
+            out[key] = np.array(value, dtype=np.int64)
+    return out
+
+def memmap_path(path_init):
+    """Folder of the preprocessed version of a dataset file"""
+    return os.path.splitext(path_init)[0] + '_memmap'
+
+def build_memmap(dataset, out_path, shard_size=1000, num_workers=0):
+    """
+    Runs dataset (an AgentTypeDataset) over all the episodes and writes the outputs in out_path.
+    Episodes that fail to load are skipped and recorded in the index.
+    """
+    os.makedirs(out_path, exist_ok=True)
+    indices = list(range(len(dataset)))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+
+    keys = None
+    shards, item_index, failed = [], [], []
+    arrays, curr_shard, pos = None, None, 0
+
+    def close_shard():
+        if arrays is not None:
+            for array in arrays.values():
+                array.flush()
+            shards.append({'path': curr_shard, 'num_items': pos})
+
+    for index, item in tqdm(zip(indices, loader), total=len(indices)):
+        flat = flatten_item(item)
+        # On failure AgentTypeDataset returns the first episode instead
+        if int(flat['belief_info.index']) != index:
+            failed.append(index)
+            continue
+
+        if keys is None:
+            keys = {key: {'shape': list(value.shape), 'dtype': value.dtype.str} for key, value in flat.items()}
+        for key, value in flat.items():
+            if list(value.shape) != keys[key]['shape']:
+                raise Exception('Episode {} has shape {} for {}, expected {}'.format(
+                    index, value.shape, key, keys[key]['shape']))
+
+        if arrays is None or pos == shard_size:
+            close_shard()
+            curr_shard = 'shard_{:05d}'.format(len(shards))
+            os.makedirs(os.path.join(out_path, curr_shard), exist_ok=True)
+            arrays = {
+                key: np.lib.format.open_memmap(
+                    os.path.join(out_path, curr_shard, '{}.npy'.format(key)), mode='w+',
+                    dtype=np.dtype(info['dtype']), shape=tuple([shard_size] + info['shape']))
+                for key, info in keys.items()}
+            pos = 0
+
+        for key, value in flat.items():
+            arrays[key][pos] = value
+        item_index.append(index)
+        pos += 1
+    close_shard()
+
+    index_info = {
+        'version': MEMMAP_VERSION,
+        'max_tsteps': dataset.max_tsteps,
+        'max_nodes': dataset.graph_helper.num_objects,
+        'categorical_belief': bool(dataset.config['model']['categorical_belief']),
+        'get_edges': dataset.get_edges,
+        'keys': keys,
+        'shards': shards,
+        'item_index': item_index,
+        'failed': failed,
+        'pkl_files': dataset.pkl_files,
+        'labels': dataset.labels,
+        'max_labels': dataset.max_labels,
+    }
+    with open(os.path.join(out_path, 'index.json'), 'w+') as f:
+        json.dump(index_info, f)
+    print("Written {} episodes in {} shards, {} failed".format(len(item_index), len(shards), len(failed)))
+    return index_info
+
+
+class MemmapAgentTypeDataset(Dataset):
+    """
+    Same outputs as dataloader_v3.AgentTypeDataset, read from the shards written by build_memmap.
+    Tensors are views of the memory maps, nothing is unpickled or parsed when loading an episode.
+    """
+    def __init__(self, path, args_config, split='train'):
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            self.index_info = json.load(f)
+
+        self.graph_helper = utils_rl_agent.GraphHelper(
+                max_num_objects=args_config['model']['max_nodes'],
+                include_touch=True)
+        self.max_tsteps = args_config['model']['max_tsteps']
+        self.max_actions = args_config['model']['max_actions']
+        self.overfit = args_config['train']['overfit']
+        self.config = args_config
+        self.get_edges = args_config['model']['state_encoder'] == 'GNN'
+
+        assert self.index_info['version'] == MEMMAP_VERSION
+        assert self.index_info['max_tsteps'] == self.max_tsteps, 'Dataset built with max_tsteps {}'.format(self.index_info['max_tsteps'])
+        assert self.index_info['max_nodes'] == self.graph_helper.num_objects, 'Dataset built with max_nodes {}'.format(self.index_info['max_nodes'])
+        assert self.index_info['categorical_belief'] == bool(args_config['model']['categorical_belief'])
+        assert self.index_info['get_edges'] or not self.get_edges, 'Dataset built without edges'
+
+        self.pkl_files = self.index_info['pkl_files']
+        self.labels = self.index_info['labels']
+        self.max_labels = self.index_info['max_labels']
+        self.keys = self.index_info['keys']
+        self.shard_offsets = np.cumsum([0] + [shard['num_items'] for shard in self.index_info['shards']])
+
+        # Opened lazily, so that every dataloader worker maps the files itself
+        self.arrays = None
+
+        print("Loading data...")
+        print("Filename: {}. Episodes: {}. Failed: {}".format(path, len(self), len(self.index_info['failed'])))
+        print("---------------")
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def get_failures(self):
+        return len(self.index_info['failed'])
+
+    def get_lengths(self):
+        """Number of steps of every episode, used by dataloader_packed.LengthBucketSampler"""
+        lengths = []
+        for shard in self.index_info['shards']:
+            length_mask = np.load(os.path.join(self.path, shard['path'], 'length_mask.npy'), mmap_mode='r')
+            lengths += length_mask[:shard['num_items']].sum(-1).astype(np.int64).tolist()
+        return lengths
+
+    def open_shards(self):
+        # copy-on-write, torch does not support read-only arrays, but the files are never modified
+        self.arrays = [
+            {key: np.load(os.path.join(self.path, shard['path'], '{}.npy'.format(key)), mmap_mode='c') for key in self.keys}
+            for shard in self.index_info['shards']]
+
+    def __getitem__(self, index):
+        if self.overfit:
+            index = 0
+        if self.arrays is None:
+            self.open_shards()
+        shard_id = int(np.searchsorted(self.shard_offsets, index, side='right')) - 1
+        shard_index = index - self.shard_offsets[shard_id]
+        shard = self.arrays[shard_id]
+
+        outputs = {name: {} for name in output_names}
+        for key in self.keys:
+            value = torch.from_numpy(shard[key][shard_index, ...])
+            if '.' in key:
+                name, attribute = key.split('.', 1)
+                outputs[name][attribute] = value
+            else:
+                outputs[key] = value
+
+        if not self.get_edges:
+            for attribute in ['edge_tuples', 'edge_classes', 'mask_edge']:
+                outputs['time_graph'].pop(attribute, None)
+        outputs['label_agent'] = int(outputs['label_agent'])
+        outputs['real_label'] = int(outputs['real_label'])
+        return tuple(outputs[name] for name in output_names)
+
+
+if __name__ == '__main__':
+    # Converts a dataset file to the memmap format, e.g.
+    # python dataloader/dataloader_memmap.py --path_init ../dataset/dataset_agent_belief_v2_train.pkl
+    from dataloader.dataloader_v3 import AgentTypeDataset
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_init', type=str, help='Dataset file, as created by create_dataset.py')
+    parser.add_argument('--config', type=str, default='config/agent_pref_v0/config_default_lowlr_belief.yaml')
+    parser.add_argument('--out_path', type=str, default='', help='Defaults to the dataset file ending in _memmap')
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--num_workers', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    # Store the edges, so that the shards work with both state encoders
+    config['model']['state_encoder'] = 'GNN'
+    config['train']['overfit'] = False
+    dataset = AgentTypeDataset(path_init=args.path_init, args_config=config)
+    out_path = args.out_path if len(args.out_path) > 0 else memmap_path(args.path_init)
+    build_memmap(dataset, out_path, shard_size=args.shard_size, num_workers=args.num_workers)
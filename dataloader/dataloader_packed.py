@@ -0,0 +1,114 @@
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+import os
+import json
+import random
+from utils import utils_episode_log
+from tqdm import tqdm
+
+# Batching of episodes of similar length. The datasets pad every episode to max_tsteps and every graph
+# to max_edges, collate_packed cuts the padding that no episode of the batch uses, and
+# LengthBucketSampler builds the batches so that little padding is left.
+
+def lengths_path(path_init):
+    """File with the episode lengths of a dataset file"""
+    return os.path.splitext(path_init)[0] + '_lengths.json'
+
+def get_episode_lengths(dataset):
+    """
+    Number of steps of every episode in dataset. Datasets with a get_lengths method provide them,
+    otherwise the episode pickles are read once and the lengths stored next to the dataset file.
+    """
+    if hasattr(dataset, 'get_lengths'):
+        return dataset.get_lengths()
+
+    cache_file = lengths_path(dataset.path_init)
+    program_lengths = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'r') as f:
+            program_lengths = json.load(f)
+
+    missing = [file_name for file_name in dataset.pkl_files if file_name not in program_lengths]
+    if len(missing) > 0:
+        print("Computing lengths of {} episodes".format(len(missing)))
+        for file_name in tqdm(missing):
+            try:
+                content = utils_episode_log.load_episode(file_name)
+                program_lengths[file_name] = len(content['action'][0])
+            except Exception:
+                program_lengths[file_name] = 0
+        with open(cache_file, 'w+') as f:
+            json.dump(program_lengths, f)
+
+    # The dataset adds a first step and cuts the episodes at max_tsteps
+    return [min(program_lengths[file_name], dataset.max_tsteps - 1) + 1 for file_name in dataset.pkl_files]
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping episodes of similar length. Every epoch the episodes are shuffled and split
+    in chunks of bucket_size batches, each chunk is sorted by length and cut in batches, and the order of
+    the batches is shuffled. With num_replicas > 1, every rank gets the same number of different batches.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        chunk_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), chunk_size):
+            chunk = sorted(indices[start:start + chunk_size], key=lambda index: self.lengths[index])
+            batches += [chunk[it:it + self.batch_size] for it in range(0, len(chunk), self.batch_size)]
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            num_batches = len(batches) // self.num_replicas
+            batches = batches[self.rank::self.num_replicas][:num_batches]
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+def collate_packed(batch):
+    """
+    Collates the outputs of AgentTypeDataset cutting the steps after the longest episode in the batch
+    and the edges after the largest graph. Graph tensors have tsteps steps, the program tsteps+1.
+    Extra outputs (e.g. the episodes of the paired dataset) are collated as they are.
+    """
+    outputs = list(default_collate(batch))
+    time_graph, program_batch, length_mask = outputs[0], outputs[1], outputs[3]
+
+    tsteps = max(int(length_mask.sum(-1).max().item()), 1)
+    time_graph = {key: value[:, :tsteps] for key, value in time_graph.items()}
+    program_batch = {key: value[:, :tsteps+1] for key, value in program_batch.items()}
+
+    if 'mask_edge' in time_graph:
+        num_edges = max(int(time_graph['mask_edge'].sum(-1).max().item()), 1)
+        for key in ['edge_tuples', 'edge_classes', 'mask_edge']:
+            time_graph[key] = time_graph[key][:, :, :num_edges]
+
+    outputs[0], outputs[1], outputs[3] = time_graph, program_batch, length_mask[:, :tsteps]
+    return tuple(outputs)
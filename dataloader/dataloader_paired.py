@@ -5,6 +5,7 @@ import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
 from arguments import *
 import yaml
 import torch.nn.functional as F
@@ -106,8 +107,7 @@ class AgentTypePairedDataset(Dataset):
         return sum(cont)
 
     def obtain_info(self, index):
-        with open(self.pkl_files[index], 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(self.pkl_files[index])
 
 
 
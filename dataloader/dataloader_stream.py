@@ -0,0 +1,187 @@
+from torch.utils.data import IterableDataset, get_worker_info
+import os
+import json
+import random
+import tarfile
+import argparse
+import pickle as pkl
+import multiprocessing as mp
+import torch.distributed as dist
+from utils import utils_episode_log
+from dataloader.dataloader_v3 import AgentTypeDataset
+
+# Sharded datasets are a folder with an index.json and tar archives with the episode pickles.
+# Every member is named {index}/{label}/{episode file name}, index is the position of the episode
+# in the original dataset file.
+
+def shards_path(path_init):
+    """Folder of the sharded version of a dataset file"""
+    return os.path.splitext(path_init)[0] + '_shards'
+
+def write_shards(dataset_dict, out_path, shard_size=500):
+    """Writes the episodes of a {filename: label} dict (as built by create_dataset.build_dataset) in tar shards"""
+    os.makedirs(out_path, exist_ok=True)
+    pkl_files = list(dataset_dict.keys())
+    labels = [dataset_dict[file_name] for file_name in pkl_files]
+    shards = []
+    for start in range(0, len(pkl_files), shard_size):
+        shard_name = 'shard_{:05d}.tar'.format(len(shards))
+        with tarfile.open(os.path.join(out_path, shard_name), 'w') as tar:
+            for index in range(start, min(start + shard_size, len(pkl_files))):
+                member_name = '{}/{}/{}'.format(index, labels[index], os.path.basename(pkl_files[index]))
+                tar.add(pkl_files[index], arcname=member_name)
+        shards.append(shard_name)
+        print('Written {}'.format(shard_name))
+
+    index_info = {
+        'shards': shards,
+        'pkl_files': pkl_files,
+        'labels': labels
+    }
+    with open(os.path.join(out_path, 'index.json'), 'w+') as f:
+        json.dump(index_info, f)
+    return index_info
+
+
+class StreamingAgentTypeDataset(IterableDataset, AgentTypeDataset):
+    """
+    Streaming version of dataloader_v3.AgentTypeDataset. Reads the shards sequentially, splitting them
+    across dataloader workers and distributed ranks (unless split_ranks is False), and shuffles the episodes with a buffer.
+    Corrupt or invalid episodes are skipped.
+    """
+    def __init__(self, path, args_config, split='train', buffer_size=200, shuffle=True, seed=0, split_ranks=True):
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            self.index_info = json.load(f)
+        AgentTypeDataset.__init__(self, path, args_config, split=split,
+                                  agent_files=dict(zip(self.index_info['pkl_files'], self.index_info['labels'])))
+
+        # Members of the shards are named by their index in the original dataset file
+        self.shard_files = self.index_info['pkl_files']
+        self.shards = self.index_info['shards']
+        self.num_episodes = len(self.pkl_files)
+        print("Shards: {}".format(len(self.shards)))
+
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.split_ranks = split_ranks
+        self.epoch = 0
+        # Shared with the workers
+        self.num_failures = mp.Value('i', 0)
+
+    def __len__(self):
+        # Approximate, the episodes failing to load are skipped
+        if self.split_ranks and dist.is_available() and dist.is_initialized():
+            return self.num_episodes // dist.get_world_size()
+        return self.num_episodes
+
+    def set_epoch(self, epoch):
+        """Changes the order of the shards and episodes, call it at the beginning of every epoch"""
+        self.epoch = epoch
+
+    def get_failures(self):
+        return self.num_failures.value
+
+    def failure(self, file_name):
+        print("Skipping", file_name)
+        with self.num_failures.get_lock():
+            self.num_failures.value += 1
+
+    def get_consumer(self):
+        """Index of this (rank, worker) pair, and the total number of them"""
+        rank, world_size = 0, 1
+        if self.split_ranks and dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_id, num_workers = 0, 1
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def get_shards(self):
+        """Shards read by this worker. All the workers shuffle the shards with the same seed"""
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+
+        consumer_id, num_consumers = self.get_consumer()
+        if len(shards) < num_consumers:
+            print("Warning: {} shards for {} workers, some workers will not get episodes".format(len(shards), num_consumers))
+        return shards[consumer_id::num_consumers]
+
+    def read_shard(self, shard_name):
+        """Episodes of a shard, as (content, file_name, label, index)"""
+        try:
+            with tarfile.open(os.path.join(self.path, shard_name), 'r|*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    index, label, file_name = member.name.split('/', 2)
+                    index, label = int(index), int(label)
+                    if label not in self.agents_use:
+                        continue
+                    try:
+                        content = utils_episode_log.loads_episode(tar.extractfile(member).read())
+                    except Exception:
+                        self.failure(member.name)
+                        continue
+                    yield content, self.shard_files[index], label, index
+        except (tarfile.TarError, EOFError, OSError) as e:
+            # Truncated shard, keep the episodes read so far
+            print("Error reading {}: {}".format(shard_name, e))
+            self.failure(shard_name)
+
+    def read_episodes(self):
+        for shard_name in self.get_shards():
+            for content, file_name, label, index in self.read_shard(shard_name):
+                try:
+                    item = self.process_episode(content, file_name, label, index)
+                except Exception:
+                    item = None
+                if item is None:
+                    self.failure(file_name)
+                    continue
+                yield item
+
+    def __iter__(self):
+        consumer_id, num_consumers = self.get_consumer()
+        rng = random.Random((self.seed + self.epoch) * num_consumers + consumer_id)
+        if self.overfit:
+            # Workers without shards have no episode to repeat
+            item = next(self.read_episodes(), None)
+            if item is None:
+                return
+            for _ in range(len(self)):
+                yield item
+            return
+
+        if not self.shuffle:
+            yield from self.read_episodes()
+            return
+
+        buffer = []
+        for item in self.read_episodes():
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            pos = rng.randrange(len(buffer))
+            yield buffer[pos]
+            buffer[pos] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == '__main__':
+    # Converts a dataset file to shards, e.g.
+    # python dataloader/dataloader_stream.py --path_init ../dataset/dataset_agent_belief_v2_train.pkl
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_init', type=str, help='Dataset file, as created by create_dataset.py')
+    parser.add_argument('--out_path', type=str, default='', help='Defaults to the dataset file ending in _shards')
+    parser.add_argument('--shard_size', type=int, default=500)
+    args = parser.parse_args()
+
+    with open(args.path_init, 'rb') as f:
+        dataset_dict = pkl.load(f)
+    out_path = args.out_path if len(args.out_path) > 0 else shards_path(args.path_init)
+    write_shards(dataset_dict, out_path, shard_size=args.shard_size)
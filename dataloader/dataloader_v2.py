@@ -8,6 +8,7 @@ import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
 from arguments import *
 import yaml
 import torch.nn.functional as F
@@ -85,8 +86,7 @@ class AgentTypeDataset(Dataset):
             index = 0
         file_name = self.pkl_files[index]
         seed_number = int(file_name.split('.')[-2]) 
-        with open(file_name, 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(file_name)
 
 
 
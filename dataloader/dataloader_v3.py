@@ -2,10 +2,14 @@ from torch.utils.data import Dataset
 import scipy
 import torch
 import ipdb
+import os
 import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
+from dataloader import feature_cache
+from dataloader.feature_cache import set_item_index
 from arguments import *
 from agents import belief
 import yaml
@@ -38,7 +42,8 @@ def set_init_belief_category(label_agent):
     return init_values_container, init_values_room
 
 class AgentTypeDataset(Dataset):
-    def __init__(self, path_init, args_config, split='train'):
+    def __init__(self, path_init, args_config, split='train', agent_files=None):
+        # agent_files: {filename: label}, read from path_init if not given
         self.path_init = path_init
         self.get_edges = args_config['model']['state_encoder'] == 'GNN'
         self.graph_helper = utils_rl_agent.GraphHelper(
@@ -46,9 +51,9 @@ class AgentTypeDataset(Dataset):
                 include_touch=True)
         # Build the agent types
 
-        with open(self.path_init, 'rb+') as f:
-            agent_files = pkl.load(f)
-            agent_files = agent_files
+        if agent_files is None:
+            with open(self.path_init, 'rb+') as f:
+                agent_files = pkl.load(f)
 
         agent_type_max = max(agent_files.values())
         
@@ -79,6 +84,7 @@ class AgentTypeDataset(Dataset):
 
 
         self.max_labels = agent_type_max+1 
+        self.agents_use = agents_use
         self.labels = labels
         self.pkl_files = pkl_files
         self.overfit = args_config['train']['overfit']
@@ -86,6 +92,7 @@ class AgentTypeDataset(Dataset):
         self.max_actions = args_config['model']['max_actions']
         self.failed_items = mp.Array('i', len(self.pkl_files))
         self.config = args_config
+        self.feature_cache = feature_cache.get_feature_cache(args_config, 'dataloader_v3')
         
         print("Loading data...")
         print("Filename: {}. Episodes: {}. Objects: {}".format(path_init, len(self.pkl_files), len(self.graph_helper.object_dict)))
@@ -107,20 +114,32 @@ class AgentTypeDataset(Dataset):
     def __getitem__(self, index):
         if self.overfit:
             index = 0
+        if self.feature_cache is not None:
+            item = self.feature_cache.get(
+                [self.pkl_files[index]], [self.labels[index], os.path.basename(self.pkl_files[index])], lambda: self.load_item(index))
+        else:
+            item = self.load_item(index)
+        if item is None:
+            return self.failure(index)
+        return set_item_index(item, index)
+
+    def load_item(self, index):
         file_name = self.pkl_files[index]
         #print(file_name)
-        seed_number = int(file_name.split('.')[-2]) 
-        with open(file_name, 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(file_name)
+        return self.process_episode(content, file_name, self.labels[index], index)
 
+    def process_episode(self, content, file_name, label, index):
+        """Builds the inputs of an episode from the content of its pickle. Returns None if the episode is not valid"""
+        seed_number = int(file_name.split('.')[-2]) 
 
         ##############################
         #### Inputs high level policy
         ##############################
         # Encode goal
         if 'action' not in content:
-            print("FAil", self.pkl_files[index]) 
-            return self.failure(index)
+            print("FAil", file_name) 
+            return None
         
 
 
@@ -174,7 +193,7 @@ class AgentTypeDataset(Dataset):
 
 
 
-        label_one_hot = torch.tensor(self.labels[index])
+        label_one_hot = torch.tensor(label)
         # print(content.keys())
         attributes_include = ['class_objects', 'states_objects', 'object_coords', 'mask_object', 'node_ids', 'mask_obs_node']
         if self.get_edges:
@@ -190,21 +209,21 @@ class AgentTypeDataset(Dataset):
         time_graph['mask_close'] = []
         time_graph['mask_goal'] = []
 
-        for it, graph in enumerate(content['graph']):
+        graphs = content['graph'][:self.max_tsteps]
+        graph_infos = self.graph_helper.build_graph_sequence(graphs, content['obs'][:len(graphs)], character_id=1, include_edges=True)
+        for it in range(len(graphs)):
             # if it == len(content['graph']) - 1:
             #     # Skip the last graph
             #     continue
 
-            if it >= self.max_tsteps:
-                break
-            graph_info, _ = self.graph_helper.build_graph(graph, character_id=1, include_edges=True, obs_ids=content['obs'][it])
+            graph_info = {attribute_name: value[it] for attribute_name, value in graph_infos.items()}
             #ipdb.set_trace()
 
             # class names
             for attribute_name in attributes_include:
                 if attribute_name not in graph_info:
-                    print(attribute_name, index, self.pkl_files[index])
-                    return self.failure(index)
+                    print(attribute_name, index, file_name)
+                    return None
                 time_graph[attribute_name].append(torch.tensor(graph_info[attribute_name]))
 
             # ipdb.set_trace()
@@ -259,7 +278,7 @@ class AgentTypeDataset(Dataset):
 
         # The belief is over object instances in the environment
         if not self.config['model']['categorical_belief']:
-            initial_belief_values, initial_belief_room_values = set_init_belief(id2node, self.labels[index], room_ids, container_ids) 
+            initial_belief_values, initial_belief_room_values = set_init_belief(id2node, label, room_ids, container_ids) 
             initial_belief_room[1] = initial_belief_room_values
             initial_belief[1] = initial_belief_values
             #print(initial_belief_room_values)
@@ -296,7 +315,7 @@ class AgentTypeDataset(Dataset):
                 'index': index
             }
         else:
-            initial_belief_values_names, initial_belief_room_values_names = set_init_belief_category(self.labels[index])
+            initial_belief_values_names, initial_belief_room_values_names = set_init_belief_category(label)
             belief_room_names, belief_room_values = initial_belief_room_values_names
             belief_container_names, belief_container_values = initial_belief_values_names
             belief_info = {
@@ -327,7 +346,7 @@ class AgentTypeDataset(Dataset):
             except:
                 #print("Index", index, program, it)
                 #ipdb.set_trace()
-                return self.failure(index)
+                return None
 
         program_batch['action'].append(self.max_actions - 1)
         program_batch['obj1'].append(-1)
@@ -375,8 +394,8 @@ class AgentTypeDataset(Dataset):
 
 
 
-        label_agent = seed_number + self.labels[index] * 5
-        real_label = self.labels[index]
+        label_agent = seed_number + label * 5
+        real_label = label
         # ipdb.set_trace()
         return time_graph, program_batch, label_one_hot, length_mask, goal, label_agent, real_label, belief_info
 
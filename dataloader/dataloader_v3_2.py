@@ -2,10 +2,14 @@ from torch.utils.data import Dataset
 import scipy
 import torch
 import ipdb
+import os
 import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
+from dataloader import feature_cache
+from dataloader.feature_cache import set_item_index
 from arguments import *
 from agents import belief
 import yaml
@@ -73,6 +77,7 @@ class AgentTypeDataset(Dataset):
         self.max_tsteps = args_config['model']['max_tsteps']
         self.max_actions = args_config['model']['max_actions']
         self.failed_items = mp.Array('i', len(self.pkl_files))
+        self.feature_cache = feature_cache.get_feature_cache(args_config, 'dataloader_v3_2')
         
         print("Loading data...")
         print("Filename: {}. Episodes: {}. Objects: {}".format(path_init, len(self.pkl_files), len(self.graph_helper.object_dict)))
@@ -94,11 +99,20 @@ class AgentTypeDataset(Dataset):
     def __getitem__(self, index):
         if self.overfit:
             index = 0
+        if self.feature_cache is not None:
+            item = self.feature_cache.get(
+                [self.pkl_files[index]], [self.labels[index], os.path.basename(self.pkl_files[index])], lambda: self.load_item(index))
+        else:
+            item = self.load_item(index)
+        if item is None:
+            return self.failure(index)
+        return set_item_index(item, index)
+
+    def load_item(self, index):
         file_name = self.pkl_files[index]
         #print(file_name)
         seed_number = int(file_name.split('.')[-2]) 
-        with open(file_name, 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(file_name)
 
 
         ##############################
@@ -107,7 +121,7 @@ class AgentTypeDataset(Dataset):
         # Encode goal
         if 'action' not in content:
             print("FAil", self.pkl_files[index]) 
-            return self.failure(index)
+            return None
         
 
 
@@ -189,7 +203,7 @@ class AgentTypeDataset(Dataset):
             for attribute_name in attributes_include:
                 if attribute_name not in graph_info:
                     print(attribute_name, index, self.pkl_files[index])
-                    return self.failure(index)
+                    return None
                 time_graph[attribute_name].append(torch.tensor(graph_info[attribute_name]))
 
             # ipdb.set_trace()
@@ -299,7 +313,7 @@ class AgentTypeDataset(Dataset):
             except:
                 #print("Index", index, program, it)
                 #ipdb.set_trace()
-                return self.failure(index)
+                return None
 
         program_batch['action'].append(self.max_actions - 1)
         program_batch['obj1'].append(-1)
@@ -2,10 +2,15 @@ from torch.utils.data import Dataset
 import scipy
 import torch
 import ipdb
+import os
+import hashlib
 import glob
 from tqdm import tqdm
 import pickle as pkl
 from utils import utils_rl_agent
+from utils import utils_episode_log
+from dataloader import feature_cache
+from dataloader.feature_cache import set_item_index
 from arguments import *
 from agents import belief
 import yaml
@@ -26,6 +31,10 @@ def set_init_belief(id2node, label_agent, room_ids, container_ids):
     return init_values_container, init_values_room
 
 
+def episode_id(file_name):
+    """Integer id of an episode file, the same across dataset files"""
+    return int(hashlib.sha1(os.path.abspath(file_name).encode()).hexdigest()[:15], 16)
+
 class AgentTypeDataset(Dataset):
     def __init__(self, path_init, args_config, split='train'):
         self.path_init = path_init
@@ -78,6 +87,9 @@ class AgentTypeDataset(Dataset):
         self.max_tsteps = args_config['model']['max_tsteps']
         self.max_actions = args_config['model']['max_actions']
         self.failed_items = mp.Array('i', len(self.pkl_files))
+        self.feature_cache = feature_cache.get_feature_cache(args_config, 'dataloader_v3_paired')
+        # Ids of the context episodes, used to cache their features in ModelAggregate
+        self.context_ids = [[episode_id(file_name) for file_name in files[1:]] for files in other_files]
         
         print("Loading data...")
         print("Filename: {}. Episodes: {}. Objects: {}".format(path_init, len(self.pkl_files), len(self.graph_helper.object_dict)))
@@ -152,14 +164,14 @@ class AgentTypeDataset(Dataset):
         time_graph['mask_close'] = []
         time_graph['mask_goal'] = []
 
-        for it, graph in enumerate(content['graph']):
+        graphs = content['graph'][:self.max_tsteps]
+        graph_infos = self.graph_helper.build_graph_sequence(graphs, content['obs'][:len(graphs)], character_id=1, include_edges=True)
+        for it, graph in enumerate(graphs):
             # if it == len(content['graph']) - 1:
             #     # Skip the last graph
             #     continue
 
-            if it >= self.max_tsteps:
-                break
-            graph_info, _ = self.graph_helper.build_graph(graph, character_id=1, include_edges=True, obs_ids=content['obs'][it])
+            graph_info = {attribute_name: value[it] for attribute_name, value in graph_infos.items()}
             prev_nodes = [node['id'] for node in graph['nodes']]
             
             #ipdb.set_trace()
@@ -276,18 +288,29 @@ class AgentTypeDataset(Dataset):
     def __getitem__(self, index):
         if self.overfit:
             index = 0
+        if self.feature_cache is not None:
+            item = self.feature_cache.get(
+                self.other_files[index], [self.labels[index], os.path.basename(self.pkl_files[index])], lambda: self.load_item(index))
+        else:
+            item = self.load_item(index)
+        if item is None:
+            return self.failure(index)
+        item = set_item_index(item, index)
+        item[8]['episode_ids'] = torch.tensor(self.context_ids[index])
+        item[8]['label'] = torch.tensor(self.labels[index])
+        return item
+
+    def load_item(self, index):
         file_name = self.pkl_files[index]
         file_names = self.other_files[index] 
         # print(len(file_names))
         #print(file_name)
         seed_number = int(file_name.split('.')[-2]) 
-        with open(file_names[0], 'rb') as f:
-            content = pkl.load(f)
+        content = utils_episode_log.load_episode(file_names[0])
 
         other_content = []
         for it in range(1, len(file_names)):
-            with open(file_names[it], 'rb') as f:
-                other_content.append(pkl.load(f))
+            other_content.append(utils_episode_log.load_episode(file_names[it]))
 
         # print("Loaded")
         ##############################
@@ -296,7 +319,7 @@ class AgentTypeDataset(Dataset):
         # Encode goal
         if 'action' not in content:
             print("FAil", self.pkl_files[index]) 
-            return self.failure(index)
+            return None
         
 
         # try:
@@ -308,7 +331,7 @@ class AgentTypeDataset(Dataset):
         # print("CONTE")
         except:
 
-            return self.failure(index)
+            return None
         other_data = {
             'time_graph': [],
             'program_batch': [],
@@ -322,7 +345,7 @@ class AgentTypeDataset(Dataset):
                 program_batch_o, length_mask_o, _ = self.get_program_info(ct, graph_info_o)
             except:
 
-                return self.failure(index)
+                return None
             other_data['time_graph'].append(time_graph_o)
             other_data['program_batch'].append(program_batch_o)
             other_data['length_mask'].append(length_mask_o)
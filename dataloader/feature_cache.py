@@ -0,0 +1,116 @@
+import os
+import json
+import uuid
+import hashlib
+import torch
+
+# Increase when the features computed by the dataloaders change, so that old entries are not used
+CACHE_VERSION = 1
+
+# Config fields changing the features of an episode
+config_fields = [
+    ('model', 'max_nodes'),
+    ('model', 'max_tsteps'),
+    ('model', 'max_actions'),
+    ('model', 'state_encoder'),
+    ('model', 'categorical_belief'),
+]
+
+def get_feature_cache(args_config, namespace):
+    """FeatureCache of a dataloader, or None if data.feature_cache is not set in the config"""
+    if 'data' not in args_config or 'feature_cache' not in args_config['data']:
+        return None
+    cache_dir = args_config['data']['feature_cache']
+    if cache_dir is None or len(cache_dir) == 0:
+        return None
+    return FeatureCache(cache_dir, args_config, namespace)
+
+
+class FeatureCache():
+    """
+    On disk cache of the items built by the dataloaders. Entries are addressed by the hash of the content
+    of the episode files, the config fields that change the features and a dataloader specific key.
+    They are written on the first access. Every entry is written to a temporary file and renamed,
+    so that workers writing the same entry at the same time never leave a partial file.
+    """
+    def __init__(self, cache_dir, args_config, namespace):
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        config_values = {
+            '{}.{}'.format(*field): args_config[field[0]].get(field[1], None) for field in config_fields}
+        self.config_key = json.dumps({'version': CACHE_VERSION, 'namespace': namespace, 'config': config_values}, sort_keys=True)
+        self.file_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_dir, 'file_hashes'), exist_ok=True)
+
+    def file_hash(self, file_name):
+        """sha1 of the file content. Stored by path, and recomputed when the size or mtime of the file change"""
+        stat = os.stat(file_name)
+        stat_key = (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        if stat_key in self.file_hashes:
+            return self.file_hashes[stat_key]
+
+        path_key = hashlib.sha1(stat_key[0].encode()).hexdigest()
+        hash_file = os.path.join(self.cache_dir, 'file_hashes', '{}.json'.format(path_key))
+        try:
+            with open(hash_file, 'r') as f:
+                info = json.load(f)
+            if info['size'] == stat.st_size and info['mtime_ns'] == stat.st_mtime_ns:
+                self.file_hashes[stat_key] = info['hash']
+                return info['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        sha = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        file_hash = sha.hexdigest()
+        self.write_atomic(hash_file, lambda f: f.write(json.dumps(
+            {'path': stat_key[0], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash}).encode()))
+        self.file_hashes[stat_key] = file_hash
+        return file_hash
+
+    def entry_path(self, file_names, extra_key):
+        key = json.dumps([self.config_key, [self.file_hash(file_name) for file_name in file_names], extra_key])
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, self.namespace, key[:2], '{}.pt'.format(key))
+
+    def write_atomic(self, path, write_fn):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.tmp.{}'.format(path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                write_fn(f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, file_names, extra_key, compute_fn):
+        """
+        Item built from file_names, computing it with compute_fn if it is not in the cache.
+        extra_key has the arguments of compute_fn other than the file contents (e.g. the agent label).
+        compute_fn may return None for invalid episodes, which is cached as well.
+        """
+        path = self.entry_path(file_names, extra_key)
+        if os.path.isfile(path):
+            try:
+                item = torch.load(path)
+                self.hits += 1
+                return item['item']
+            except Exception:
+                # Unreadable entry, computed again
+                pass
+
+        self.misses += 1
+        item = compute_fn()
+        self.write_atomic(path, lambda f: torch.save({'item': item}, f))
+        return item
+
+
+def set_item_index(item, index):
+    """Cached items can come from another dataset file, set the index in belief_info to the one of the dataset"""
+    item[7]['index'] = torch.tensor(index).float()
+    return item
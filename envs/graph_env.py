@@ -18,6 +18,10 @@ from evolving_graph.scripts import read_script_from_string
 from evolving_graph.environment import EnvironmentGraph
 from evolving_graph.environment import EnvironmentState as EnvironmentStateBase
 
+sys.path.append(f'{curr_dir}/..')
+from utils.utils_graph import CompactGraph
+from utils import utils_graph
+
 def init_from_state(env_state: EnvironmentStateBase, touched_objs):
    env_state_new =  EnvironmentState(env_state._graph, env_state._name_equivalence, env_state.instance_selection, touched_objs)
    env_state_new.executor_data = env_state.executor_data
@@ -27,29 +31,221 @@ def init_from_state(env_state: EnvironmentStateBase, touched_objs):
    env_state_new._new_edges_from = env_state._new_edges_from
    return env_state_new
 
+def state_snapshot(env_state: EnvironmentStateBase):
+    """
+    Copy of the changes of env_state over its base graph. Small, since it only contains the
+    changes made by the actions, used to find the effect of a transition with get_state_delta.
+    """
+    return {
+        'new_edges': {key: set(value) for key, value in env_state._new_edges_from.items()},
+        'removed_edges': {key: set(value) for key, value in env_state._removed_edges_from.items()},
+        'node_states': {node_id: set(node.to_dict()['states']) for node_id, node in env_state._new_nodes.items()},
+        'touched': set(env_state.touched_objs)
+    }
+
+def get_state_delta(snapshot, env_state: EnvironmentStateBase):
+    """
+    Edges added and removed, and nodes changed, from a state_snapshot to env_state.
+    Edges are returned as (from_id, relation_type, to_id), nodes in dict format.
+    """
+    added_edges, removed_edges = [], []
+    keys = set(snapshot['new_edges']) | set(snapshot['removed_edges']) | \
+           set(env_state._new_edges_from) | set(env_state._removed_edges_from)
+    for from_id, relation in keys:
+        prev_ids = set(env_state._graph.get_node_ids_from(from_id, relation))
+        prev_ids -= snapshot['removed_edges'].get((from_id, relation), set())
+        prev_ids |= snapshot['new_edges'].get((from_id, relation), set())
+        curr_ids = set(env_state.get_node_ids_from(from_id, relation))
+        added_edges += [(from_id, relation.name, to_id) for to_id in curr_ids - prev_ids]
+        removed_edges += [(from_id, relation.name, to_id) for to_id in prev_ids - curr_ids]
+
+    touched = set(env_state.touched_objs)
+    node_ids = set(snapshot['node_states']) | set(env_state._new_nodes) | (touched ^ snapshot['touched'])
+    changed_nodes = []
+    for node_id in node_ids:
+        dict_node = env_state.get_node(node_id).to_dict()
+        if node_id in snapshot['node_states']:
+            prev_states = set(snapshot['node_states'][node_id])
+        else:
+            prev_states = set(env_state._graph.get_node(node_id).to_dict()['states'])
+        if node_id in touched:
+            dict_node['states'].append('touched')
+        if node_id in snapshot['touched']:
+            prev_states.add('touched')
+        if set(dict_node['states']) != prev_states:
+            changed_nodes.append(dict_node)
+    return added_edges, removed_edges, changed_nodes
+
 class EnvironmentState(EnvironmentStateBase):
+    # Attributes that are never modified by the actions, shared between copies of a state
+    shared_attributes = ['_graph', '_name_equivalence']
+
     def __init__(self, graph: EnvironmentGraph, name_equivalence, instance_selection: bool=False, touched_objs=[]):
         self.touched_objs = touched_objs
         super(EnvironmentState, self).__init__(graph, name_equivalence, instance_selection)
 
+    def __deepcopy__(self, memo):
+        """
+        Copy on write. The actions only modify the changes a state keeps over its base graph
+        (new/removed edges, new nodes), so the base graph is shared and only the changes are copied.
+        Copying a state costs time and memory proportional to the effect of the actions, not to the house size.
+        """
+        new_state = EnvironmentState.__new__(EnvironmentState)
+        memo[id(self)] = new_state
+        for attr_name, attr_value in self.__dict__.items():
+            if attr_name in self.shared_attributes:
+                setattr(new_state, attr_name, attr_value)
+            else:
+                setattr(new_state, attr_name, copy.deepcopy(attr_value, memo))
+        return new_state
+
     def to_dict(self):
         edges = []
         from_pairs = self._new_edges_from.keys() | self._graph.get_from_pairs()
         for from_n, r in from_pairs:
             for to_n in self.get_node_ids_from(from_n, r):
                 edges.append({'from_id': from_n, 'relation_type': r.name, 'to_id': to_n})
+        return {'nodes': self._dict_nodes(), 'edges': edges}
+
+    def to_compact(self):
+        # Same as to_dict, without building a dict per edge
+        edge_tuples = []
+        from_pairs = self._new_edges_from.keys() | self._graph.get_from_pairs()
+        for from_n, r in from_pairs:
+            for to_n in self.get_node_ids_from(from_n, r):
+                edge_tuples.append((from_n, r.name, to_n))
+        return CompactGraph.from_edge_tuples(self._dict_nodes(), edge_tuples)
+
+    def _dict_nodes(self):
         nodes = []
         for node in self.get_nodes():
             dict_node = node.to_dict()
             if dict_node['id'] in self.touched_objs:
                 dict_node['states'].append('touched')
             nodes.append(dict_node)
-        return {'nodes': nodes, 'edges': edges}
+        return nodes
 
     def touch_object(self, obj_id):
         self.touched_objs.append(obj_id)
 
 
+class VisibilityEngine():
+    """
+    Objects visible by a character, as in VhGraphEnv._mask_state: the rooms, the grabbed objects,
+    and the objects in the character room that are not inside something closed.
+    Keeps the containment forest and the open containers, and caches the visible objects of every room,
+    so a query costs time proportional to the room contents. apply_delta updates the forest with the
+    changes of a transition, invalidating only the rooms that changed.
+    """
+    def __init__(self, graph, rooms_ids):
+        self.rooms_ids = list(rooms_ids)
+        self.rooms_set = set(rooms_ids)
+        # INSIDE edges in both directions, in edge order. As in _mask_state, the last one is the container
+        self.parents, self.children = {}, {}
+        self.holds = {}
+        self.open_ids = set([node['id'] for node in graph['nodes'] if 'OPEN' in node['states']])
+        self.room_visible = {}
+        for from_id, rel, to_id in utils_graph.get_edges(graph):
+            self._add_edge(from_id, rel, to_id)
+        self.set_graph(graph)
+
+    def set_graph(self, graph):
+        """Graph the visibility corresponds to, used to return the observed edges"""
+        self.graph = graph
+        self._edges_from = None
+
+    def _add_edge(self, from_id, rel, to_id):
+        if rel == 'INSIDE':
+            self.parents.setdefault(from_id, []).append(to_id)
+            self.children.setdefault(to_id, []).append(from_id)
+        elif 'HOLDS' in rel:
+            self.holds.setdefault(from_id, []).append(to_id)
+
+    def _remove_edge(self, from_id, rel, to_id):
+        if rel == 'INSIDE':
+            self.parents[from_id].remove(to_id)
+            self.children[to_id].remove(from_id)
+        elif 'HOLDS' in rel:
+            self.holds[from_id].remove(to_id)
+
+    def room_of(self, node_id):
+        visited = set()
+        while node_id not in self.rooms_set:
+            if node_id in visited or len(self.parents.get(node_id, [])) == 0:
+                return None
+            visited.add(node_id)
+            node_id = self.parents[node_id][-1]
+        return node_id
+
+    def apply_delta(self, added_edges, removed_edges, changed_nodes, graph=None):
+        """Update with the output of get_state_delta. graph is the graph after the changes, if available"""
+        inside_edges = [edge for edge in added_edges + removed_edges if edge[1] == 'INSIDE']
+        # Rooms affected, before and after the change
+        rooms_changed = set([self.room_of(node_id) for edge in inside_edges for node_id in (edge[0], edge[2])])
+        for edge in removed_edges:
+            self._remove_edge(*edge)
+        for edge in added_edges:
+            self._add_edge(*edge)
+        rooms_changed |= set([self.room_of(node_id) for edge in inside_edges for node_id in (edge[0], edge[2])])
+
+        for node in changed_nodes:
+            is_open = 'OPEN' in node['states']
+            if is_open != (node['id'] in self.open_ids):
+                if is_open:
+                    self.open_ids.add(node['id'])
+                else:
+                    self.open_ids.remove(node['id'])
+                rooms_changed.add(self.room_of(node['id']))
+
+        for room_id in rooms_changed:
+            self.room_visible.pop(room_id, None)
+        self.set_graph(graph)
+
+    def _hidden(self, node_id):
+        container = self.parents[node_id][-1]
+        return container not in self.rooms_set and container not in self.open_ids
+
+    def _compute_room_visible(self, room_id):
+        object_in_room_ids = list(self.children.get(room_id, []))
+        curr_objects = list(object_in_room_ids)
+        while len(curr_objects) > 0:
+            objects_inside = []
+            for curr_obj_id in curr_objects:
+                objects_inside += self.children.get(curr_obj_id, [])
+            object_in_room_ids += objects_inside
+            curr_objects = objects_inside
+        return [object_id for object_id in object_in_room_ids if not self._hidden(object_id)]
+
+    def visible_ids(self, character_id):
+        room_id = self.parents[character_id][-1]
+        if room_id not in self.room_visible:
+            self.room_visible[room_id] = self._compute_room_visible(room_id)
+        return self.room_visible[room_id] + self.rooms_ids + self.holds.get(character_id, [])
+
+    def visible_mask(self, character_id, node_ids):
+        """Boolean array, whether each of node_ids is visible"""
+        return np.isin(np.asarray(node_ids), self.visible_ids(character_id))
+
+    def mask_state(self, graph, character_id):
+        observable_object_ids = self.visible_ids(character_id)
+        observable_set = set(observable_object_ids)
+        id2node = utils_graph.get_id2node(graph)
+        if graph is self.graph:
+            # Only visit the edges of the visible objects
+            if self._edges_from is None:
+                self._edges_from = {}
+                for it, edge in enumerate(graph['edges']):
+                    self._edges_from.setdefault(edge['from_id'], []).append(it)
+            edge_index = sorted(set([it for node_id in observable_set for it in self._edges_from.get(node_id, [])]))
+            edges = [graph['edges'][it] for it in edge_index if graph['edges'][it]['to_id'] in observable_set]
+        else:
+            edges = [edge for edge in graph['edges'] if edge['from_id'] in observable_set and edge['to_id'] in observable_set]
+        return {
+            "edges": edges,
+            "nodes": [id2node[id_node] for id_node in observable_object_ids]
+        }
+
+
 class VhGraphEnv():
 
     metadata = {'render.modes': ['human']}
@@ -132,6 +328,8 @@ class VhGraphEnv():
         self.rooms_ids = None
         self.observable_object_ids_n = [None for i in range(self.n_chars)]
         self.pomdp = False
+        # VisibilityEngine of self.state, updated by step
+        self.visibility = None
         self.executor_n = [ScriptExecutor(EnvironmentGraph(self.state), self.name_equivalence, i) for i in range(self.n_chars)]
     
 
@@ -179,6 +377,7 @@ class VhGraphEnv():
         # TODO: Detect action conflicts
         # convert action to a single action script
         objs_in_use = []
+        snapshot = state_snapshot(self.vh_state)
         for i in range(self.n_chars):
             if i not in scripts:
                 continue
@@ -187,7 +386,10 @@ class VhGraphEnv():
             is_executable, msg = self._is_action_executable(script, i, objs_in_use)
             if (is_executable):
                 objs_in_use += script.obtain_objects()
-                succeed, self.vh_state = self.executor_n[i].execute_one_step(script, self.vh_state)
+                # The executor returns a base EnvironmentState, the touched objects are kept as in transition
+                touched_objs = list(self.vh_state.touched_objs)
+                succeed, next_vh_state = self.executor_n[i].execute_one_step(script, self.vh_state)
+                self.vh_state = init_from_state(next_vh_state, touched_objs)
                 info_n['n'].append({
                     "succeed": succeed, 
                     "error_message": {i: self.executor_n[i].info.get_error_string() for i in range(self.n_chars)}
@@ -200,6 +402,8 @@ class VhGraphEnv():
 
         state = self.vh_state.to_dict()
         self.state = state
+        if self.visibility is not None:
+            self.visibility.apply_delta(*get_state_delta(snapshot, self.vh_state), graph=state)
         
         for i in range(self.n_chars):
             observable_state = self._mask_state(state, i) if self.pomdp else state
@@ -242,7 +446,8 @@ class VhGraphEnv():
         for i in range(self.n_chars):
             script_string = scripts.get(i, "")
             script = read_script_from_string(script_string)
-            touched_objs = vh_state.touched_objs
+            # Copy, so that touching an object does not modify the previous state
+            touched_objs = list(vh_state.touched_objs)
             if '[touch]' in script_string:
 
                 succeed, next_vh_state = self.executor_n[i].execute_one_step(script, vh_state)
@@ -315,11 +520,13 @@ class VhGraphEnv():
         self.rooms_ids = [n["id"] for n in self.rooms]
         self.state = state
         self.vh_state = self.get_vh_state(state)
+        self.visibility = VisibilityEngine(state, self.rooms_ids)
 
         ############ Reward ############
         observable_state_n = [self._mask_state(state, i) if self.pomdp else state for i in range(self.n_chars)]
         self.observable_state_n = observable_state_n
         self.observable_object_ids_n = [[node['id'] for node in obs_state['nodes']] for obs_state in observable_state_n]
+        self.prev_progress_n = [0 for i in range(self.n_chars)]
 
 
 
@@ -453,8 +660,28 @@ class VhGraphEnv():
         string_instr = '[{}] {}'.format(action, obj_list)
         return string_instr
 
+    def get_visibility(self, state):
+        """
+        VisibilityEngine of a graph. The engine of the environment state is kept up to date by step,
+        other graphs get a new engine, since they may have been modified since the last call.
+        """
+        if self.visibility is not None and state is self.state:
+            return self.visibility
+        return VisibilityEngine(state, self.rooms_ids)
+
+    def get_visible_mask(self, node_ids, char_index=0, graph_env=None):
+        """Boolean array, whether each of node_ids is observed by the character"""
+        state = self.state if graph_env is None else graph_env
+        return self.get_visibility(state).visible_mask(self.character_n[char_index]['id'], node_ids)
+
     def _mask_state(self, state, char_index):
         # Assumption: inside is not transitive. For every object, only the closest inside relation is recorded
+        if isinstance(state, CompactGraph):
+            return self._mask_state_compact(state, char_index)
+        return self.get_visibility(state).mask_state(state, self.character_n[char_index]['id'])
+
+    def _mask_state_full(self, state, char_index):
+        # Version rebuilding the containment from all the edges
         character = self.character_n[char_index]
         # find character
         character_id = character["id"]
@@ -509,7 +736,41 @@ class VhGraphEnv():
         }
 
         return partilly_observable_state
-        
+
+    def _mask_state_compact(self, graph, char_index):
+        # Same as _mask_state, with the containment and the observed edges computed on the arrays of the graph
+        character_id = self.character_n[char_index]["id"]
+        parents = graph.parent_indices('INSIDE')
+        grabbed_ids = graph.get_node_ids_from(character_id, lambda rel: 'HOLDS' in rel)
+
+        room_index = parents[graph.id2index[character_id]]
+        object_in_room = [graph.children_indices([room_index], 'INSIDE')]
+        while len(object_in_room[-1]) > 0:
+            object_in_room.append(graph.children_indices(object_in_room[-1], 'INSIDE'))
+        object_in_room = np.concatenate(object_in_room)
+
+        room_indices = [graph.id2index[room_id] for room_id in self.rooms_ids]
+        room_mask = np.zeros(len(graph.node_ids), dtype=bool)
+        room_mask[room_indices] = True
+        containers = parents[object_in_room]
+        visible = room_mask[containers] | graph.state_mask('OPEN')[containers]
+        observable_indices = object_in_room[visible].tolist() + room_indices
+        observable_indices += [graph.id2index[node_id] for node_id in grabbed_ids]
+
+        observable_mask = np.zeros(len(graph.node_ids), dtype=bool)
+        observable_mask[observable_indices] = True
+        edge_index = np.nonzero(observable_mask[graph.edge_from] & observable_mask[graph.edge_to])[0]
+        edges = [{'from_id': from_id, 'relation_type': graph.relations[rel], 'to_id': to_id}
+                 for from_id, rel, to_id in zip(graph.node_ids[graph.edge_from[edge_index]].tolist(),
+                                                graph.edge_rel[edge_index].tolist(),
+                                                graph.node_ids[graph.edge_to[edge_index]].tolist())]
+
+        partilly_observable_state = {
+            "edges": edges,
+            "nodes": [graph.node_at(index) for index in observable_indices]
+        }
+        return partilly_observable_state
+
     def _find_node_by_id(self, state, id):
         for node in state["nodes"]:
             if node["id"] == id:
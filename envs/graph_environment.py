@@ -0,0 +1,267 @@
+from .base_environment import BaseEnvironment
+from .graph_env import VhGraphEnv
+from utils import utils_environment as utils
+
+import random
+import copy
+
+# Headless version of UnityEnvironment, running the episodes on the graph simulator of envs/graph_env.py.
+# It has the same interface (reset(task_id), step, get_observation(s), reward, get_goal, touched objects),
+# so it can replace UnityEnvironment in the env_fn of ArenaMP to generate and evaluate the episodes of the
+# planners without the Unity executable. The actions change the graph as in Unity, but nothing moves in 3D:
+# the bounding box of a character is placed at the last object it walked to. There are no images.
+#
+# python testing_agents/test_single_agent_v2.py --simulator-type python
+
+character_size = [0.5, 1.8, 0.5]
+
+class GraphEnvironment(BaseEnvironment):
+
+
+    def __init__(self,
+                 num_agents=2,
+                 max_episode_length=200,
+                 env_task_set=None,
+                 observation_types=None,
+                 agent_goals=None,
+                 use_editor=False,
+                 base_port=8080,
+                 port_id=0,
+                 executable_args={},
+                 recording_options={'recording': False},
+                 seed=123):
+        # use_editor, executable_args and recording_options are only there to be built as UnityEnvironment
+
+        self.seed = seed
+        self.rnd = random.Random(seed)
+        self.num_agents = num_agents
+        self.max_episode_length = max_episode_length
+        self.env_task_set = env_task_set
+        self.port_number = base_port + port_id
+        self.recording_options = recording_options
+
+        if observation_types is not None:
+            self.observation_types = observation_types
+        else:
+            self.observation_types = ['partial' for _ in range(num_agents)]
+
+        if agent_goals is not None:
+            self.agent_goals = agent_goals
+        else:
+            self.agent_goals = ['full' for _ in range(num_agents)]
+
+        self.task_goal, self.goal_spec = {0: {}, 1: {}}, {0: {}, 1: {}}
+        self.agent_object_touched = []
+        self.env_id = None
+        self.steps = 0
+        self.prev_reward = 0.
+
+        self.graph = None
+        self.clean_graph = None
+        self.changed_graph = True
+        self.full_graph = None
+        self.character_center = {}
+
+        self.env = VhGraphEnv(n_chars=self.num_agents)
+
+    def close(self):
+        pass
+
+    def get_graph(self):
+        if self.changed_graph:
+            graph = self.env.vh_state.to_dict()
+            # As in Unity, the characters are the first nodes
+            graph['nodes'] = [node for node in graph['nodes'] if node['category'] == 'Characters'] + \
+                             [node for node in graph['nodes'] if node['category'] != 'Characters']
+            for node in graph['nodes']:
+                if node['id'] in self.character_center:
+                    node['bounding_box'] = {'center': list(self.character_center[node['id']]), 'size': list(character_size)}
+                if node['id'] in self.agent_object_touched and 'TOUCHED' not in [st.upper() for st in node['states']]:
+                    node['states'].append('TOUCHED')
+            self.graph = graph
+            self.clean_graph = None
+            self.changed_graph = False
+        return self.graph
+
+    def get_clean_graph(self):
+        """Graph as observed by the agents, without the house objects and with non transitive inside edges"""
+        graph = self.get_graph()
+        if self.clean_graph is None:
+            self.clean_graph = utils.inside_not_trans(utils.clean_house_obj(graph))
+            self.full_graph = copy.deepcopy(self.clean_graph)
+        return self.clean_graph
+
+    def reward(self):
+        reward = 0.
+        done = True
+        satisfied, unsatisfied = utils.check_progress(self.get_graph(), self.goal_spec[0])
+        for key, value in satisfied.items():
+            preds_needed, mandatory, reward_per_pred = self.goal_spec[0][key]
+            # How many predicates achieved
+            value_pred = min(len(value), preds_needed)
+            reward += value_pred * reward_per_pred
+
+            if mandatory and unsatisfied[key] > 0:
+                done = False
+
+        self.prev_reward = reward
+        return reward, done, {'satisfied_goals': satisfied}
+
+    def get_goal(self, task_spec, agent_goal):
+        if agent_goal == 'full':
+            res_dict = {goal_k: [goal_c, True, 2] for goal_k, goal_c in task_spec.items()}
+            return res_dict
+        elif agent_goal == 'grab':
+            candidates = [x.split('_')[1] for x,y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']]
+            object_grab = self.rnd.choice(candidates)
+            return {'holds_'+object_grab+'_'+'1': [1, True, 10], 'close_'+object_grab+'_'+'1': [1, False, 0.1]}
+        elif agent_goal == 'put':
+            pred = self.rnd.choice([x for x, y in task_spec.items() if y > 0 and x.split('_')[0] in ['on', 'inside']])
+            object_grab = pred.split('_')[1]
+            return {
+                pred: [1, True, 60],
+                'holds_' + object_grab + '_' + '1': [1, False, 2],
+                'close_' + object_grab + '_' + '1': [1, False, 0.05]
+
+            }
+        else:
+            raise NotImplementedError
+
+    def add_characters(self, graph, rooms):
+        """Adds the characters (ids 1, 2...) to the graph, in the center of their initial room"""
+        char_ids = [node['id'] for node in graph['nodes'] if node['category'] == 'Characters']
+        nodes = [node for node in graph['nodes'] if node['id'] not in char_ids]
+        edges = [edge for edge in graph['edges'] if edge['from_id'] not in char_ids and edge['to_id'] not in char_ids]
+
+        char_nodes, char_edges = [], []
+        self.character_center = {}
+        for i in range(self.num_agents):
+            room_node = [node for node in nodes if node['class_name'] == rooms[i]][0]
+            if room_node.get('bounding_box') is not None:
+                self.character_center[i+1] = list(room_node['bounding_box']['center'])
+            char_nodes.append({
+                'id': i+1,
+                'class_name': 'character',
+                'category': 'Characters',
+                'properties': [],
+                'states': [],
+                'prefab_name': None,
+                'bounding_box': None
+            })
+            char_edges.append({'from_id': i+1, 'relation_type': 'INSIDE', 'to_id': room_node['id']})
+
+        # As in Unity, the characters are the first nodes
+        return {'nodes': char_nodes + nodes, 'edges': char_edges + edges}
+
+    def reset(self, environment_graph=None, task_id=None):
+        if task_id is None:
+            task_id = self.rnd.choice(list(range(len(self.env_task_set))))
+        env_task = self.env_task_set[task_id]
+
+        self.agent_object_touched = []
+
+        self.task_id = env_task['task_id']
+        self.init_graph = copy.deepcopy(env_task['init_graph'])
+        self.init_rooms = env_task['init_rooms']
+        self.task_goal = env_task['task_goal']
+        self.task_name = env_task['task_name']
+        self.env_id = env_task['env_id']
+        print("Resetting... Envid: {}. Taskid: {}. Index: {}".format(self.env_id, self.task_id, task_id))
+
+        self.goal_spec = {agent_id: self.get_goal(self.task_goal[agent_id], self.agent_goals[agent_id])
+                          for agent_id in range(self.num_agents)}
+
+        if environment_graph is None:
+            environment_graph = self.init_graph
+
+        if self.init_rooms[0] not in ['kitchen', 'bedroom', 'livingroom', 'bathroom']:
+            rooms = self.rnd.sample(['kitchen', 'bedroom', 'livingroom', 'bathroom'], 2)
+        else:
+            rooms = list(self.init_rooms)
+
+        graph = self.add_characters(copy.deepcopy(environment_graph), rooms)
+        self.env.reset(graph)
+
+        self.changed_graph = True
+        graph = self.get_graph()
+        self.init_unity_graph = graph
+        self.rooms = [(node['class_name'], node['id']) for node in graph['nodes'] if node['category'] == 'Rooms']
+        self.id2node = {node['id']: node for node in graph['nodes']}
+
+        obs = self.get_observations()
+        self.steps = 0
+        self.prev_reward = 0.
+        return obs
+
+    def step(self, action_dict):
+        scripts = {}
+        for agent_id, action in action_dict.items():
+            if action is None:
+                continue
+            if action.startswith('[touch]'):
+                # As in UnityEnvironment, touching only marks the object
+                objid = int(action.split('(')[1].strip()[:-1])
+                self.agent_object_touched.append(objid)
+            else:
+                # Unity walks a few meters towards the object, here the character gets to it as in the planners
+                scripts[agent_id] = action.replace('[walktowards]', '[walk]')
+
+        failed_execution = False
+        if len(scripts) > 0:
+            _, _, info_n = self.env.step(scripts)
+            id2node = {node['id']: node for node in self.env.state['nodes']}
+            for agent_id, info_agent in zip(sorted(scripts.keys()), info_n['n']):
+                if not info_agent['succeed']:
+                    print("NO SUCCESS")
+                    print(info_agent['error_message'], scripts[agent_id])
+                    failed_execution = True
+                elif scripts[agent_id].startswith('[walk]'):
+                    target_id = int(scripts[agent_id].split('(')[1].split(')')[0])
+                    if id2node[target_id].get('bounding_box') is not None:
+                        self.character_center[agent_id+1] = list(id2node[target_id]['bounding_box']['center'])
+        self.changed_graph = True
+
+        # Obtain reward
+        reward, done, info = self.reward()
+
+        graph = self.get_graph()
+        self.steps += 1
+
+        obs = self.get_observations()
+
+        info['finished'] = done
+        info['graph'] = graph
+        info['failed_exec'] = failed_execution
+        if self.steps == self.max_episode_length:
+            done = True
+        return obs, reward, done, info
+
+    def get_observations(self):
+        dict_observations = {}
+        for agent_id in range(self.num_agents):
+            obs_type = self.observation_types[agent_id]
+            dict_observations[agent_id] = self.get_observation(agent_id, obs_type)
+        return dict_observations
+
+    def get_action_space(self):
+        dict_action_space = {}
+        for agent_id in range(self.num_agents):
+            if self.observation_types[agent_id] not in ['partial', 'full']:
+                raise NotImplementedError
+            # Even if you can see all the graph, you can only interact with visible objects
+            visible_graph = self.get_observation(agent_id, 'partial')
+            dict_action_space[agent_id] = [node['id'] for node in visible_graph['nodes']]
+        return dict_action_space
+
+    def get_observation(self, agent_id, obs_type, info={}):
+        if obs_type == 'partial':
+            # Same objects as utils_env.get_visible_nodes, agent 0 has id (0 + 1)
+            curr_graph = self.get_clean_graph()
+            return self.env._mask_state(curr_graph, agent_id)
+
+        elif obs_type == 'full':
+            return self.get_clean_graph()
+
+        else:
+            # No cone or images without Unity
+            raise NotImplementedError
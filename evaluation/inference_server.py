@@ -0,0 +1,288 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import collections
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+
+import yaml
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(curr_dir, '..'))
+
+from models import agent_belief_inference
+from dataloader.dataloader_v3 import AgentTypeDataset
+from dataloader.dataloader_packed import collate_packed
+from utils import utils_rl_agent
+
+# Batched CPU inference with trained agent_belief_inference checkpoints. Episodes are sent to
+# InferenceServer.submit (or through a local socket with InferenceClient), grouped in micro-batches
+# of at most max_batch_size episodes or max_wait_ms of waiting, and run in a single forward pass.
+#
+# python evaluation/inference_server.py --ckpt ckpts/<experiment>/100.pt --port 6000
+
+
+class EpisodePreprocessor(AgentTypeDataset):
+    """Builds the model inputs of raw episodes (the content of the episode pickles) as AgentTypeDataset does"""
+    def __init__(self, args_config):
+        self.get_edges = args_config['model']['state_encoder'] == 'GNN'
+        self.graph_helper = utils_rl_agent.GraphHelper(
+                max_num_objects=args_config['model']['max_nodes'],
+                include_touch=True)
+        self.max_tsteps = args_config['model']['max_tsteps']
+        self.max_actions = args_config['model']['max_actions']
+        self.config = args_config
+        self.overfit = False
+        self.feature_cache = None
+
+    def __call__(self, content, file_name, label):
+        return self.process_episode(content, file_name, label, 0)
+
+
+def load_model(ckpt_path, args_config):
+    if args_config['model']['gated']:
+        model = agent_belief_inference.ActionGatedPredNetwork(args_config)
+    else:
+        model = agent_belief_inference.ActionPredNetwork(args_config)
+    state_dict = torch.load(ckpt_path, map_location='cpu')['model']
+    # Checkpoints saved from DataParallel
+    state_dict = {(key[len('module.'):] if key.startswith('module.') else key): value for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+class InferenceServer():
+    """
+    Loads a checkpoint once and runs the episodes it receives in dynamic micro-batches.
+    An episode is either a preprocessed item (the tuple returned by AgentTypeDataset) or a dict
+    {'content': episode pickle content, 'file_name': episode file name, 'label': agent label}.
+    """
+    def __init__(self, ckpt_path, args_config, max_batch_size=32, max_wait_ms=10, num_threads=None):
+        self.config = args_config
+        self.model = load_model(ckpt_path, args_config)
+        self.preprocessor = EpisodePreprocessor(args_config)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.num_episodes = 0
+        self.num_batches = 0
+        self.num_failures = 0
+        self.busy_time = 0.
+        self.start_time = time.time()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, episode):
+        """Returns a Future with the predictions of the episode"""
+        future = Future()
+        self.requests.put((episode, future, time.time()))
+        return future
+
+    def predict(self, episodes):
+        futures = [self.submit(episode) for episode in episodes]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+    def get_batch(self):
+        """Waits for a request, then takes the ones arriving within max_wait, up to max_batch_size"""
+        request = self.requests.get()
+        if request is None:
+            return []
+        batch = [request]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            batch.append(request)
+        return batch
+
+    def run(self):
+        while self.running:
+            batch = self.get_batch()
+            if len(batch) == 0:
+                break
+            start = time.time()
+            items, futures, arrival = [], [], []
+            for episode, future, arrival_time in batch:
+                try:
+                    item = self.preprocess(episode)
+                    error = Exception('Invalid episode')
+                except Exception as e:
+                    item, error = None, e
+                if item is None:
+                    future.set_exception(error)
+                    with self.lock:
+                        self.num_failures += 1
+                    continue
+                items.append(item)
+                futures.append(future)
+                arrival.append(arrival_time)
+
+            if len(items) > 0:
+                try:
+                    predictions = self.forward(items)
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                end = time.time()
+                with self.lock:
+                    self.num_episodes += len(items)
+                    self.num_batches += 1
+                    self.busy_time += end - start
+                    self.latencies.extend([end - arrival_time for arrival_time in arrival])
+                for future, prediction in zip(futures, predictions):
+                    future.set_result(prediction)
+
+    def preprocess(self, episode):
+        if isinstance(episode, dict):
+            return self.preprocessor(episode['content'], episode['file_name'], episode['label'])
+        return episode
+
+    def forward(self, items):
+        time_graph, program, _, len_mask, goal, label_agent, _, belief_info = collate_packed([item[:8] for item in items])
+        inputs = {
+            'program': program,
+            'graph': time_graph,
+            'mask_len': len_mask,
+            'goal': goal,
+            'label_agent': label_agent,
+            'belief_info': belief_info
+        }
+        with torch.no_grad():
+            output = self.model(inputs)
+
+        lengths = len_mask.sum(-1).long().tolist()
+        action = output['action_logits'].argmax(-1)
+        o1 = output['o1_logits'].argmax(-1)
+        o2 = output['o2_logits'].argmax(-1)
+        belief_container = F.softmax(output['belief_logit'], -1)
+        belief_room = F.softmax(output['belief_logit_room'], -1)
+        predictions = []
+        for it, length in enumerate(lengths):
+            predictions.append({
+                'action': action[it, :length].numpy(),
+                'o1': o1[it, :length].numpy(),
+                'o2': o2[it, :length].numpy(),
+                'belief_container': belief_container[it].numpy(),
+                'belief_room': belief_room[it].numpy(),
+            })
+        return predictions
+
+    def get_stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            elapsed = time.time() - self.start_time
+            stats = {
+                'episodes': self.num_episodes,
+                'batches': self.num_batches,
+                'failures': self.num_failures,
+                'mean_batch_size': self.num_episodes / max(self.num_batches, 1),
+                'episodes_per_sec': self.num_episodes / max(elapsed, 1e-9),
+                'episodes_per_busy_sec': self.num_episodes / max(self.busy_time, 1e-9),
+                'queued': self.requests.qsize(),
+            }
+        if len(latencies) > 0:
+            stats.update({
+                'latency_ms_mean': float(latencies.mean()),
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_max': float(latencies.max()),
+            })
+        return stats
+
+    def serve(self, address=('localhost', 6000), authkey=b'belief'):
+        """
+        Serves the model on a local socket. Every message is ('predict', [episodes]) or ('stats', None),
+        and gets ('ok', result) or ('error', message) back.
+        """
+        listener = Listener(address, authkey=authkey)
+        print("Serving on {}".format(listener.address))
+        try:
+            while self.running:
+                conn = listener.accept()
+                threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+    def serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    command, data = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if command == 'predict':
+                        result = self.predict(data)
+                    elif command == 'stats':
+                        result = self.get_stats()
+                    else:
+                        raise Exception('Unknown command {}'.format(command))
+                    conn.send(('ok', result))
+                except Exception as e:
+                    conn.send(('error', repr(e)))
+
+
+class InferenceClient():
+    def __init__(self, address=('localhost', 6000), authkey=b'belief'):
+        self.conn = Client(address, authkey=authkey)
+
+    def request(self, command, data=None):
+        self.conn.send((command, data))
+        status, result = self.conn.recv()
+        if status != 'ok':
+            raise Exception(result)
+        return result
+
+    def predict(self, episodes):
+        return self.request('predict', episodes)
+
+    def get_stats(self):
+        return self.request('stats')
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', type=str, help='Checkpoint saved by algos/train_belief_pred.py')
+    parser.add_argument('--config', type=str, default='', help='Defaults to the config.yaml next to the checkpoint')
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=10)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    config_file = args.config if len(args.config) > 0 else os.path.join(os.path.dirname(args.ckpt), 'config.yaml')
+    with open(config_file, 'r') as f:
+        config = yaml.safe_load(f)
+    server = InferenceServer(args.ckpt, config, max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms, num_threads=args.num_threads)
+    server.serve((args.host, args.port))
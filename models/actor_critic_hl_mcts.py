@@ -92,11 +92,44 @@ class ActorCritic(nn.Module):
             for name, inp in inputs.items():
                 new_inputs[name] = inp.cuda()
             inputs = new_inputs
-        affordance_obj1 = inputs['affordance_matrix']
 
         # value function, history, node_embedding, rnn
         context_goal, object_goal, rnn_hxs = self.base(inputs, rnn_hxs, masks)
         value = self.critic_linear(context_goal)
+        logits = [distr(context_goal).original_logits for distr in self.dist]
+        return self.sample_actions(inputs, value, logits, rnn_hxs, context_goal, object_goal,
+                                   deterministic=deterministic, epsilon=epsilon, action_indices=action_indices)
+
+    def act_batch(self, inputs, rnn_hxs, masks=None, deterministic=False, epsilon=0.0):
+        """
+        act for a batch of agents (inputs built with utils_rl_agent.cat_batch), with a single forward pass.
+        The actions are sampled per agent, as in act, epsilon can be a list with the epsilon of every agent.
+        Returns the list of act outputs of every agent
+        """
+        if self.is_cuda():
+            new_inputs = {}
+            for name, inp in inputs.items():
+                new_inputs[name] = inp.cuda()
+            inputs = new_inputs
+
+        context_goal, object_goal, rnn_hxs = self.base(inputs, rnn_hxs, masks)
+        value = self.critic_linear(context_goal)
+        logits = [distr(context_goal).original_logits for distr in self.dist]
+
+        batch_size = value.shape[0]
+        if not isinstance(epsilon, (list, tuple)):
+            epsilon = [epsilon] * batch_size
+        item = utils_rl_agent.get_batch_item
+        outputs = []
+        for it in range(batch_size):
+            outputs.append(self.sample_actions(item(inputs, it), item(value, it), item(logits, it), item(rnn_hxs, it),
+                                               item(context_goal, it), item(object_goal, it),
+                                               deterministic=deterministic, epsilon=epsilon[it]))
+        return outputs
+
+    def sample_actions(self, inputs, value, logits, rnn_hxs, context_goal, object_goal, deterministic=False, epsilon=0.0, action_indices=None):
+        """Samples the actions from the logits of every distribution. Also used by policy_export.CompiledActorCritic"""
+        affordance_obj1 = inputs['affordance_matrix']
 
         # TODO: this can probably be always shared across a batch
         object_classes = inputs['class_objects']
@@ -109,7 +142,7 @@ class ActorCritic(nn.Module):
         actions_probs = [None] * len(indices)
         for i in indices:
             distr = self.dist[i]
-            dist = distr(context_goal)
+            dist = distr.update_logs(logits[i])
             log_probs = dist.original_logits
 
             # if i == 0:
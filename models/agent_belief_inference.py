@@ -4,25 +4,63 @@ import torch.nn.functional as F
 import torch.nn as nn
 import ipdb
 
+class ContextCache():
+    """
+    Summary vectors of the context episodes, stored per (train/eval mode, agent label, episode id), since the
+    encoder has dropout. The vectors are kept while the weights of the encoder stay within tolerance (relative
+    norm of the change) of the weights they were computed with.
+    """
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+        self.features = {}
+        self.reference_weights = None
+        self.hits = 0
+        self.misses = 0
+
+    def weights_change(self, model):
+        if self.reference_weights is None:
+            return float('inf')
+        diff, norm = 0., 0.
+        for name, param in model.state_dict().items():
+            if not param.dtype.is_floating_point:
+                continue
+            reference = self.reference_weights[name]
+            diff += (param.detach().float() - reference).norm().item() ** 2
+            norm += reference.norm().item() ** 2
+        return (diff / max(norm, 1e-12)) ** 0.5
+
+    def refresh(self, model):
+        """Clears the vectors if the weights of model changed more than tolerance. Returns whether it did"""
+        if self.weights_change(model) <= self.tolerance:
+            return False
+        self.features = {}
+        self.reference_weights = {name: param.detach().float().clone() for name, param in model.state_dict().items()}
+        return True
+
+
 class ModelAggregate(nn.Module):
     def __init__(self, model, args):
         super(ModelAggregate, self).__init__()
         self.model_single_ep = model
+        self.context_cache = None
+        if args['model'].get('context_cache', False):
+            self.context_cache = ContextCache(args['model'].get('context_cache_tolerance', 0.0))
 
-    def forward(self, inputs, other_inputs):
+    def refresh_context_cache(self):
+        """Call at the beginning of every epoch or evaluation, and after loading a checkpoint"""
+        if self.context_cache is not None:
+            if self.context_cache.refresh(self.model_single_ep):
+                print("Context cache cleared")
+
+    def flatten_episodes(self, other_inputs):
         # first, we platten the episodes
         other_episode_inputs = {}
-        other_inputs_tg_flatten = {}
-        other_inputs_program_flatten = {}
-
-
         other_episode_inputs['graph'] = {}
         other_episode_inputs['program'] = {}
         other_episode_inputs['goal'] = {}
 
         for key in other_inputs['time_graph']:
             dims = list(other_inputs['time_graph'][key].shape)
-            bs, neps = dims[:2]
             other_episode_inputs['graph'][key] = torch.reshape(other_inputs['time_graph'][key], [-1]+dims[2:])
 
         for key in other_inputs['program_batch']:
@@ -33,15 +71,54 @@ class ModelAggregate(nn.Module):
             dims = list(other_inputs['goal'][key].shape)
             other_episode_inputs['goal'][key] = torch.reshape(other_inputs['goal'][key], [-1]+dims[2:])
 
-
         dims = list(other_inputs['length_mask'].shape)
         other_episode_inputs['mask_len'] = torch.reshape(other_inputs['length_mask'], [-1]+dims[2:])
+        return other_episode_inputs
 
-        # ipdb.set_trace()
+    def select_episodes(self, episode_inputs, index):
+        return {key: (self.select_episodes(value, index) if isinstance(value, dict) else value[index])
+                for key, value in episode_inputs.items()}
 
+    def encode_episodes(self, other_episode_inputs):
+        """Summary vector of every episode, the output of the model at the last step"""
         outputs_eps = self.model_single_ep(other_episode_inputs, compute_belief=False)
         laststep = other_episode_inputs['mask_len'].sum(dim=-1).long() - 1
-        outputs_eps = torch.gather(outputs_eps, 1, laststep[:, None, None].repeat(1, 1, outputs_eps.shape[-1]))[:, 0, :]
+        return torch.gather(outputs_eps, 1, laststep[:, None, None].repeat(1, 1, outputs_eps.shape[-1]))[:, 0, :]
+
+    def encode_context_cached(self, other_inputs, other_episode_inputs):
+        # Context vectors are constants here, only the episodes missing in the cache are encoded
+        cache = self.context_cache
+        bs, neps = other_inputs['episode_ids'].shape
+        labels = other_inputs['label'][:, None].repeat(1, neps).reshape(-1).tolist()
+        keys = [(self.training, label, episode_id) for label, episode_id in zip(labels, other_inputs['episode_ids'].reshape(-1).tolist())]
+        missing = {}
+        for it, key in enumerate(keys):
+            if key not in cache.features and key not in missing:
+                missing[key] = it
+        cache.hits += len(keys) - len(missing)
+        cache.misses += len(missing)
+
+        if len(missing) > 0:
+            index = torch.tensor(list(missing.values()), device=other_episode_inputs['mask_len'].device)
+            with torch.no_grad():
+                features = self.encode_episodes(self.select_episodes(other_episode_inputs, index))
+            for key, feature in zip(missing.keys(), features):
+                cache.features[key] = feature
+
+        device = other_episode_inputs['mask_len'].device
+        return torch.cat([cache.features[key][None].to(device) for key in keys], 0)
+
+    def forward(self, inputs, other_inputs):
+        other_episode_inputs = self.flatten_episodes(other_inputs)
+        bs, neps = other_inputs['length_mask'].shape[:2]
+
+        # ipdb.set_trace()
+        if self.context_cache is not None and 'episode_ids' in other_inputs:
+            if self.context_cache.reference_weights is None:
+                self.refresh_context_cache()
+            outputs_eps = self.encode_context_cached(other_inputs, other_episode_inputs)
+        else:
+            outputs_eps = self.encode_episodes(other_episode_inputs)
         output_eps = outputs_eps.reshape([bs, neps, -1]).mean(1)
         return self.model_single_ep(inputs, context_feat=output_eps)
 
@@ -127,6 +204,7 @@ class ActionGatedPredNetwork(nn.Module):
 
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -139,7 +217,7 @@ class ActionGatedPredNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -196,11 +274,11 @@ class ActionGatedPredNetwork(nn.Module):
         if self.time_aggregate == 'LSTM':
             tstep, nnodes = list(input_embed.shape)[1:3]
             if context_feat is None:
-                graph_output, (h_t, c_t) = self.RNN(input_embed)
+                graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
             else:
                 context_feat = context_feat[:, None, :].repeat(1, tstep, 1)
                 input_embed = torch.cat([input_embed, context_feat], -1)
-                graph_output, (h_t, c_t) = self.RNN2(input_embed)
+                graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN2, input_embed, mask_len, packed=self.packed_inputs)
 
         elif self.time_aggregate == 'none':
             if context_Feat is None:
@@ -326,6 +404,7 @@ class ActionPredNetwork(nn.Module):
                                            nn.Linear(self.hidden_size, 1))
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -338,7 +417,7 @@ class ActionPredNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -376,7 +455,7 @@ class ActionPredNetwork(nn.Module):
 
         ipdb.set_trace()
         # Input a combination of previous actions and graph 
-        graph_output, (h_t, c_t) = self.RNN(input_embed)
+        graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
         
 
         # skip the last graph
@@ -456,6 +535,7 @@ class ActionCharNetwork(nn.Module):
                                            nn.Linear(self.hidden_size, 1))
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -468,7 +548,7 @@ class ActionCharNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -504,6 +584,6 @@ class ActionCharNetwork(nn.Module):
             input_embed = torch.cat([input_embed, cond_vec], -1)
 
         # Input a combination of previous actions and graph 
-        graph_output, (h_t, c_t) = self.RNN(input_embed)
+        graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
 
         return graph_output
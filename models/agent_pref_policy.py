@@ -74,6 +74,7 @@ class ActionGatedPredNetwork(nn.Module):
 
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -86,7 +87,7 @@ class ActionGatedPredNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -138,7 +139,7 @@ class ActionGatedPredNetwork(nn.Module):
 
         # Input a combination of previous actions and graph 
         if self.time_aggregate == 'LSTM':
-            graph_output, (h_t, c_t) = self.RNN(input_embed)
+            graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
         elif self.time_aggregate == 'none':
             graph_output = self.COMBTime(input_embed)
 
@@ -220,6 +221,7 @@ class ActionPredNetwork(nn.Module):
                                            nn.Linear(self.hidden_size, 1))
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -232,7 +234,7 @@ class ActionPredNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -270,7 +272,7 @@ class ActionPredNetwork(nn.Module):
 
         ipdb.set_trace()
         # Input a combination of previous actions and graph 
-        graph_output, (h_t, c_t) = self.RNN(input_embed)
+        graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
 
         # skip the last graph
 
@@ -349,6 +351,7 @@ class ActionCharNetwork(nn.Module):
                                            nn.Linear(self.hidden_size, 1))
 
         self.goal_inp = args['goal_inp']
+        self.packed_inputs = args.get('packed_inputs', False)
         if args['goal_inp']:
             self.goal_encoder = base_nets.GoalEncoder(self.max_num_classes, self.hidden_size, obj_class_encoder=self.graph_encoder.object_class_encoding)
 
@@ -361,7 +364,7 @@ class ActionCharNetwork(nn.Module):
         mask_nodes = graph['mask_object']
         index_obj1 = program['indobj1']
         index_obj2 = program['indobj2']
-        node_embeddings = self.graph_encoder(graph)
+        node_embeddings = base_nets.encode_graph(self.graph_encoder, graph, mask_len, packed=self.packed_inputs)
         # Is this ok?
         node_embeddings[node_embeddings.isnan()] = 1
 
@@ -397,6 +400,6 @@ class ActionCharNetwork(nn.Module):
             input_embed = torch.cat([input_embed, cond_vec], -1)
 
         # Input a combination of previous actions and graph 
-        graph_output, (h_t, c_t) = self.RNN(input_embed)
+        graph_output, (h_t, c_t) = base_nets.run_rnn(self.RNN, input_embed, mask_len, packed=self.packed_inputs)
 
         return graph_output
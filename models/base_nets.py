@@ -253,6 +253,37 @@ class GoalAttentionModel(NNBase):
         return r_context_vec, r_object_vec_comb, rnn_hxs
 
 
+def encode_graph(graph_encoder, graph, mask_len, packed=False):
+    """
+    Runs graph_encoder over [bs, tsteps, ...] graphs. With packed, only the steps in mask_len are encoded,
+    flattened in a single sequence, and the padded steps are 0 in the output.
+    """
+    if not packed or 'graph' in graph:
+        return graph_encoder(graph)
+    valid = mask_len.bool()
+    graph_valid = {}
+    for key, value in graph.items():
+        if torch.is_tensor(value) and list(value.shape[:2]) == list(valid.shape):
+            graph_valid[key] = value[valid][None]
+    node_embeddings = graph_encoder(graph_valid)[0]
+    output = node_embeddings.new_zeros(list(valid.shape) + list(node_embeddings.shape[1:]))
+    output[valid] = node_embeddings
+    return output
+
+def run_rnn(rnn, inputs, mask_len, packed=False):
+    """
+    Runs a batch_first LSTM over [bs, tsteps, dim] inputs. With packed, every sequence stops at
+    its length in mask_len, and the outputs after it are 0.
+    """
+    if not packed:
+        return rnn(inputs)
+    lengths = mask_len.sum(-1).long().clamp(min=1).cpu()
+    packed_inputs = nn.utils.rnn.pack_padded_sequence(inputs, lengths, batch_first=True, enforce_sorted=False)
+    output, (h_t, c_t) = rnn(packed_inputs)
+    output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=inputs.shape[1])
+    return output, (h_t, c_t)
+
+
 class GNNBase(nn.Module):
     def __init__(self, hidden_size=128, max_nodes=150, num_rels=5, num_classes=100, num_states=4):
         super(GNNBase, self).__init__()
@@ -102,6 +102,38 @@ class GatedGraphConv(nn.Module):
             #graph.ndata['h'] = feat
         return feat
 
+    def forward_edges(self, src, dst, etypes, feat):
+        """Same as forward, with the graph given as edge lists instead of a DGLGraph.
+
+        Parameters
+        ----------
+        src, dst : torch.LongTensor
+            Source and destination of every edge, as row indices of feat, of shape :math:`(E,)`.
+            A batch of graphs is a single graph with the nodes of all the graphs.
+        etypes : torch.LongTensor
+            The edge type tensor of shape :math:`(E,)`.
+        feat : torch.Tensor
+            The input feature of shape :math:`(N, D_{in})`.
+
+        Returns
+        -------
+        torch.Tensor
+            The output feature of shape :math:`(N, D_{out})`.
+        """
+        # Edges of every type are selected once, and reused in all the steps
+        edges_type = []
+        for i in range(self._n_etypes):
+            eids = (etypes == (i+1)).nonzero().view(-1)
+            if len(eids) > 0:
+                edges_type.append((self.linears[i], src[eids], dst[eids]))
+
+        for _ in range(self._n_steps):
+            a = feat.new_zeros((feat.shape[0], self._out_feats))
+            for linear, src_type, dst_type in edges_type:
+                a.index_add_(0, dst_type, linear(feat[src_type]))
+            feat = self.gru(a, feat)
+        return feat
+
 class RGCNLayer(nn.Module):
     def __init__(self, in_feat, out_feat, num_rels, num_bases=-1, bias=None,
                  activation=None, is_input_layer=False):
@@ -256,32 +288,19 @@ class GraphModelGGNN(nn.Module):
         feat_in_batch = self.feat_in(all_class_names[mask_nodes_r].long(), node_states[mask_nodes_r])
 
         if not graph_built:
-            for env_id in range(num_envs):
-                g = DGLGraph()
-                num_nodes = int(mask_nodes[env_id].sum().item())
-                num_edges = int(mask_edges[env_id].sum().item())
-
-
-                if num_nodes > 0:
-                    g.add_nodes(num_nodes)
-                    # ipdb.set_trace()
-                    if num_edges > 0:
-                        edge_types = all_edge_types[env_id][:num_edges].long()
-                        #try:
-                        #ipdb.set_trace()
-                        g.add_edges(all_edge_ids[env_id][:num_edges, 0].long(),
-                                    all_edge_ids[env_id][:num_edges, 1].long(),
-                                    {'rel_type': edge_types})
-                                    #     'norm': torch.ones((num_edges, 1)).to(edge_types.device)})
-                    graphs.append(g)
-                else:
-                    empty_graphs.append(env_id)
-
-            #print('----s')
-            batch_graph = dgl.batch(graphs)
+            # Message passing over all the graphs at once. Nodes are indexed by their position
+            # among the valid nodes of the batch, as in feat_in_batch
+            num_nodes = mask_nodes.shape[-1]
+            node_index = torch.cumsum(mask_nodes_r.long(), 0) - 1
+            offsets = torch.arange(num_envs, device=all_edge_ids.device)[:, None] * num_nodes
+            mask_edges_r = mask_edges.reshape([-1]).bool()
+            src = (all_edge_ids[..., 0].long() + offsets).reshape([-1])[mask_edges_r]
+            dst = (all_edge_ids[..., 1].long() + offsets).reshape([-1])[mask_edges_r]
+            edge_types = all_edge_types.reshape([-1])[mask_edges_r].long()
+            feats_out = self.ggnn.forward_edges(node_index[src], node_index[dst], edge_types, feat_in_batch)
         else:
             batch_graph = inputs['graph']
-        feats_out = self.ggnn(batch_graph, feat_in_batch)
+            feats_out = self.ggnn(batch_graph, feat_in_batch)
 
         feats_out_tensor = torch.zeros(all_class_names.shape[0], self.out_dim)
         if inputs['class_objects'].is_cuda:
@@ -0,0 +1,194 @@
+import os
+import sys
+import argparse
+import warnings
+import torch
+import torch.nn as nn
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(curr_dir, '..'))
+
+from models.distributions import ElementWiseCategorical
+from utils import utils_rl_agent
+
+# Export of the Transformer policies (actor_critic and actor_critic_hl_mcts) for CPU inference.
+# PolicyCore is the tensor-only part of ActorCritic.act: state encoder, goal attention, LSTM, critic
+# and the logits of every distribution. It is traced into TorchScript, frozen and optimized for
+# inference, and CompiledActorCritic runs it in place of the eager model, sampling the actions with
+# the masking of ActorCritic.sample_actions. The compiled policies run in eval mode (no dropout).
+#
+# python models/policy_export.py --load-model trained_models/<exp>/high_level.pt \
+#     --load-model-lowlevel trained_models/<exp>/low_level.pt --out-dir compiled_policy
+
+# Inputs of the state encoder and goal encoder, in the order of PolicyCore.forward
+input_names = ['class_objects', 'object_coords', 'states_objects', 'mask_object',
+               'target_obj_class', 'target_loc_class', 'mask_goal_pred']
+
+# Files in the export folder, as loaded by the agents
+policy_files = {
+    'high_level': 'high_level.pt',
+    'low_level': 'low_level.pt',
+    'low_level_put': 'low_level_put.pt'
+}
+
+
+class PolicyCore(nn.Module):
+    def __init__(self, actor_critic):
+        super(PolicyCore, self).__init__()
+        self.base = actor_critic.base
+        self.critic_linear = actor_critic.critic_linear
+        self.dist = actor_critic.dist
+
+    def forward(self, class_objects, object_coords, states_objects, mask_object,
+                target_obj_class, target_loc_class, mask_goal_pred, h, c, masks):
+        inputs = {
+            'class_objects': class_objects,
+            'object_coords': object_coords,
+            'states_objects': states_objects,
+            'mask_object': mask_object,
+            'target_obj_class': target_obj_class,
+            'target_loc_class': target_loc_class,
+            'mask_goal_pred': mask_goal_pred
+        }
+        context_goal, object_goal, (h, c) = self.base(inputs, (h, c), masks)
+        value = self.critic_linear(context_goal)
+
+        # Same logits as the distributions, without building them
+        logits = []
+        for distr in self.dist:
+            if isinstance(distr, ElementWiseCategorical):
+                logits.append(distr.layer(object_goal).squeeze(-1))
+            else:
+                logits.append(distr.linear(context_goal))
+        return tuple([value, context_goal, object_goal, h, c] + logits)
+
+
+def get_core_inputs(inputs, rnn_hxs, masks):
+    """Arguments of PolicyCore.forward from the arguments of ActorCritic.act"""
+    core_inputs = [inputs[name] for name in input_names]
+    core_inputs[0] = core_inputs[0].long()
+    core_inputs[4] = core_inputs[4].long()
+    core_inputs[5] = core_inputs[5].long()
+    if masks is None:
+        masks = torch.ones(rnn_hxs[0].shape)
+    return [inp.cpu() for inp in core_inputs] + [rnn_hxs[0].cpu(), rnn_hxs[1].cpu(), masks.cpu()]
+
+
+def example_inputs(actor_critic, max_nodes=150, num_goals=6):
+    """Inputs with the shapes built by the RL agents (batch of 1), to trace the policy"""
+    hidden_size = actor_critic.hidden_size
+    num_states = actor_critic.base.main.single_object_encoding.state_embedding.in_features
+    num_classes = actor_critic.base.main.single_object_encoding.num_classes
+    num_visible = max(1, max_nodes // 2)
+    mask_object = torch.zeros(1, max_nodes)
+    mask_object[:, :num_visible] = 1.
+    mask_goal_pred = torch.zeros(1, num_goals)
+    mask_goal_pred[:, 0] = 1.
+    inputs = {
+        'class_objects': torch.randint(num_classes, (1, max_nodes)),
+        'object_coords': torch.randn(1, max_nodes, 6),
+        'states_objects': (torch.rand(1, max_nodes, num_states) > 0.5).float(),
+        'mask_object': mask_object,
+        'target_obj_class': torch.randint(num_classes, (1, num_goals)),
+        'target_loc_class': torch.randint(num_classes, (1, num_goals)),
+        'mask_goal_pred': mask_goal_pred
+    }
+    rnn_hxs = (torch.randn(1, hidden_size), torch.randn(1, hidden_size))
+    return inputs, rnn_hxs, torch.ones(1, hidden_size)
+
+
+def export_torchscript(actor_critic, path, max_nodes=150, num_goals=6, optimize=True):
+    """Traces the policy of actor_critic on CPU and saves it in path"""
+    core = PolicyCore(actor_critic).cpu().eval()
+    inputs, rnn_hxs, masks = example_inputs(actor_critic, max_nodes, num_goals)
+    with torch.no_grad(), warnings.catch_warnings():
+        # The NaN checks of the base become constants in the trace
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        module = torch.jit.trace(core, tuple(get_core_inputs(inputs, rnn_hxs, masks)))
+    if optimize:
+        module = torch.jit.optimize_for_inference(torch.jit.freeze(module))
+    torch.jit.save(module, path)
+    return module
+
+
+def export_onnx(actor_critic, path, max_nodes=150, num_goals=6, opset_version=14):
+    """Optional ONNX version of the same policy, needs the onnx package"""
+    core = PolicyCore(actor_critic).cpu().eval()
+    inputs, rnn_hxs, masks = example_inputs(actor_critic, max_nodes, num_goals)
+    output_names = ['value', 'context_goal', 'object_goal', 'h', 'c'] + [
+        'logits_{}'.format(it) for it in range(len(core.dist))]
+    with torch.no_grad():
+        torch.onnx.export(core, tuple(get_core_inputs(inputs, rnn_hxs, masks)), path,
+                          input_names=input_names + ['h', 'c', 'masks'],
+                          output_names=output_names, opset_version=opset_version)
+
+
+class CompiledActorCritic():
+    """
+    Runs the policy exported by export_torchscript with the interface of ActorCritic.act.
+    actor_critic is the eager model, only used to sample the actions.
+    """
+    def __init__(self, actor_critic, path):
+        self.actor_critic = actor_critic
+        self.module = torch.jit.load(path, map_location='cpu')
+        self.module.eval()
+
+    def act(self, inputs, rnn_hxs, masks=None, deterministic=False, epsilon=0.0, action_indices=None):
+        with torch.no_grad():
+            outputs = self.module(*get_core_inputs(inputs, rnn_hxs, masks))
+        value, context_goal, object_goal, h, c = outputs[:5]
+        logits = list(outputs[5:])
+        return self.actor_critic.sample_actions(inputs, value, logits, (h, c), context_goal, object_goal,
+                                                deterministic=deterministic, epsilon=epsilon,
+                                                action_indices=action_indices)
+
+    def act_batch(self, inputs, rnn_hxs, masks=None, deterministic=False, epsilon=0.0):
+        # The module is traced with a single agent, it is run once per agent of the batch
+        batch_size = rnn_hxs[0].shape[0]
+        if not isinstance(epsilon, (list, tuple)):
+            epsilon = [epsilon] * batch_size
+        item = utils_rl_agent.get_batch_item
+        return [self.act(item(inputs, it), item(rnn_hxs, it), None if masks is None else item(masks, it),
+                         deterministic=deterministic, epsilon=epsilon[it])
+                for it in range(batch_size)]
+
+
+def load_compiled_policies(folder, actor_critics):
+    """CompiledActorCritic for every actor_critics[name] with a file in folder, the eager model otherwise"""
+    policies = {}
+    for name, actor_critic in actor_critics.items():
+        path = os.path.join(folder, policy_files[name])
+        if os.path.isfile(path):
+            print("Loading compiled policy {}".format(path))
+            policies[name] = CompiledActorCritic(actor_critic, path)
+        else:
+            policies[name] = actor_critic
+    return policies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load-model', type=str, default='', help='High level policy, as saved by algos/a2c_mp.py')
+    parser.add_argument('--load-model-lowlevel', type=str, default='', help='Low level policies (low level, low level put)')
+    parser.add_argument('--out-dir', type=str, default='compiled_policy')
+    parser.add_argument('--max-num-objects', type=int, default=150)
+    parser.add_argument('--onnx', action='store_true', default=False, help='also export the ONNX models')
+    args = parser.parse_args()
+
+    models = {}
+    if len(args.load_model) > 0:
+        models['high_level'] = torch.load(args.load_model, map_location='cpu')[0]
+    if len(args.load_model_lowlevel) > 0:
+        model_low_level = torch.load(args.load_model_lowlevel, map_location='cpu')
+        models['low_level'] = model_low_level[0]
+        models['low_level_put'] = model_low_level[1]
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for name, model in models.items():
+        path = os.path.join(args.out_dir, policy_files[name])
+        export_torchscript(model, path, max_nodes=args.max_num_objects)
+        print("Saved {}".format(path))
+        if args.onnx:
+            onnx_path = os.path.splitext(path)[0] + '.onnx'
+            export_onnx(model, onnx_path, max_nodes=args.max_num_objects)
+            print("Saved {}".format(onnx_path))
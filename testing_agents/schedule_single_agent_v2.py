@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import pickle
+import logging
+import multiprocessing as mp
+
+from envs.unity_environment import UnityEnvironment
+from envs.graph_environment import GraphEnvironment
+from agents import MCTS_agent_particle_v2
+from arguments import get_args
+from algos.arena_mp2 import ArenaMP
+from utils import utils_episode_log
+from utils import utils_scheduler
+from testing_agents.test_single_agent_v2 import agent_types, get_agent_args, get_mode, load_env_task_set, get_record_dir
+
+# Generates the episodes of test_single_agent_v2 with a pool of workers. The (agent type, episode, try)
+# jobs are stored in a SQLite queue next to the logs, every worker runs its own ArenaMP and simulator
+# (on port base_port + worker id) and takes jobs until the queue is empty. Running the script again
+# resumes the remaining jobs.
+#
+# python testing_agents/schedule_single_agent_v2.py --agenttype 0,3,4 --num-workers 8 \
+#     --executable_file ../path_sim_dev/linux_exec.x86_64 --max-episode-length 150
+# python testing_agents/schedule_single_agent_v2.py --report
+
+num_tries = 3
+# Episodes of test_single_agent_v2, used if --dataset_path is not given
+default_dataset_path = './dataset/train_env_task_set_20_full_reduced_tasks1to3.pik'
+
+
+def get_jobs_db(args):
+    if len(args.jobs_db) > 0:
+        return args.jobs_db
+    datafile = args.dataset_path.split('/')[-1].replace('.pik', '')
+    return '../data_scratch/large_data_touch_v2/jobs_{}.db'.format(datafile)
+
+
+def enqueue_jobs(queue, dataset_path, env_task_set, agent_types_index):
+    jobs = []
+    for agent_type in agent_types_index:
+        record_dir, _ = get_record_dir(dataset_path, get_mode(agent_type))
+        for episode_id in range(len(env_task_set)):
+            if sum(env_task_set[episode_id]['task_goal'][0].values()) == 0:
+                continue
+            for iter_id in range(num_tries):
+                log_file_name = record_dir + '/logs_episode.{}_iter.{}.pik'.format(episode_id, iter_id)
+                jobs.append((agent_type, episode_id, iter_id, log_file_name))
+    num_added = queue.add_jobs(jobs)
+    print("Added {} jobs, {} in total".format(num_added, len(jobs)))
+
+
+class EpisodeWorker():
+    """Builds an ArenaMP on its own port and runs the jobs of the queue"""
+    def __init__(self, args, num_planner_processes):
+        self.args = args
+        self.num_planner_processes = num_planner_processes
+
+    def init(self, worker_id):
+        env_task_set = load_env_task_set(self.args.dataset_path)
+        executable_args = {
+            'file_name': self.args.executable_file,
+            'x_display': self.args.display if self.args.saveimg else None,
+            'no_graphics': not self.args.saveimg
+        }
+
+        env_class = GraphEnvironment if self.args.simulator_type == 'python' else UnityEnvironment
+        def env_fn(env_id):
+            # The observation type is set per agent type, see set_agent_type
+            return env_class(num_agents=1,
+                             max_episode_length=self.args.max_episode_length,
+                             port_id=env_id,
+                             env_task_set=env_task_set,
+                             observation_types=['partial'],
+                             use_editor=self.args.use_editor,
+                             executable_args=executable_args,
+                             base_port=self.args.base_port)
+
+        arena = ArenaMP(self.args.max_episode_length, worker_id, env_fn, [])
+        return {'worker_id': worker_id, 'arena': arena, 'env_task_set': env_task_set, 'agent_type': None}
+
+    def set_agent_type(self, state, agent_type):
+        arena = state['arena']
+        for agent in arena.agents:
+            agent.close()
+        agent_args = get_agent_args(agent_type)
+        args_agent1 = dict(agent_id=1,
+                           char_index=0,
+                           recursive=False,
+                           max_episode_length=20,
+                           num_simulation=200,
+                           max_rollout_steps=5,
+                           c_init=0.1,
+                           c_base=10000,
+                           num_samples=1,
+                           num_processes=self.num_planner_processes,
+                           num_particles=20,
+                           logging=True,
+                           logging_graphs=True,
+                           agent_params=agent_args)
+        arena.agent_fn = [lambda x, y: MCTS_agent_particle_v2(**args_agent1)]
+        arena.agents = [agent_fn(arena.arena_id, arena.env) for agent_fn in arena.agent_fn]
+        arena.num_agents = len(arena.agents)
+        arena.env.observation_types = [agent_args['obs_type']]
+        state['agent_type'] = agent_type
+
+    def run(self, state, job):
+        if state['agent_type'] != job['agent_type']:
+            self.set_agent_type(state, job['agent_type'])
+        arena = state['arena']
+        episode_id, iter_id = job['episode_id'], job['iter_id']
+        log_file_name = job['log_file']
+        os.makedirs(os.path.dirname(log_file_name), exist_ok=True)
+        print('Worker {}. Agent type: {}. Episode: {}. Try: {}'.format(state['worker_id'], job['agent_type'], episode_id, iter_id))
+
+        for it_agent, agent in enumerate(arena.agents):
+            agent.seed = (it_agent + iter_id * 2) * 5
+        try:
+            arena.reset(episode_id)
+            success, steps, saved_info = arena.run(delta_log=self.args.delta_log)
+        except Exception:
+            # Unity errors and episodes with too many failed actions, the simulator is restarted
+            # and the job retried later
+            arena.reset_env()
+            raise
+
+        if len(saved_info['obs']) == 0:
+            raise Exception('Episode without observations')
+        # Written to a temporary file first, the log file marks the job as done for the other scripts
+        tmp_file_name = '{}.tmp.{}'.format(log_file_name, state['worker_id'])
+        if self.args.delta_log:
+            utils_episode_log.save_episode_log(saved_info, tmp_file_name)
+        else:
+            with open(tmp_file_name, 'wb') as f:
+                pickle.dump(saved_info, f)
+        os.replace(tmp_file_name, log_file_name)
+        return {'success': bool(success), 'steps': steps}
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.dataset_path is None:
+        args.dataset_path = default_dataset_path
+    queue = utils_scheduler.JobQueue(get_jobs_db(args))
+    if args.report:
+        print(utils_scheduler.format_progress(queue.progress()))
+        for error in queue.errors():
+            print('Agent type: {}. Episode: {}. Try: {}. Attempts: {}. {}'.format(*error))
+        sys.exit()
+
+    agent_types_index = list(range(len(agent_types)))
+    if args.agenttype != 'all':
+        agent_types_index = [int(x) for x in args.agenttype.split(',')]
+
+    enqueue_jobs(queue, args.dataset_path, load_env_task_set(args.dataset_path), agent_types_index)
+    print("Requeued {} jobs of a previous run".format(queue.requeue_running()))
+    print("{} jobs already have a log file".format(queue.mark_existing_done()))
+    if args.retry_failed:
+        print("Retrying {} failed jobs".format(queue.retry_failed()))
+    print(utils_scheduler.format_progress(queue.progress()))
+    queue.close()
+
+    # Every worker runs a simulator and the planner processes of its agent
+    num_workers = args.num_workers
+    if num_workers <= 0:
+        num_workers = max(1, mp.cpu_count() // args.num_planner_processes)
+    print("Running {} workers with {} planner processes each".format(num_workers, args.num_planner_processes))
+
+    logging.basicConfig(level=logging.INFO)
+    worker = EpisodeWorker(args, args.num_planner_processes)
+    start_time = time.time()
+    utils_scheduler.run_workers(num_workers, get_jobs_db(args), worker.init, worker.run,
+                                max_attempts=args.max_attempts, backoff=args.retry_backoff)
+    print("Finished in {:.1f} hours".format((time.time() - start_time) / 3600.))
@@ -13,11 +13,13 @@ import numpy as np
 from pathlib import Path
 
 from envs.unity_environment import UnityEnvironment
+from envs.graph_environment import GraphEnvironment
 from agents import MCTS_agent, MCTS_agent_particle_v2, MCTS_agent_particle
 from arguments import get_args
 from algos.arena_mp2 import ArenaMP
 from utils import utils_goals
 from utils import utils_exception
+from utils import utils_episode_log
 
 
 
@@ -30,6 +32,81 @@ def get_class_mode(agent_args):
         agent_args['belief']['forget_rate'])
     return mode_str
 
+# Beliefs
+# spiked: object is in cabinet
+agent_types = [
+        ['full', 0, 0.05, False, 0, "uniform"], # 0
+        ['full', 0.5, 0.01, False, 0, "uniform"], # 1
+        ['full', -5, 0.05, False, 0, "uniform"], # 2
+        ['partial', 0, 0.05, False, 0, "uniform"], # 3
+        ['partial', 0, 0.05, False, 0, "spiked"], # 4. kitchen and cabinet
+        ['partial', 0, 0.05, False, 0.2, "uniform"], # 5
+        ['partial', -500, 0.01, False, 0.01, "spiked"], # 6
+        ['partial', -500, 0.05, False, 0.2, "uniform"], # 7
+        ['partial', 0.5, 0.05, False, 0.2, "uniform"], # 8
+        ['cone', 0, 0.05, False, 0, "uniform"], # 9
+        ['partial', 0, 0.05, False, 0, "spiked2"], # 10 High prior for not inside
+        ['partial', 0, 0.05, False, 0, "spiked3"], # 11 For sure not in bathroom
+        ['partial', 0, 0.05, False, 0, "spiked4"], # 12 All things kithcen
+        ['partial', 0, 0.05, False, 0.1, "spiked"], # 13
+        ['partial', 0, 0.05, False, 0.1, "spiked2"], # 14
+        ['partial', 0, 0.00, False, 0.1, "spiked2"] # 15
+]
+
+
+def get_agent_args(agent_type):
+    obs_type, open_cost, walk_cost, should_close, forget_rate, belief_type = agent_types[agent_type]
+    agent_args = {
+        'obs_type': obs_type,
+        'open_cost': open_cost,
+        'should_close': should_close,
+        'walk_cost': walk_cost,
+        'belief': {'forget_rate': forget_rate, 'belief_type': belief_type}
+    }
+    return agent_args
+
+def get_mode(agent_type):
+    return '{}_'.format(agent_type+1) + get_class_mode(get_agent_args(agent_type)) + 'v9_particles_v2_modeinfo'
+
+def load_env_task_set(dataset_path):
+    """Episodes of dataset_path with touch goals"""
+    env_task_set = pickle.load(open(dataset_path, 'rb'))
+    print(len(env_task_set))
+    to_delete = []
+
+    for item, env in enumerate(env_task_set):
+        # Remove one of the goals
+        new_dict_goal = {}
+        for goal_pred in env['task_goal'][0]:
+            if 'sit' in goal_pred:
+                env['task_goal'][0][goal_pred] = 0
+            numpred = env['task_goal'][0][goal_pred]
+            if goal_pred.split('_')[0] not in ['on', 'in', 'inside']:
+                continue
+            goal_pred_new = 'touch_' + goal_pred.split('_')[1]
+            if numpred > 0:
+                new_dict_goal[goal_pred_new] = numpred
+        if len(new_dict_goal) == 0:
+            to_delete.append(item)
+        env['task_goal'][0] = new_dict_goal
+
+        init_gr = env['init_graph']
+        gbg_can = [node['id'] for node in init_gr['nodes'] if node['class_name'] in ['garbagecan', 'clothespile']]
+        init_gr['nodes'] = [node for node in init_gr['nodes'] if node['id'] not in gbg_can]
+        init_gr['edges'] = [edge for edge in init_gr['edges'] if edge['from_id'] not in gbg_can and edge['to_id'] not in gbg_can]
+        for node in init_gr['nodes']:
+            if node['class_name'] == 'cutleryfork':
+                node['obj_transform']['position'][1] += 0.1
+
+    env_task_set = [env_task_set[idi] for idi in range(len(env_task_set)) if idi not in to_delete]
+    return env_task_set
+
+def get_record_dir(dataset_path, mode):
+    datafile = dataset_path.split('/')[-1].replace('.pik', '')
+    record_dir = '../data_scratch/large_data_touch_v2/{}/{}'.format(datafile, mode)
+    error_dir = '../data_scratch/large_data_touch_v2/logging/{}_{}'.format(datafile, mode)
+    return record_dir, error_dir
+
 if __name__ == '__main__':
     args = get_args()
     num_proc = 10
@@ -43,27 +120,6 @@ if __name__ == '__main__':
     #args.dataset_path = './dataset/test_env_task_set_10_full_reduced_tasks1to3.pik'
     args.dataset_path = './dataset/train_env_task_set_20_full_reduced_tasks1to3.pik'
 
-    # Beliefs
-    # spiked: object is in cabinet
-    
-    agent_types = [
-            ['full', 0, 0.05, False, 0, "uniform"], # 0
-            ['full', 0.5, 0.01, False, 0, "uniform"], # 1
-            ['full', -5, 0.05, False, 0, "uniform"], # 2
-            ['partial', 0, 0.05, False, 0, "uniform"], # 3
-            ['partial', 0, 0.05, False, 0, "spiked"], # 4. kitchen and cabinet
-            ['partial', 0, 0.05, False, 0.2, "uniform"], # 5
-            ['partial', -500, 0.01, False, 0.01, "spiked"], # 6
-            ['partial', -500, 0.05, False, 0.2, "uniform"], # 7
-            ['partial', 0.5, 0.05, False, 0.2, "uniform"], # 8
-            ['cone', 0, 0.05, False, 0, "uniform"], # 9
-            ['partial', 0, 0.05, False, 0, "spiked2"], # 10 High prior for not inside
-            ['partial', 0, 0.05, False, 0, "spiked3"], # 11 For sure not in bathroom
-            ['partial', 0, 0.05, False, 0, "spiked4"], # 12 All things kithcen
-            ['partial', 0, 0.05, False, 0.1, "spiked"], # 13
-            ['partial', 0, 0.05, False, 0.1, "spiked2"], # 14
-            ['partial', 0, 0.00, False, 0.1, "spiked2"] # 15
-    ]
     random_start = random.Random()
     agent_types_index = list(range(9))
     #agent_types_index =  [0, 3, 4, 10, 12, 13, 14]
@@ -73,51 +129,13 @@ if __name__ == '__main__':
     if args.agenttype != 'all':
         agent_types_index = [int(x) for x in args.agenttype.split(',')]
     for agent_id in agent_types_index: #len(agent_types)):
-        args.obs_type, open_cost, walk_cost, should_close, forget_rate, belief_type = agent_types[agent_id]
-        datafile = args.dataset_path.split('/')[-1].replace('.pik', '')
-        agent_args = {
-            'obs_type': args.obs_type,
-            'open_cost': open_cost,
-            'should_close': should_close,
-            'walk_cost': walk_cost,
-            'belief': {'forget_rate': forget_rate, 'belief_type': belief_type}
-        }
-        args.mode = '{}_'.format(agent_id+1) + get_class_mode(agent_args)
-        args.mode += 'v9_particles_v2_modeinfo'
+        agent_args = get_agent_args(agent_id)
+        args.obs_type = agent_args['obs_type']
+        args.mode = get_mode(agent_id)
 
-        
-        env_task_set = pickle.load(open(args.dataset_path, 'rb'))
-        print(len(env_task_set))
-        to_delete = []
-
-        for item, env in enumerate(env_task_set):
-            # Remove one of the goals
-            new_dict_goal = {}
-            for goal_pred in env['task_goal'][0]:
-                if 'sit' in goal_pred:
-                    env['task_goal'][0][goal_pred] = 0
-                numpred = env['task_goal'][0][goal_pred]
-                if goal_pred.split('_')[0] not in ['on', 'in', 'inside']:
-                    continue
-                goal_pred_new = 'touch_' + goal_pred.split('_')[1]
-                if numpred > 0:
-                    new_dict_goal[goal_pred_new] = numpred
-            if len(new_dict_goal) == 0:
-                to_delete.append(item)
-            env['task_goal'][0] = new_dict_goal
-
-            init_gr = env['init_graph']
-            gbg_can = [node['id'] for node in init_gr['nodes'] if node['class_name'] in ['garbagecan', 'clothespile']]
-            init_gr['nodes'] = [node for node in init_gr['nodes'] if node['id'] not in gbg_can]
-            init_gr['edges'] = [edge for edge in init_gr['edges'] if edge['from_id'] not in gbg_can and edge['to_id'] not in gbg_can]
-            for node in init_gr['nodes']:
-                if node['class_name'] == 'cutleryfork':
-                    node['obj_transform']['position'][1] += 0.1
-
-        env_task_set = [env_task_set[idi] for idi in range(len(env_task_set)) if idi not in to_delete]
-
-        args.record_dir = '../data_scratch/large_data_touch_v2/{}/{}'.format(datafile, args.mode)
-        error_dir = '../data_scratch/large_data_touch_v2/logging/{}_{}'.format(datafile, args.mode)
+        env_task_set = load_env_task_set(args.dataset_path)
+
+        args.record_dir, error_dir = get_record_dir(args.dataset_path, args.mode)
         if not os.path.exists(args.record_dir):
             os.makedirs(args.record_dir)
 
@@ -146,15 +164,17 @@ if __name__ == '__main__':
 
         
         file_failures = 'failures_{}.txt'.format(args.base_port)
+        # The python simulator runs the episodes without Unity, e.g. in headless machines
+        env_class = GraphEnvironment if args.simulator_type == 'python' else UnityEnvironment
         def env_fn(env_id):
-            return UnityEnvironment(num_agents=1,
-                                    max_episode_length=args.max_episode_length,
-                                    port_id=env_id,
-                                    env_task_set=env_task_set,
-                                    observation_types=[args.obs_type],
-                                    use_editor=args.use_editor,
-                                    executable_args=executable_args,
-                                    base_port=args.base_port)
+            return env_class(num_agents=1,
+                             max_episode_length=args.max_episode_length,
+                             port_id=env_id,
+                             env_task_set=env_task_set,
+                             observation_types=[args.obs_type],
+                             use_editor=args.use_editor,
+                             executable_args=executable_args,
+                             base_port=args.base_port)
 
 
         args_common = dict(recursive=False,
@@ -231,7 +251,7 @@ if __name__ == '__main__':
                         Path(img_arg).mkdir(parents=True, exist_ok=True)
                     else:
                         img_arg = None
-                    success, steps, saved_info = arena.run(save_img=img_arg)
+                    success, steps, saved_info = arena.run(save_img=img_arg, delta_log=args.delta_log)
 
                     print('-------------------------------------')
                     print('success' if success else 'failure')
@@ -247,10 +267,13 @@ if __name__ == '__main__':
                     Path(args.record_dir).mkdir(parents=True, exist_ok=True)
                     if len(saved_info['obs']) > 0:
                         print(colored("Saving.."), 'green')
-                        pickle.dump(saved_info, open(log_file_name, 'wb'))
+                        if args.delta_log:
+                            utils_episode_log.save_episode_log(saved_info, log_file_name)
+                        else:
+                            pickle.dump(saved_info, open(log_file_name, 'wb'))
                     else:
                         with open(log_file_name, 'w+') as f:
-                            f.write(json.dumps(saved_info, indent=4))
+                            f.write(json.dumps(utils_episode_log.to_dict(saved_info), indent=4))
 
                     logger.removeHandler(logger.handlers[0])
                     os.remove(failure_file)
@@ -0,0 +1,63 @@
+import os
+import sys
+import random
+import tempfile
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import utils_episode_log
+
+# Episode logs should give back the saved_info they were saved from
+# python -m pytest tests/test_episode_log.py
+
+
+def get_graphs(num_steps, seed=0):
+    rng = random.Random(seed)
+    nodes = [{'id': node_id, 'class_name': 'object', 'states': []} for node_id in range(1, 30)]
+    edges = [{'from_id': node_id, 'relation_type': 'INSIDE', 'to_id': 1} for node_id in range(2, 30)]
+    graphs = []
+    for _ in range(num_steps):
+        edges = [edge for edge in edges if rng.random() > 0.1]
+        edges.append({'from_id': rng.randrange(2, 30), 'relation_type': 'CLOSE', 'to_id': rng.randrange(2, 30)})
+        node = dict(nodes[rng.randrange(len(nodes))])
+        node['states'] = [rng.choice(['OPEN', 'CLOSED'])]
+        nodes = [node if curr_node['id'] == node['id'] else curr_node for curr_node in nodes]
+        graphs.append({'nodes': nodes, 'edges': list(edges)})
+    return graphs
+
+
+def check_loaded(loaded, saved_info):
+    loaded = utils_episode_log.to_dict(loaded)
+    assert sorted(loaded.keys()) == sorted(saved_info.keys())
+    for field in saved_info:
+        assert utils_episode_log.is_equal(loaded[field], saved_info[field]), field
+
+
+def get_saved_info(codec):
+    graphs = get_graphs(40)
+    beliefs = [{'step': step, 'values': [step] * 3} for step in range(40)]
+    saved_info = {'task_name': 'setup_table', 'graph': graphs, 'belief': {0: beliefs}}
+    # As built by ArenaMP.run(delta_log=True), with the codec available then
+    content = utils_episode_log.to_sequences(saved_info, codec, keyframe_interval=10)
+    return saved_info, content
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'lz4'])
+def test_save_with_other_codec(codec):
+    try:
+        utils_episode_log.get_codec(codec)
+    except ImportError:
+        pytest.skip('{} is not installed'.format(codec))
+    saved_info, content = get_saved_info(codec)
+    with tempfile.TemporaryDirectory() as folder:
+        file_name = os.path.join(folder, 'logs_episode.0_iter.0.pik')
+        utils_episode_log.save_episode_log(content, file_name, codec='zlib')
+        loaded = utils_episode_log.load_episode(file_name)
+    check_loaded(loaded, saved_info)
+
+
+def test_save_lists():
+    saved_info, _ = get_saved_info(None)
+    loaded = utils_episode_log.loads_episode(utils_episode_log.dumps_episode(saved_info, codec='zlib'))
+    assert loaded['graph'][25] == saved_info['graph'][25]
+    check_loaded(loaded, saved_info)
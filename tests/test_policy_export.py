@@ -0,0 +1,96 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import torch
+from gym import spaces
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from models import actor_critic, actor_critic_hl_mcts, policy_export
+from utils import utils_rl_agent
+
+# The compiled policies should act as the eager models in eval mode
+# python -m pytest tests/test_policy_export.py
+
+base_kwargs = {'hidden_size': 128, 'max_nodes': 150, 'num_classes': 100, 'num_states': 4}
+
+
+def get_inputs(model, num_actions, num_visible):
+    inputs, rnn_hxs, masks = policy_export.example_inputs(model, base_kwargs['max_nodes'])
+    inputs['class_objects'] = inputs['class_objects'].int()
+    # Different from the number of objects used to trace
+    inputs['mask_object'][:] = 0.
+    inputs['mask_object'][:, :num_visible] = 1.
+    inputs['mask_action_node'] = inputs['mask_object'].clone()
+    inputs['affordance_matrix'] = torch.ones(1, num_actions, base_kwargs['num_classes'])
+    return inputs, rnn_hxs, masks
+
+
+def check_equivalence(model, num_actions):
+    model.eval()
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'policy.pt')
+        policy_export.export_torchscript(model, path, max_nodes=base_kwargs['max_nodes'])
+        compiled = policy_export.CompiledActorCritic(model, path)
+
+        for num_visible, deterministic in [(30, True), (120, False)]:
+            inputs, rnn_hxs, masks = get_inputs(model, num_actions, num_visible)
+            outputs = []
+            for policy in [model, compiled]:
+                np.random.seed(0)
+                torch.manual_seed(0)
+                with torch.no_grad():
+                    outputs.append(policy.act(inputs, rnn_hxs, masks, deterministic=deterministic))
+            (value, actions, probs, rnn_state, _), (value_c, actions_c, probs_c, rnn_state_c, _) = outputs
+
+            assert torch.allclose(value, value_c, atol=1e-5)
+            for action, action_c in zip(actions, actions_c):
+                assert torch.equal(action, action_c)
+            for prob, prob_c in zip(probs, probs_c):
+                assert torch.allclose(prob, prob_c, atol=1e-5)
+            for state, state_c in zip(rnn_state, rnn_state_c):
+                assert torch.allclose(state, state_c, atol=1e-5)
+
+
+def test_low_level_policy():
+    action_space = spaces.Tuple((spaces.Discrete(10), spaces.Discrete(base_kwargs['num_classes'])))
+    model = actor_critic.ActorCritic(action_space, base_name='TF', base_kwargs=base_kwargs)
+    check_equivalence(model, 10)
+
+
+def test_high_level_policy():
+    action_space = spaces.Tuple((spaces.Discrete(5), spaces.Discrete(4)))
+    model = actor_critic_hl_mcts.ActorCritic(action_space, base_name='TF', base_kwargs=base_kwargs)
+    check_equivalence(model, 5)
+
+
+def test_act_batch():
+    # act_batch (algos/vec_arena.py) should give the actions of act for every agent of the batch
+    action_space = spaces.Tuple((spaces.Discrete(5), spaces.Discrete(4)))
+    model = actor_critic_hl_mcts.ActorCritic(action_space, base_name='TF', base_kwargs=base_kwargs)
+    model.eval()
+    batch = [get_inputs(model, 5, num_visible) for num_visible in [10, 60, 120]]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'policy.pt')
+        policy_export.export_torchscript(model, path, max_nodes=base_kwargs['max_nodes'])
+        compiled = policy_export.CompiledActorCritic(model, path)
+
+        for policy in [model, compiled]:
+            with torch.no_grad():
+                outputs = [policy.act(inputs, rnn_hxs, masks, deterministic=True) for inputs, rnn_hxs, masks in batch]
+                outputs_batch = policy.act_batch(*[utils_rl_agent.cat_batch(list(items)) for items in zip(*batch)],
+                                                 deterministic=True)
+            assert len(outputs_batch) == len(batch)
+            for (value, actions, _, rnn_state, _), (value_b, actions_b, _, rnn_state_b, _) in zip(outputs, outputs_batch):
+                assert torch.allclose(value, value_b, atol=1e-5)
+                for action, action_b in zip(actions, actions_b):
+                    assert torch.equal(action, action_b)
+                for state, state_b in zip(rnn_state, rnn_state_b):
+                    assert torch.allclose(state, state_b, atol=1e-5)
+
+
+if __name__ == '__main__':
+    test_low_level_policy()
+    test_high_level_policy()
+    test_act_batch()
+    print("Compiled policies match the eager models")
@@ -53,6 +53,7 @@ import copy
 from agents import MCTS_agent, HRL_agent
 from arguments import get_args
 from algos.arena_mp2 import ArenaMP
+from algos.vec_arena import VecArena
 from algos.a2c import A2C
 from algos.a2c_mp import A2C as A2C_MP
 from utils import utils_goals, utils_rl_agent
@@ -219,6 +220,10 @@ if __name__ == '__main__':
         ArenaMP = ray.remote(ArenaMP) #, max_reconstructions=ray.ray_constants.INFINITE_RECONSTRUCTION)
         arenas = [ArenaMP.remote(args.max_number_steps, arena_id, env_fn, agents) for arena_id in range(args.num_processes)]
         a2c = A2C_MP(arenas, graph_helper, args)
+    elif args.num_envs > 1:
+        # The episodes of all the environments run in this process, with a batched policy
+        arenas = [VecArena(args.max_number_steps, env_fn, agents, args.num_envs)]
+        a2c = A2C_MP(arenas, graph_helper, args)
     else:
         arenas = [ArenaMP(args.max_number_steps, arena_id, env_fn, agents) for arena_id in range(args.num_processes)]
         a2c = A2C_MP(arenas, graph_helper, args)
@@ -1,4 +1,10 @@
+import os
+import contextlib
+import torch
 import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from random import Random
 
 """ Dataset partitioning helper """
@@ -38,26 +44,78 @@ class DataPartitioner(object):
 
 def get_partition(dataset, bs, shuffle=True):
     size = dist.get_world_size()
-    bsz = bs / float(size)
+    bsz = max(1, bs // size)
     partition_sizes = [1.0 / size for _ in range(size)]
     partition = DataPartitioner(dataset, partition_sizes)
     partition = partition.use(dist.get_rank())
     dataset = torch.utils.data.DataLoader(partition, batch_size=bsz, shuffle=shuffle)
     return dataset, bsz
 
-""" Gradient averaging. """
+""" Gradient averaging. DistributedDataParallel does this during backward, use distributed_model instead """
 def average_gradients(model):
     size = float(dist.get_world_size())
     for param in model.parameters():
+        if param.grad is None:
+            continue
         dist.all_reduce(param.grad.data, op=dist.ReduceOp.SUM)
         param.grad.data /= size
 
-def init_process(rank, size, fn, backend='gloo'):
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    """Logging and checkpoints are done by rank 0 only"""
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def get_sampler(dataset, shuffle=True):
+    """Sampler giving every process a different part of the dataset, None when not distributed"""
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle)
+
+def distributed_model(model, find_unused_parameters=True):
+    """
+    Wraps the model with DistributedDataParallel. Gradients are all-reduced in buckets as soon as
+    they are computed, overlapping the communication with the rest of backward.
+    The models have heads that do not contribute to every loss, hence find_unused_parameters.
+    Buffers are not broadcast, so that rank 0 can run evaluation alone.
+    """
+    return DistributedDataParallel(model, find_unused_parameters=find_unused_parameters, broadcast_buffers=False)
+
+def join(model, enable=True):
+    """
+    Context for a training loop where the processes may run a different number of batches.
+    Processes that finish early keep joining the gradient all-reduce of the others, instead of hanging them.
+    """
+    if isinstance(model, DistributedDataParallel):
+        return model.join(enable=enable)
+    return contextlib.nullcontext()
+
+def init_process(rank, size, fn, backend='gloo', fn_args=()):
     """ Initialize the distributed environment. """
-    os.environ['MASTER_ADDR'] = '127.0.0.1'
-    os.environ['MASTER_PORT'] = '29500'
+    os.environ['MASTER_ADDR'] = os.environ.get('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = os.environ.get('MASTER_PORT', '29500')
     dist.init_process_group(backend, rank=rank, world_size=size)
-    fn(rank, size)
+    # Split the cores across the processes
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // size))
+    try:
+        fn(rank, size, *fn_args)
+    finally:
+        cleanup()
+
+def launch(fn, size, fn_args=(), backend='gloo'):
+    """ Runs fn(rank, size, *fn_args) in size processes """
+    mp.spawn(init_process, args=(size, fn, backend, fn_args), nprocs=size, join=True)
 
 def cleanup():
     dist.destroy_process_group()
@@ -1,6 +1,8 @@
 import ipdb
 import copy
 import random
+from collections import OrderedDict
+from utils import utils_graph
 
 def clean_house_obj(graph):
     house_obj = ['window', 'door', 'floor', 'ceiling', 'wall']
@@ -147,6 +149,8 @@ def separate_new_ids_graph(graph, max_id):
 
 def check_progress(state, goal_spec):
     """TODO: add more predicate checkers; currently only ON"""
+    if utils_graph.is_compact(state):
+        return check_progress_compact(state, goal_spec)
     unsatisfied = {}
     satisfied = {}
     reward = 0.
@@ -205,3 +209,199 @@ def check_progress(state, goal_spec):
                     satisfied[key].append(predicate)
                     unsatisfied[key] -= 1
     return satisfied, unsatisfied
+
+def check_progress_compact(graph, goal_spec):
+    """Same as check_progress, but only visiting the edges of the goal nodes of a CompactGraph"""
+    unsatisfied = {}
+    satisfied = {}
+    for key, value in goal_spec.items():
+        elements = key.split('_')
+        unsatisfied[key] = value[0] if elements[0] not in ['offOn', 'offInside'] else 0
+        satisfied[key] = []
+
+        # (edge index, satisfied predicate, change in unsatisfied), sorted by edge to match check_progress
+        matches = []
+        if elements[0] in 'close':
+            for edge_index in graph.edge_indices(int(elements[2]), lambda rel: rel.lower().startswith('close')):
+                _, _, to_id = graph.edge_tuple(edge_index)
+                if graph.node(to_id)['class_name'] == elements[1]:
+                    matches.append((edge_index, '{}_{}_{}'.format(elements[0], to_id, elements[2]), -1))
+        if elements[0] in ['on', 'inside', 'offOn', 'offInside']:
+            relation = {'on': 'on', 'inside': 'inside', 'offOn': 'on', 'offInside': 'inside'}[elements[0]]
+            for edge_index in graph.edge_indices(int(elements[2]), lambda rel: rel.lower() == relation, reverse=True):
+                from_id, _, _ = graph.edge_tuple(edge_index)
+                if graph.node(from_id)['class_name'] == elements[1] or str(from_id) == elements[1]:
+                    if elements[0] in ['on', 'inside']:
+                        matches.append((edge_index, '{}_{}_{}'.format(elements[0], from_id, elements[2]), -1))
+                    else:
+                        matches.append((edge_index, None, 1))
+        elif elements[0] == 'holds':
+            for edge_index in graph.edge_indices(int(elements[2]), lambda rel: rel.lower().startswith('holds')):
+                _, _, to_id = graph.edge_tuple(edge_index)
+                if graph.node(to_id)['class_name'] == elements[1]:
+                    matches.append((edge_index, '{}_{}_{}'.format(elements[0], to_id, elements[2]), -1))
+        elif elements[0] == 'sit':
+            for edge_index in graph.edge_indices(int(elements[1]), lambda rel: rel.lower().startswith('sit')):
+                _, _, to_id = graph.edge_tuple(edge_index)
+                if to_id == int(elements[2]):
+                    matches.append((edge_index, '{}_{}_{}'.format(elements[0], to_id, elements[2]), -1))
+
+        for _, predicate, increment in sorted(matches, key=lambda match: match[0]):
+            if predicate is not None:
+                satisfied[key].append(predicate)
+            unsatisfied[key] += increment
+
+        if elements[0] == 'turnOn':
+            if 'ON' in graph.node(int(elements[1]))['states']:
+                predicate = '{}_{}_{}'.format(elements[0], elements[1], 1)
+                satisfied[key].append(predicate)
+                unsatisfied[key] -= 1
+        if elements[0] == 'touch':
+            for id_touch in graph.class2id[elements[1]]:
+                if 'TOUCHED' in [st.upper() for st in graph.node(id_touch)['states']]:
+                    predicate = '{}_{}_{}'.format(elements[0], id_touch, 1)
+                    satisfied[key].append(predicate)
+                    unsatisfied[key] -= 1
+    return satisfied, unsatisfied
+
+
+def edge_key(edge):
+    return (edge['from_id'], edge['relation_type'], edge['to_id'])
+
+def graph_delta(prev_graph, graph):
+    """
+    Difference between two graphs, so that apply_graph_delta(prev_graph, delta) == graph, edge order included
+    (the heuristics take the first matching edge). The added edges keep their index in the new edge list,
+    and if the edges that stay were reordered the whole edge list is sent.
+    """
+    prev_id2node = {node['id']: node for node in prev_graph['nodes']}
+    node_ids = [node['id'] for node in graph['nodes']]
+    changed_nodes = [node for node in graph['nodes'] if prev_id2node.get(node['id']) != node]
+
+    prev_edges = [edge_key(edge) for edge in prev_graph['edges']]
+    curr_edges = [edge_key(edge) for edge in graph['edges']]
+    prev_edges_set, curr_edges_set = set(prev_edges), set(curr_edges)
+    delta = {
+        'node_ids': node_ids,
+        'changed_nodes': changed_nodes
+    }
+    kept_prev = [edge for edge in prev_edges if edge in curr_edges_set]
+    kept_curr = [edge for edge in curr_edges if edge in prev_edges_set]
+    if kept_prev != kept_curr:
+        delta['edges'] = curr_edges
+    else:
+        delta['added_edges'] = [(index, edge) for index, edge in enumerate(curr_edges) if edge not in prev_edges_set]
+        delta['removed_edges'] = [edge for edge in prev_edges if edge not in curr_edges_set]
+    return delta
+
+def apply_graph_delta(prev_graph, delta):
+    id2node = {node['id']: node for node in prev_graph['nodes']}
+    for node in delta['changed_nodes']:
+        id2node[node['id']] = node
+    if 'edges' in delta:
+        edges = [{'from_id': from_id, 'relation_type': rel, 'to_id': to_id} for from_id, rel, to_id in delta['edges']]
+    else:
+        removed_edges = set(delta['removed_edges'])
+        edges = [edge for edge in prev_graph['edges'] if edge_key(edge) not in removed_edges]
+        # In increasing index, every edge goes to its position in the new list
+        for index, (from_id, rel, to_id) in delta['added_edges']:
+            edges.insert(index, {'from_id': from_id, 'relation_type': rel, 'to_id': to_id})
+    return {
+        'nodes': [id2node[node_id] for node_id in delta['node_ids']],
+        'edges': edges
+    }
+
+class HeuristicCache():
+    """
+    Memoizes the heuristics (find, grab, put, putIn, turnOn, sit, touch). Their plan only depends on
+    the targets, the containment chain of the targets (and of whoever holds them), with the open/closed
+    state of the containers and whether the agent is next to them, the agent room and the agent hands.
+    The key is built from those, so entries stay valid until one of them changes.
+    Holds at most max_size plans, evicted in LRU order.
+    """
+    def __init__(self, agent_id, char_index, max_size=100000):
+        self.agent_id = agent_id
+        self.char_index = char_index
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._graph_key = None
+        self._graph_info = None
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits * 1. / total if total > 0 else 0.
+
+    def _index_graph(self, graph):
+        # Many subgoals are evaluated on the same state, index it once. The graphs may be modified
+        # in place, so the state is identified by its content
+        edges = utils_graph.get_edges(graph)
+        graph_key = (tuple(edges), tuple([(node['id'], tuple(node['states'])) for node in graph['nodes']]))
+        if self._graph_key == graph_key:
+            return self._graph_info
+        inside, agent_rel, close_agent, holders, hands, on_edges = {}, {}, set(), {}, [], set()
+        for from_id, rel, to_id in edges:
+            if rel == 'INSIDE':
+                inside.setdefault(from_id, []).append(to_id)
+            elif rel == 'ON':
+                on_edges.add((from_id, to_id))
+            if from_id == self.agent_id:
+                agent_rel.setdefault(to_id, set()).add(rel)
+                if 'HOLDS' in rel:
+                    hands.append(to_id)
+            elif 'HOLD' in rel:
+                holders.setdefault(to_id, []).append((from_id, rel))
+            if to_id == self.agent_id and rel == 'CLOSE':
+                close_agent.add(from_id)
+        self._graph_key = graph_key
+        self._graph_info = {
+            'id2node': utils_graph.get_id2node(graph),
+            'inside': inside, 'agent_rel': agent_rel, 'close_agent': close_agent,
+            'holders': holders, 'hands': tuple(hands), 'on_edges': on_edges
+        }
+        return self._graph_info
+
+    def key(self, unsatisfied, graph, subgoal):
+        info = self._index_graph(graph)
+        id2node, inside = info['id2node'], info['inside']
+        targets = [int(x) for x in subgoal.split('_')[1:] if x.isdigit()]
+        holders = tuple([holder for target in targets for holder in info['holders'].get(target, [])])
+
+        # Containment chain of the targets and holders, up to the rooms
+        chain = []
+        visited = set()
+        curr_ids = targets + [holder_id for holder_id, _ in holders]
+        while len(curr_ids) > 0:
+            next_ids = []
+            for node_id in curr_ids:
+                if node_id in visited:
+                    continue
+                visited.add(node_id)
+                states = id2node[node_id]['states'] if node_id in id2node else []
+                chain.append((
+                    node_id, tuple(inside.get(node_id, [])), 'OPEN' in states, 'CLOSED' in states,
+                    tuple(sorted(info['agent_rel'].get(node_id, []))), node_id in info['close_agent']))
+                next_ids += inside.get(node_id, [])
+            curr_ids = next_ids
+
+        other = None
+        if len(targets) == 2:
+            other = (tuple(targets) in info['on_edges'],
+                     sum([count for predicate, count in unsatisfied.items() if predicate.startswith('inside')]) == 1)
+        return (subgoal, tuple(inside.get(self.agent_id, [])), info['hands'], holders, tuple(chain), other)
+
+    def get_actions(self, heuristic, unsatisfied, graph, simulator, subgoal):
+        key = self.key(unsatisfied, graph, subgoal)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        else:
+            self.misses += 1
+            self.cache[key] = heuristic(self.agent_id, self.char_index, unsatisfied, graph, simulator, subgoal)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        actions, costs = self.cache[key]
+        if actions is None:
+            return None, None
+        return list(actions), list(costs)
@@ -0,0 +1,332 @@
+import bisect
+import pickle
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compact format for the episode logs saved by ArenaMP.run. Consecutive graphs and beliefs of an
+# episode differ in a few nodes and edges, so every sequence (the graphs, and the beliefs of every agent)
+# stores a full keyframe every keyframe_interval steps and the changes with respect to the previous
+# step otherwise. Every step is compressed on its own, so that step t can be rebuilt from its keyframe
+# without decompressing the rest of the episode.
+#
+# load_episode reads both these logs and the pickles of saved_info. The sequences of a log are
+# DeltaSequence objects, which can be indexed, sliced and iterated like the lists of saved_info.
+# Rebuilt graphs share the nodes that did not change, copy them before modifying them.
+
+MAGIC = b'VHEPLOG\x01'
+LOG_VERSION = 1
+
+# Fields of saved_info stored as sequences, either a list or a dict of lists (one per agent)
+sequence_fields = {
+    'graph': 'graph',
+    'belief_graph': 'graph',
+    'belief': 'dict',
+    'belief_room': 'dict'
+}
+
+
+class Codec():
+    def __init__(self, name, level=None):
+        self.name = name
+        if name == 'zstd':
+            if zstandard is None:
+                raise ImportError('zstandard is needed to read this episode log')
+            self.compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+            self.decompressor = zstandard.ZstdDecompressor()
+        elif name == 'lz4':
+            if lz4 is None:
+                raise ImportError('lz4 is needed to read this episode log')
+        elif name != 'zlib':
+            raise Exception('Unknown codec {}'.format(name))
+        self.level = level
+
+    def compress(self, data):
+        if self.name == 'zstd':
+            return self.compressor.compress(data)
+        if self.name == 'lz4':
+            return lz4.frame.compress(data)
+        return zlib.compress(data, 1 if self.level is None else self.level)
+
+    def decompress(self, data):
+        if self.name == 'zstd':
+            return self.decompressor.decompress(data)
+        if self.name == 'lz4':
+            return lz4.frame.decompress(data)
+        return zlib.decompress(data)
+
+def get_codec(name=None):
+    """Fastest available codec if name is None"""
+    if name is None:
+        name = 'zstd' if zstandard is not None else ('lz4' if lz4 is not None else 'zlib')
+    return Codec(name)
+
+
+def is_equal(value1, value2):
+    """Equality of nested dicts and lists with numpy arrays"""
+    if isinstance(value1, np.ndarray) or isinstance(value2, np.ndarray):
+        return (isinstance(value1, np.ndarray) and isinstance(value2, np.ndarray) and
+                value1.dtype == value2.dtype and np.array_equal(value1, value2))
+    if isinstance(value1, dict):
+        if not isinstance(value2, dict) or list(value1.keys()) != list(value2.keys()):
+            return False
+        return all(is_equal(value1[key], value2[key]) for key in value1)
+    if isinstance(value1, (list, tuple)):
+        if type(value1) != type(value2) or len(value1) != len(value2):
+            return False
+        return all(is_equal(elem1, elem2) for elem1, elem2 in zip(value1, value2))
+    return type(value1) == type(value2) and value1 == value2
+
+
+def dict_delta(prev, curr):
+    """Entries of curr that changed with respect to prev, e.g. the nodes of edge_belief updated in a step"""
+    changed = {key: value for key, value in curr.items() if key not in prev or not is_equal(prev[key], value)}
+    removed = [key for key in prev if key not in curr]
+    delta = {'changed': changed, 'removed': removed}
+    if list(apply_dict_delta(prev, delta).keys()) != list(curr.keys()):
+        delta['order'] = list(curr.keys())
+    return delta
+
+def apply_dict_delta(prev, delta):
+    removed = set(delta['removed'])
+    curr = {key: delta['changed'].get(key, value) for key, value in prev.items() if key not in removed}
+    for key, value in delta['changed'].items():
+        if key not in curr:
+            curr[key] = value
+    if 'order' in delta:
+        curr = {key: curr[key] for key in delta['order']}
+    return curr
+
+
+def edge_key(edge):
+    return (edge['from_id'], edge['relation_type'], edge['to_id'])
+
+def graph_delta(prev, curr):
+    """Nodes that changed, nodes removed, and edges added and removed between two graphs"""
+    prev_nodes = {node['id']: node for node in prev['nodes']}
+    curr_ids = set(node['id'] for node in curr['nodes'])
+    delta = {
+        'changed_nodes': [node for node in curr['nodes'] if node['id'] not in prev_nodes or prev_nodes[node['id']] != node],
+        'removed_nodes': [node_id for node_id in prev_nodes if node_id not in curr_ids]
+    }
+
+    prev_edges = set(edge_key(edge) for edge in prev['edges'])
+    curr_edges = set(edge_key(edge) for edge in curr['edges'])
+    delta['added_edges'] = [edge for edge in curr['edges'] if edge_key(edge) not in prev_edges]
+    delta['removed_edges'] = [edge_key(edge) for edge in prev['edges'] if edge_key(edge) not in curr_edges]
+
+    other_keys = [key for key in curr if key not in ['nodes', 'edges']]
+    delta['other'] = {key: curr[key] for key in other_keys if key not in prev or prev[key] != curr[key]}
+
+    # The graphs are stored exactly, if the nodes or edges were reordered keep the new order
+    rebuilt = apply_graph_delta(prev, delta)
+    if [node['id'] for node in rebuilt['nodes']] != [node['id'] for node in curr['nodes']]:
+        delta['node_order'] = [node['id'] for node in curr['nodes']]
+    if rebuilt['edges'] != curr['edges']:
+        delta['edges'] = curr['edges']
+        delta['added_edges'], delta['removed_edges'] = [], []
+    if list(rebuilt.keys()) != list(curr.keys()):
+        delta['key_order'] = list(curr.keys())
+    return delta
+
+def apply_graph_delta(prev, delta):
+    changed = {node['id']: node for node in delta['changed_nodes']}
+    removed = set(delta['removed_nodes'])
+    nodes = [changed.pop(node['id'], node) for node in prev['nodes'] if node['id'] not in removed]
+    nodes += list(changed.values())
+    if 'node_order' in delta:
+        id2node = {node['id']: node for node in nodes}
+        nodes = [id2node[node_id] for node_id in delta['node_order']]
+
+    if 'edges' in delta:
+        edges = delta['edges']
+    else:
+        removed_edges = set(delta['removed_edges'])
+        edges = [edge for edge in prev['edges'] if edge_key(edge) not in removed_edges] + delta['added_edges']
+
+    curr = {key: value for key, value in prev.items() if key not in ['nodes', 'edges']}
+    curr.update({'nodes': nodes, 'edges': edges})
+    curr.update(delta['other'])
+    if 'key_order' in delta:
+        curr = {key: curr[key] for key in delta['key_order']}
+    return curr
+
+
+class DeltaSequence():
+    """
+    List of graphs (kind 'graph') or dicts (kind 'dict') stored as compressed keyframes and deltas.
+    Supports append, len, indexing, slicing and iteration. Iterating, or reading the steps in order,
+    only applies one delta per step.
+    """
+    def __init__(self, kind, codec=None, keyframe_interval=25):
+        assert kind in ['graph', 'dict']
+        self.kind = kind
+        self.codec = codec if isinstance(codec, Codec) else get_codec(codec)
+        self.keyframe_interval = keyframe_interval
+        self.entries = []
+        self.keyframes = []
+        self.last = None
+        self.cache = None
+
+    def get_delta(self, prev, curr):
+        return graph_delta(prev, curr) if self.kind == 'graph' else dict_delta(prev, curr)
+
+    def apply_delta(self, prev, delta):
+        return apply_graph_delta(prev, delta) if self.kind == 'graph' else apply_dict_delta(prev, delta)
+
+    def can_delta(self, value):
+        if self.kind == 'graph':
+            return isinstance(value, dict) and 'nodes' in value and 'edges' in value
+        return isinstance(value, dict)
+
+    def append(self, value):
+        step = len(self.entries)
+        if self.last is None and step > 0:
+            self.last = self.get(step - 1)
+        # Values of another type are stored whole
+        if (self.last is None or step - self.keyframes[-1] >= self.keyframe_interval or
+                not self.can_delta(self.last) or not self.can_delta(value)):
+            self.keyframes.append(step)
+            entry = value
+        else:
+            entry = self.get_delta(self.last, value)
+        self.entries.append(self.codec.compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.last = value
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, step):
+        if step < 0:
+            step += len(self.entries)
+        if step < 0 or step >= len(self.entries):
+            raise IndexError('Step {} out of range, the sequence has {} steps'.format(step, len(self.entries)))
+        keyframe = self.keyframes[bisect.bisect_right(self.keyframes, step) - 1]
+        if self.cache is not None and keyframe <= self.cache[0] <= step:
+            start, value = self.cache
+        else:
+            start, value = keyframe, self.decode(keyframe)
+        for it in range(start + 1, step + 1):
+            value = self.apply_delta(value, self.decode(it))
+        self.cache = (step, value)
+        return value
+
+    def decode(self, step):
+        return pickle.loads(self.codec.decompress(self.entries[step]))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get(step) for step in range(*index.indices(len(self)))]
+        return self.get(index)
+
+    def __iter__(self):
+        for step in range(len(self)):
+            yield self.get(step)
+
+    def get_state(self):
+        # The sequences of saved_info may have been built with another codec than the one of the log
+        return {'kind': self.kind, 'codec': self.codec.name, 'keyframe_interval': self.keyframe_interval,
+                'keyframes': self.keyframes, 'entries': self.entries}
+
+    @classmethod
+    def from_state(cls, state, codec=None):
+        """codec is used for states that do not record theirs"""
+        sequence = cls(state['kind'], state.get('codec', codec), state['keyframe_interval'])
+        sequence.keyframes = state['keyframes']
+        sequence.entries = state['entries']
+        return sequence
+
+
+def new_sequence(field, values=(), codec=None, keyframe_interval=25):
+    """DeltaSequence for a field of saved_info"""
+    sequence = DeltaSequence(sequence_fields[field], codec, keyframe_interval)
+    sequence.extend(values)
+    return sequence
+
+def to_sequences(saved_info, codec=None, keyframe_interval=25):
+    """Copy of saved_info with the lists of sequence_fields converted to DeltaSequence"""
+    content = dict(saved_info)
+    for field in sequence_fields:
+        value = content.get(field, None)
+        if isinstance(value, list):
+            content[field] = new_sequence(field, value, codec, keyframe_interval)
+        elif isinstance(value, dict):
+            content[field] = {key: (new_sequence(field, values, codec, keyframe_interval) if isinstance(values, list) else values)
+                              for key, values in value.items()}
+    return content
+
+def to_dict(content):
+    """saved_info with plain lists, e.g. to dump it as json"""
+    saved_info = dict(content)
+    for field, value in saved_info.items():
+        if isinstance(value, DeltaSequence):
+            saved_info[field] = list(value)
+        elif field in sequence_fields and isinstance(value, dict):
+            saved_info[field] = {key: (list(values) if isinstance(values, DeltaSequence) else values) for key, values in value.items()}
+    return saved_info
+
+
+def dumps_episode(saved_info, codec=None, keyframe_interval=25):
+    codec = get_codec(codec)
+    content = to_sequences(saved_info, codec, keyframe_interval)
+    fields, sequences = {}, {}
+    for field, value in content.items():
+        if isinstance(value, DeltaSequence):
+            sequences[(field,)] = value.get_state()
+        elif field in sequence_fields and isinstance(value, dict) and any(isinstance(values, DeltaSequence) for values in value.values()):
+            fields[field] = {key: values for key, values in value.items() if not isinstance(values, DeltaSequence)}
+            for key, values in value.items():
+                if isinstance(values, DeltaSequence):
+                    sequences[(field, key)] = values.get_state()
+        else:
+            fields[field] = value
+
+    data = {
+        'version': LOG_VERSION,
+        'codec': codec.name,
+        'fields': codec.compress(pickle.dumps(fields, protocol=pickle.HIGHEST_PROTOCOL)),
+        'sequences': sequences
+    }
+    return MAGIC + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+def save_episode_log(saved_info, file_name, codec=None, keyframe_interval=25):
+    """Saves saved_info (with lists or DeltaSequence) in the episode log format"""
+    data = dumps_episode(saved_info, codec, keyframe_interval)
+    with open(file_name, 'wb') as f:
+        f.write(data)
+
+
+def is_episode_log(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def loads_episode(data):
+    """Content of an episode, from the bytes of an episode log or of a saved_info pickle"""
+    if not is_episode_log(data):
+        return pickle.loads(data)
+    data = pickle.loads(data[len(MAGIC):])
+    assert data['version'] == LOG_VERSION, 'Episode log version {}'.format(data['version'])
+    codec = get_codec(data['codec'])
+    content = pickle.loads(codec.decompress(data['fields']))
+    for path, state in data['sequences'].items():
+        sequence = DeltaSequence.from_state(state, codec)
+        if len(path) == 1:
+            content[path[0]] = sequence
+        else:
+            content.setdefault(path[0], {})[path[1]] = sequence
+    return content
+
+def load_episode(file_name):
+    with open(file_name, 'rb') as f:
+        return loads_episode(f.read())
@@ -1,3 +1,6 @@
+import copy
+
+
 def convert_goal_spec(task_name, goal, state, exclude=[]):
     """
     Convert the task goal into a format interpreted by the planner and model
@@ -50,3 +53,157 @@ def convert_goal_spec(task_name, goal, state, exclude=[]):
             goals[predicate] = count
 
     return goals
+
+
+class GoalProgressTracker():
+    """
+    Progress of a goal spec, updated incrementally from the edges and nodes changed by a transition.
+    The goal spec is parsed once into typed predicates, indexed by the node they are anchored to,
+    so that updating the progress costs O(changed edges) instead of O(goals x edges).
+
+    progress() matches utils_environment.check_progress and reward() matches MCTS_particles_v2.check_progress.
+    """
+    def __init__(self, goal_spec, graph):
+        self.goal_spec = goal_spec
+        self.id2class = {node['id']: node['class_name'] for node in graph['nodes']}
+        class2id = {}
+        for node in graph['nodes']:
+            if node['class_name'] not in class2id:
+                class2id[node['class_name']] = []
+            class2id[node['class_name']].append(node['id'])
+
+        # Edge predicates, indexed by (anchor side, anchor id)
+        self.edge_predicates = {}
+        # Node predicates, indexed by node id
+        self.node_predicates = {}
+        self.unsatisfied_init = {}
+        self.reward_init = 0
+        for key, value in goal_spec.items():
+            elements = key.split('_')
+            self.unsatisfied_init[key] = value[0] if elements[0] not in ['offOn', 'offInside'] else 0
+            if key.startswith('off'):
+                # As in MCTS_particles_v2.check_progress
+                self.reward_init += value
+            for predicate in self._parse_predicate(key, elements, class2id):
+                if predicate['type'] == 'node':
+                    for node_id in predicate['node_ids']:
+                        self.node_predicates.setdefault(node_id, []).append(predicate)
+                else:
+                    self.edge_predicates.setdefault((predicate['anchor'], predicate['anchor_id']), []).append(predicate)
+
+        # Matches of every predicate: key -> {item: satisfied predicate}. Dicts keep insertion order
+        self.matches = {key: {} for key in goal_spec}
+        self.num_reward = 0
+        id2node = {node['id']: node for node in graph['nodes']}
+        for edge in graph['edges']:
+            self._update_edge((edge['from_id'], edge['relation_type'], edge['to_id']), 1)
+        for node_id, predicates in self.node_predicates.items():
+            if node_id in id2node:
+                self._update_node(id2node[node_id], predicates)
+
+    def _parse_predicate(self, key, elements, class2id):
+        def matches_obj(obj):
+            return lambda node_id: self.id2class.get(node_id) == obj or str(node_id) == obj
+
+        def matches_class(class_name):
+            return lambda node_id: self.id2class.get(node_id) == class_name
+
+        def matches_id(obj_id):
+            return lambda node_id: node_id == obj_id
+
+        # anchor: which side of the edge is fixed by the predicate, other: condition on the other side
+        # unsatisfied and reward: how a match changes the progress and the reward
+        predicates = []
+        name = elements[0]
+        if name in 'close':
+            predicates.append({'type': 'edge', 'key': key, 'relation': lambda rel: rel.lower().startswith('close'),
+                               'anchor': 'from', 'anchor_id': int(elements[2]), 'other': matches_class(elements[1]),
+                               'satisfied': True, 'unsatisfied': -1, 'reward': 0})
+        if name in ['on', 'inside', 'offOn', 'offInside']:
+            relation = {'on': 'on', 'inside': 'inside', 'offOn': 'on', 'offInside': 'inside'}[name]
+            predicates.append({'type': 'edge', 'key': key, 'relation': lambda rel: rel.lower() == relation,
+                               'anchor': 'to', 'anchor_id': int(elements[2]), 'other': matches_obj(elements[1]),
+                               'satisfied': name in ['on', 'inside'],
+                               'unsatisfied': -1 if name in ['on', 'inside'] else 1,
+                               'reward': {'on': 1, 'inside': 1, 'offOn': -1, 'offInside': 0}[name]})
+        elif name == 'holds':
+            predicates.append({'type': 'edge', 'key': key, 'relation': lambda rel: rel.lower().startswith('holds'),
+                               'anchor': 'from', 'anchor_id': int(elements[2]), 'other': matches_class(elements[1]),
+                               'satisfied': True, 'unsatisfied': -1, 'reward': 1})
+        elif name == 'sit':
+            # The progress counts SITTING relations, the planner reward counts ON relations
+            predicates.append({'type': 'edge', 'key': key, 'relation': lambda rel: rel.lower().startswith('sit'),
+                               'anchor': 'from', 'anchor_id': int(elements[1]), 'other': matches_id(int(elements[2])),
+                               'satisfied': True, 'unsatisfied': -1, 'reward': 0})
+            predicates.append({'type': 'edge', 'key': key, 'relation': lambda rel: rel.lower().startswith('on'),
+                               'anchor': 'from', 'anchor_id': int(elements[1]), 'other': matches_id(int(elements[2])),
+                               'satisfied': False, 'unsatisfied': 0, 'reward': 1})
+        if name == 'turnOn':
+            predicates.append({'type': 'node', 'key': key, 'node_ids': [int(elements[1])],
+                               'state': lambda states: 'ON' in states})
+        if name == 'touch':
+            predicates.append({'type': 'node', 'key': key, 'node_ids': class2id[elements[1]],
+                               'state': lambda states: 'TOUCHED' in [st.upper() for st in states]})
+        return predicates
+
+    def _update_edge(self, edge, sign):
+        from_id, relation, to_id = edge
+        for anchor, anchor_id, other_id in [('from', from_id, to_id), ('to', to_id, from_id)]:
+            for predicate in self.edge_predicates.get((anchor, anchor_id), []):
+                if not predicate['relation'](relation) or not predicate['other'](other_id):
+                    continue
+                item = (id(predicate), edge)
+                matches = self.matches[predicate['key']]
+                if sign > 0 and item not in matches:
+                    satisfied = None
+                    if predicate['satisfied']:
+                        elements = predicate['key'].split('_')
+                        satisfied = '{}_{}_{}'.format(elements[0], other_id, elements[2])
+                    matches[item] = (satisfied, predicate['unsatisfied'])
+                    self.num_reward += predicate['reward']
+                elif sign < 0 and item in matches:
+                    del matches[item]
+                    self.num_reward -= predicate['reward']
+
+    def _update_node(self, node, predicates):
+        for predicate in predicates:
+            item = (id(predicate), node['id'])
+            matches = self.matches[predicate['key']]
+            is_satisfied = predicate['state'](node['states'])
+            if is_satisfied and item not in matches:
+                elements = predicate['key'].split('_')
+                if elements[0] == 'turnOn':
+                    satisfied = '{}_{}_{}'.format(elements[0], elements[1], 1)
+                else:
+                    satisfied = '{}_{}_{}'.format(elements[0], node['id'], 1)
+                matches[item] = (satisfied, -1)
+                self.num_reward += 1
+            elif not is_satisfied and item in matches:
+                del matches[item]
+                self.num_reward -= 1
+
+    def child(self, added_edges=(), removed_edges=(), changed_nodes=()):
+        """
+        New tracker after a transition, this tracker is not modified.
+        Edges are (from_id, relation_type, to_id) tuples, changed nodes are node dicts.
+        """
+        new_tracker = copy.copy(self)
+        new_tracker.matches = {key: dict(matches) for key, matches in self.matches.items()}
+        for edge in removed_edges:
+            new_tracker._update_edge(tuple(edge), -1)
+        for edge in added_edges:
+            new_tracker._update_edge(tuple(edge), 1)
+        for node in changed_nodes:
+            if node['id'] in new_tracker.node_predicates:
+                new_tracker._update_node(node, new_tracker.node_predicates[node['id']])
+        return new_tracker
+
+    def progress(self):
+        satisfied, unsatisfied = {}, {}
+        for key, matches in self.matches.items():
+            satisfied[key] = [match[0] for match in matches.values() if match[0] is not None]
+            unsatisfied[key] = self.unsatisfied_init[key] + sum([match[1] for match in matches.values()])
+        return satisfied, unsatisfied
+
+    def reward(self):
+        return self.reward_init + self.num_reward
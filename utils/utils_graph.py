@@ -0,0 +1,245 @@
+import numpy as np
+
+
+class CompactGraph():
+    """
+    Array based version of the {'nodes': [...], 'edges': [...]} graphs.
+    Nodes are stored in a table indexed by integers, edges as (from, rel, to) arrays of node indices,
+    and adjacency is kept in CSR format per relation type, so that the edges of a node can be found
+    in O(degree) instead of scanning all the edges.
+
+    graph['nodes'] and graph['edges'] are still available, so code reading the dict format keeps working.
+    """
+    def __init__(self, nodes, edge_from, edge_rel, edge_to, relations, extra_ids=()):
+        self.nodes = list(nodes)
+        self.node_ids = np.array([node['id'] for node in self.nodes] + list(extra_ids), dtype=np.int64)
+        # Edges may point to nodes that are not in the graph, they get an index but no node
+        self._index_nodes = self.nodes + [None] * len(extra_ids)
+        self.id2index = {node_id: it for it, node_id in enumerate(self.node_ids.tolist())}
+
+        self.relations = list(relations)
+        self.rel2index = {rel: it for it, rel in enumerate(self.relations)}
+        self.edge_from = np.asarray(edge_from, dtype=np.int64)
+        self.edge_rel = np.asarray(edge_rel, dtype=np.int64)
+        self.edge_to = np.asarray(edge_to, dtype=np.int64)
+
+        self._csr = {}
+        self._parents = {}
+        self._state_masks = {}
+        self._edges = None
+        self._id2node = None
+        self._class2id = None
+
+    @classmethod
+    def from_dict(cls, graph):
+        return cls.from_edge_tuples(
+            graph['nodes'],
+            [(edge['from_id'], edge['relation_type'], edge['to_id']) for edge in graph['edges']])
+
+    @classmethod
+    def from_edge_tuples(cls, nodes, edge_tuples):
+        id2index = {}
+        for it, node in enumerate(nodes):
+            id2index[node['id']] = it
+        extra_ids = []
+        rel2index = {}
+        edge_from, edge_rel, edge_to = [], [], []
+        for from_id, rel, to_id in edge_tuples:
+            for node_id in (from_id, to_id):
+                if node_id not in id2index:
+                    id2index[node_id] = len(id2index)
+                    extra_ids.append(node_id)
+            if rel not in rel2index:
+                rel2index[rel] = len(rel2index)
+            edge_from.append(id2index[from_id])
+            edge_rel.append(rel2index[rel])
+            edge_to.append(id2index[to_id])
+        return cls(nodes, edge_from, edge_rel, edge_to, list(rel2index.keys()), extra_ids)
+
+    def to_dict(self):
+        return {'nodes': list(self.nodes), 'edges': list(self.edges)}
+
+    @property
+    def edges(self):
+        if self._edges is None:
+            node_ids = self.node_ids
+            self._edges = [
+                {'from_id': int(node_ids[from_index]), 'relation_type': self.relations[rel], 'to_id': int(node_ids[to_index])}
+                for from_index, rel, to_index in zip(self.edge_from.tolist(), self.edge_rel.tolist(), self.edge_to.tolist())]
+        return self._edges
+
+    def __getitem__(self, key):
+        if key == 'nodes':
+            return self.nodes
+        elif key == 'edges':
+            return self.edges
+        raise KeyError(key)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_from)
+
+    @property
+    def id2node(self):
+        if self._id2node is None:
+            self._id2node = {node['id']: node for node in self.nodes}
+        return self._id2node
+
+    @property
+    def class2id(self):
+        if self._class2id is None:
+            self._class2id = {}
+            for node in self.nodes:
+                if node['class_name'] not in self._class2id:
+                    self._class2id[node['class_name']] = []
+                self._class2id[node['class_name']].append(node['id'])
+        return self._class2id
+
+    def has_node(self, node_id):
+        return node_id in self.id2index and self._index_nodes[self.id2index[node_id]] is not None
+
+    def node(self, node_id):
+        node = self._index_nodes[self.id2index[node_id]]
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def node_at(self, index):
+        node = self._index_nodes[index]
+        if node is None:
+            raise KeyError(int(self.node_ids[index]))
+        return node
+
+    def _relation_indices(self, relation):
+        """relation can be a name, a list of names or a function on the name"""
+        if relation is None:
+            return list(range(len(self.relations)))
+        if callable(relation):
+            return [it for it, rel in enumerate(self.relations) if relation(rel)]
+        if isinstance(relation, str):
+            relation = [relation]
+        return [self.rel2index[rel] for rel in relation if rel in self.rel2index]
+
+    def csr(self, rel_index, reverse=False):
+        """
+        Adjacency of a relation. For node index i, the edge indices going out of i
+        (coming into i if reverse) are edge_index[indptr[i]:indptr[i+1]], in edge order.
+        """
+        key = (rel_index, reverse)
+        if key not in self._csr:
+            edges_rel = np.nonzero(self.edge_rel == rel_index)[0]
+            source = self.edge_to[edges_rel] if reverse else self.edge_from[edges_rel]
+            order = np.argsort(source, kind='stable')
+            counts = np.bincount(source, minlength=len(self.node_ids))
+            indptr = np.concatenate([[0], np.cumsum(counts)])
+            self._csr[key] = (indptr, edges_rel[order])
+        return self._csr[key]
+
+    def edge_indices(self, node_id, relation=None, reverse=False):
+        """Indices of the edges from node_id (to node_id if reverse), sorted as in the edge list"""
+        if node_id not in self.id2index:
+            return np.zeros(0, dtype=np.int64)
+        index = self.id2index[node_id]
+        res = []
+        for rel_index in self._relation_indices(relation):
+            indptr, edge_index = self.csr(rel_index, reverse)
+            res.append(edge_index[indptr[index]:indptr[index+1]])
+        if len(res) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if len(res) == 1:
+            return res[0]
+        return np.sort(np.concatenate(res))
+
+    def parent_indices(self, relation):
+        """For every node index, index of the target of its last edge with relation, -1 if it has none"""
+        if relation not in self._parents:
+            parents = np.full(len(self.node_ids), -1, dtype=np.int64)
+            if relation in self.rel2index:
+                indptr, edge_index = self.csr(self.rel2index[relation])
+                has_edge = indptr[1:] > indptr[:-1]
+                parents[has_edge] = self.edge_to[edge_index[indptr[1:][has_edge] - 1]]
+            self._parents[relation] = parents
+        return self._parents[relation]
+
+    def children_indices(self, indices, relation):
+        """Indices of the nodes with an edge relation to any of indices, in the order of indices and of the edges"""
+        if relation not in self.rel2index:
+            return np.zeros(0, dtype=np.int64)
+        indptr, edge_index = self.csr(self.rel2index[relation], reverse=True)
+        starts, ends = indptr[indices], indptr[np.asarray(indices) + 1]
+        counts = ends - starts
+        # Concatenation of the ranges starts[i]:ends[i]
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        return self.edge_from[edge_index[np.arange(counts.sum()) + offsets]]
+
+    def state_mask(self, state):
+        """Boolean array, whether each node index has a given state"""
+        if state not in self._state_masks:
+            self._state_masks[state] = np.array(
+                [node is not None and state in node['states'] for node in self._index_nodes], dtype=bool)
+        return self._state_masks[state]
+
+    def edge_tuple(self, edge_index):
+        return (int(self.node_ids[self.edge_from[edge_index]]),
+                self.relations[self.edge_rel[edge_index]],
+                int(self.node_ids[self.edge_to[edge_index]]))
+
+    def get_node_ids_from(self, node_id, relation=None):
+        return self.node_ids[self.edge_to[self.edge_indices(node_id, relation)]].tolist()
+
+    def get_node_ids_to(self, node_id, relation=None):
+        return self.node_ids[self.edge_from[self.edge_indices(node_id, relation, reverse=True)]].tolist()
+
+    def get_edges(self, relation=None):
+        """(from_id, relation, to_id) of the edges with a given relation, in edge order"""
+        rel_indices = self._relation_indices(relation)
+        edge_index = np.nonzero(np.isin(self.edge_rel, rel_indices))[0]
+        return [self.edge_tuple(it) for it in edge_index]
+
+
+def is_compact(graph):
+    return isinstance(graph, CompactGraph)
+
+def to_dict(graph):
+    if is_compact(graph):
+        return graph.to_dict()
+    return graph
+
+def _relation_matches(relation, rel_name):
+    if relation is None:
+        return True
+    if callable(relation):
+        return relation(rel_name)
+    if isinstance(relation, str):
+        return rel_name == relation
+    return rel_name in relation
+
+# Helpers that work on both graph formats. They are O(degree) with a CompactGraph
+
+def get_id2node(graph):
+    if is_compact(graph):
+        return graph.id2node
+    return {node['id']: node for node in graph['nodes']}
+
+def get_node(graph, node_id):
+    if is_compact(graph):
+        return graph.node(node_id)
+    return [node for node in graph['nodes'] if node['id'] == node_id][0]
+
+def get_node_ids_from(graph, node_id, relation=None):
+    if is_compact(graph):
+        return graph.get_node_ids_from(node_id, relation)
+    return [edge['to_id'] for edge in graph['edges'] if edge['from_id'] == node_id and _relation_matches(relation, edge['relation_type'])]
+
+def get_node_ids_to(graph, node_id, relation=None):
+    if is_compact(graph):
+        return graph.get_node_ids_to(node_id, relation)
+    return [edge['from_id'] for edge in graph['edges'] if edge['to_id'] == node_id and _relation_matches(relation, edge['relation_type'])]
+
+def get_edges(graph, relation=None):
+    if is_compact(graph):
+        return graph.get_edges(relation)
+    return [(edge['from_id'], edge['relation_type'], edge['to_id']) for edge in graph['edges'] if _relation_matches(relation, edge['relation_type'])]
@@ -356,6 +356,147 @@ class GraphHelper():
         #print(node_ids[:len(nodes)])
         return output, (graph_viz, labeldict, action_space_ids, visible_nodes)
 
+    def build_graph_sequence(self, graphs, obs_ids_per_step=None, character_id=1, ids=None,
+                             include_edges=False, action_space_ids=None, level=1):
+        """
+        build_graph for all the graphs of an episode. Returns the same arrays as build_graph, with an extra
+        time dimension. The node ordering and the class lookup are only recomputed when the nodes change,
+        and the states/edges are filled with array operations.
+        """
+        num_steps = len(graphs)
+        max_nodes = self.num_objects
+        max_edges = self.num_edges
+
+        all_class_names = np.zeros((num_steps, max_nodes)).astype(np.int32)
+        all_node_states = np.zeros((num_steps, max_nodes, len(self.states)))
+        all_node_ids = np.zeros((num_steps, max_nodes)).astype(np.int32)
+        all_edge_ids = np.zeros((num_steps, max_edges, 2)).astype(np.int32)
+        all_edge_types = np.zeros((num_steps, max_edges)).astype(np.int32)
+        mask_nodes = np.zeros((num_steps, max_nodes))
+        mask_edges = np.zeros((num_steps, max_edges))
+        mask_action_nodes = np.zeros((num_steps, max_nodes))
+        mask_obs_nodes = np.zeros((num_steps, max_nodes))
+        close_nodes = np.zeros((num_steps, max_nodes))
+        obj_coords = np.zeros((num_steps, max_nodes, 6))
+
+        no_obj_class = self.object_dict.get_id('no_obj')
+        valid_classes = self.object_dict.el2id
+        class_ids, state_index, relation_ids = {}, {}, {}
+        state_rows = []
+        prev_ids = None
+
+        for it, graph in enumerate(graphs):
+            id2node = {node['id']: node for node in graph['nodes']}
+            for node in graph['nodes']:
+                if node['category'] == 'Rooms':
+                    assert(node['class_name'] in self.rooms)
+
+            # Same ordering as build_graph
+            if ids is None:
+                step_ids = [node['id'] for node in graph['nodes'] if node['class_name'] in valid_classes]
+            else:
+                step_ids = ids
+            if level > 0:
+                step_ids = [node['id'] for node in graph['nodes'] if node['category'] == 'Rooms'] + step_ids
+            step_ids = [idi for idi in step_ids if idi != character_id]
+            step_ids = [character_id] + list(set(step_ids))
+            num_nodes = len(step_ids) + 1
+            if num_nodes > max_nodes:
+                raise Exception("Error, more nodes than allowed ({}): found {}".format(max_nodes, num_nodes))
+
+            if step_ids != prev_ids:
+                prev_ids = step_ids
+                node_ids = np.array(step_ids + [-1])
+                sort_index = np.argsort(node_ids, kind='stable')
+                sorted_ids = node_ids[sort_index]
+                for node_id in step_ids:
+                    class_name = id2node[node_id]['class_name']
+                    if class_name not in class_ids:
+                        class_ids[class_name] = self.object_dict.get_id(class_name)
+                class_names = np.array([class_ids[id2node[node_id]['class_name']] for node_id in step_ids] + [no_obj_class])
+
+            nodes = [id2node[node_id] for node_id in step_ids]
+            all_class_names[it, :num_nodes] = class_names
+            all_node_ids[it, :num_nodes] = node_ids
+            mask_nodes[it, :num_nodes] = 1.
+
+            # One hot of the states, computed once per different list of states
+            state_keys = []
+            for node in nodes:
+                key = tuple(node['states'])
+                if key not in state_index:
+                    state_index[key] = len(state_rows)
+                    state_rows.append(self.one_hot(node['states']))
+                state_keys.append(state_index[key])
+            if () not in state_index:
+                state_index[()] = len(state_rows)
+                state_rows.append(self.one_hot([]))
+            state_keys.append(state_index[()])
+            all_node_states[it, :num_nodes] = np.array(state_rows)[state_keys]
+
+            if action_space_ids is not None:
+                mask_action_nodes[it, :num_nodes] = np.isin(node_ids, action_space_ids)
+            else:
+                mask_action_nodes[it, :num_nodes] = 1.
+
+            if obs_ids_per_step is not None:
+                mask_obs_nodes[it, :num_nodes] = np.isin(node_ids, list(obs_ids_per_step[it]))
+            else:
+                mask_obs_nodes[it] = mask_nodes[it]
+
+            # Edges between the included nodes, in the order of the graph
+            edges = graph['edges']
+            if len(edges) > 0:
+                from_ids = np.array([edge['from_id'] for edge in edges])
+                to_ids = np.array([edge['to_id'] for edge in edges])
+                relations = [edge['relation_type'] for edge in edges]
+                valid = np.isin(from_ids, node_ids[:-1]) & np.isin(to_ids, node_ids[:-1])
+                from_ids, to_ids = from_ids[valid], to_ids[valid]
+                relations = [relation for relation, is_valid in zip(relations, valid) if is_valid]
+                num_edges = len(relations)
+                if include_edges and num_edges > max_edges:
+                    raise Exception("Error, more edges than allowed ({}): found {}".format(max_edges, num_edges))
+
+                if num_edges > 0:
+                    for relation in set(relations):
+                        if relation not in relation_ids:
+                            relation_ids[relation] = self.relation_dict.get_id(relation)
+                    is_close = np.array([relation == 'CLOSE' for relation in relations]) & (from_ids == 1)
+                    close_nodes[it, :num_nodes] = np.isin(node_ids, to_ids[is_close])
+
+                    if include_edges:
+                        mask_edges[it, :num_edges] = 1.
+                        all_edge_ids[it, :num_edges, 0] = sort_index[np.searchsorted(sorted_ids, from_ids)]
+                        all_edge_ids[it, :num_edges, 1] = sort_index[np.searchsorted(sorted_ids, to_ids)]
+                        all_edge_types[it, :num_edges] = [relation_ids[relation] for relation in relations]
+
+            if self.simulaor_type == 'unity':
+                bbox_available = 'bounding_box' in nodes[0].keys() and nodes[0]['bounding_box'] is not None
+                if bbox_available:
+                    has_bbox = np.array([('bounding_box' in node.keys()) for node in nodes] + [False])
+                    centers = np.zeros((num_nodes, 3))
+                    sizes = np.zeros((num_nodes, 3))
+                    centers[has_bbox] = [node['bounding_box']['center'] for node in nodes if 'bounding_box' in node.keys()]
+                    sizes[has_bbox] = [node['bounding_box']['size'] for node in nodes if 'bounding_box' in node.keys()]
+                    obj_coords[it, :num_nodes, :3] = np.where(has_bbox[:, None], centers - np.array(nodes[0]['bounding_box']['center']), 0)
+                    obj_coords[it, :num_nodes, 3:] = sizes
+
+        output = {
+            'class_objects': all_class_names,
+            'states_objects': all_node_states,
+            'edge_tuples': all_edge_ids,
+            'edge_classes': all_edge_types,
+            'mask_object': mask_nodes,
+            'mask_edge': mask_edges,
+            'mask_action_node': mask_action_nodes,
+            'mask_obs_node': mask_obs_nodes,
+            'node_ids': all_node_ids,
+            'gt_close': close_nodes
+        }
+        if self.simulaor_type == 'unity':
+            output['object_coords'] = obj_coords
+        return output
+
 def can_perform_action(action, o1, o1_id, agent_id, graph, graph_helper=None, teleport=True):
     if action == 'no_action':
         return None
@@ -517,3 +658,22 @@ def update_probs(log_probs, i, actions, object_classes, mask_observations, obj1_
         #   pdb.set_trace()
 
         return log_probs
+
+
+def cat_batch(items):
+    """Concatenates along the batch dimension a list of policy inputs/outputs (tensors, or dicts, lists and tuples of them)"""
+    first = items[0]
+    if isinstance(first, dict):
+        return {key: cat_batch([item[key] for item in items]) for key in first.keys()}
+    if isinstance(first, (list, tuple)):
+        return type(first)(cat_batch([item[it] for item in items]) for it in range(len(first)))
+    return torch.cat(items, 0)
+
+
+def get_batch_item(batch, it):
+    """Element it of a batch built with cat_batch, keeping the batch dimension"""
+    if isinstance(batch, dict):
+        return {key: get_batch_item(value, it) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(get_batch_item(value, it) for value in batch)
+    return batch[it:it+1]
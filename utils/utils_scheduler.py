@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import traceback
+import multiprocessing as mp
+
+# Durable queue of episode generation jobs, shared by the workers of the data collection scripts.
+# Every job is a (agent_type, episode_id, iter_id) unit stored in a SQLite file, so that a run can be
+# stopped at any point and restarted: done jobs are skipped, jobs that were running when the run was
+# killed go back to pending, and failed jobs are retried with exponential backoff.
+#
+# Job status: pending -> running -> done, or back to pending after a failure, until max_attempts.
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue():
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        dir_name = os.path.dirname(db_path)
+        if len(dir_name) > 0:
+            os.makedirs(dir_name, exist_ok=True)
+        # isolation_level None: transactions are opened explicitly
+        self.conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'agent_type INTEGER, episode_id INTEGER, iter_id INTEGER, '
+            'log_file TEXT, status TEXT, attempts INTEGER DEFAULT 0, next_try REAL DEFAULT 0, '
+            'worker INTEGER, error TEXT, result TEXT, updated REAL, '
+            'UNIQUE(agent_type, episode_id, iter_id))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_try)')
+
+    def close(self):
+        self.conn.close()
+
+    def add_jobs(self, jobs):
+        """Adds (agent_type, episode_id, iter_id, log_file) jobs, the ones already in the queue are kept as they are"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cursor = self.conn.executemany(
+                'INSERT OR IGNORE INTO jobs (agent_type, episode_id, iter_id, log_file, status, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                [(agent_type, episode_id, iter_id, log_file, PENDING, now) for agent_type, episode_id, iter_id, log_file in jobs])
+        return cursor.rowcount
+
+    def mark_existing_done(self):
+        """Jobs whose log file was written by a previous (or unscheduled) run are done"""
+        rows = self.conn.execute('SELECT id, log_file FROM jobs WHERE status != ?', (DONE,)).fetchall()
+        done = [(DONE, time.time(), job_id) for job_id, log_file in rows if log_file is not None and os.path.isfile(log_file)]
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('UPDATE jobs SET status = ?, updated = ? WHERE id = ?', done)
+        return len(done)
+
+    def requeue_running(self):
+        """Jobs left running by workers that died go back to pending. Call it before starting the workers"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cursor = self.conn.execute('UPDATE jobs SET status = ?, worker = NULL WHERE status = ?', (PENDING, RUNNING))
+        return cursor.rowcount
+
+    def retry_failed(self):
+        """Gives the jobs that used all their attempts another chance"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cursor = self.conn.execute('UPDATE jobs SET status = ?, attempts = 0, next_try = 0 WHERE status = ?', (PENDING, FAILED))
+        return cursor.rowcount
+
+    def claim(self, worker_id, agent_type=None):
+        """
+        Takes a pending job that can be tried now, preferring the ones of agent_type (the agents the
+        worker already has). Returns a dict with the job, or None.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute(
+                'SELECT id, agent_type, episode_id, iter_id, log_file, attempts FROM jobs '
+                'WHERE status = ? AND next_try <= ? ORDER BY (agent_type = ?) DESC, iter_id, id LIMIT 1',
+                (PENDING, now, -1 if agent_type is None else agent_type)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE jobs SET status = ?, worker = ?, updated = ? WHERE id = ?', (RUNNING, worker_id, now, row[0]))
+        keys = ['id', 'agent_type', 'episode_id', 'iter_id', 'log_file', 'attempts']
+        return dict(zip(keys, row))
+
+    def complete(self, job_id, result=None):
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('UPDATE jobs SET status = ?, result = ?, error = NULL, updated = ? WHERE id = ?',
+                              (DONE, json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error, max_attempts=3, backoff=30.):
+        """Job back to pending after backoff * 2^(attempts-1) seconds, or failed after max_attempts"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            attempts = self.conn.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0] + 1
+            status = FAILED if attempts >= max_attempts else PENDING
+            # Some jitter, so that the workers do not retry in lockstep
+            next_try = time.time() + backoff * 2 ** (attempts - 1) * random.uniform(1., 1.5)
+            self.conn.execute('UPDATE jobs SET status = ?, attempts = ?, next_try = ?, error = ?, updated = ? WHERE id = ?',
+                              (status, attempts, next_try, error, time.time(), job_id))
+        return status
+
+    def fail_worker(self, worker_id, error, max_attempts=3, backoff=30.):
+        """Fails the jobs left running by a worker that died, they go back to pending as in fail. Returns them"""
+        job_ids = [row[0] for row in self.conn.execute(
+            'SELECT id FROM jobs WHERE status = ? AND worker = ?', (RUNNING, worker_id)).fetchall()]
+        for job_id in job_ids:
+            self.fail(job_id, error, max_attempts, backoff)
+        return job_ids
+
+    def has_work(self):
+        """Whether there are jobs pending (now or after a backoff) or running"""
+        row = self.conn.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (PENDING, RUNNING)).fetchone()
+        return row[0] > 0
+
+    def progress(self):
+        """{agent_type: {status: count}}"""
+        progress = {}
+        for agent_type, status, count in self.conn.execute(
+                'SELECT agent_type, status, COUNT(*) FROM jobs GROUP BY agent_type, status ORDER BY agent_type'):
+            progress.setdefault(agent_type, {})[status] = count
+        return progress
+
+    def errors(self, limit=10):
+        return self.conn.execute(
+            'SELECT agent_type, episode_id, iter_id, attempts, error FROM jobs WHERE error IS NOT NULL '
+            'ORDER BY updated DESC LIMIT ?', (limit,)).fetchall()
+
+
+def format_progress(progress):
+    statuses = [PENDING, RUNNING, DONE, FAILED]
+    lines = ['{:>10} '.format('agent') + ' '.join('{:>8}'.format(status) for status in statuses)]
+    totals = {status: 0 for status in statuses}
+    for agent_type, counts in progress.items():
+        lines.append('{:>10} '.format(agent_type) + ' '.join('{:>8}'.format(counts.get(status, 0)) for status in statuses))
+        for status in statuses:
+            totals[status] += counts.get(status, 0)
+    lines.append('{:>10} '.format('total') + ' '.join('{:>8}'.format(totals[status]) for status in statuses))
+    return '\n'.join(lines)
+
+
+def worker_loop(worker_id, db_path, init_fn, run_fn, max_attempts=3, backoff=30., poll_interval=5.):
+    """
+    Runs jobs until the queue is empty. init_fn(worker_id) builds the state dict of the worker (e.g. an
+    ArenaMP on its own simulator port), run_fn(state, job) runs a job, updating state, and returns its
+    result. run_fn raises an exception when the job fails, after leaving state ready for the next job
+    (e.g. restarting the simulator). state['agent_type'], if set, is used to choose the next job.
+    """
+    queue = JobQueue(db_path)
+    state = init_fn(worker_id)
+    while True:
+        job = queue.claim(worker_id, state.get('agent_type', None))
+        if job is None:
+            if not queue.has_work():
+                break
+            # Jobs waiting for their backoff, or running in other workers that may fail
+            time.sleep(poll_interval)
+            continue
+        try:
+            result = run_fn(state, job)
+            queue.complete(job['id'], result)
+        except Exception as e:
+            traceback.print_exc()
+            status = queue.fail(job['id'], '{}: {}'.format(type(e).__name__, e), max_attempts, backoff)
+            print('Worker {}: job {} failed ({})'.format(worker_id, job['id'], status))
+    queue.close()
+
+
+def run_workers(num_workers, db_path, init_fn, run_fn, max_attempts=3, backoff=30., report_interval=60., max_restarts=3):
+    """
+    Runs worker_loop in num_workers processes, printing the progress every report_interval seconds.
+    The processes are not daemonic, so that the agents can start their own planning processes.
+    When a worker dies, its running jobs are failed and it is started again, up to max_restarts times.
+    """
+    def start_worker(worker_id):
+        worker = mp.Process(target=worker_loop, args=(worker_id, db_path, init_fn, run_fn, max_attempts, backoff))
+        worker.start()
+        return worker
+
+    workers = [start_worker(worker_id) for worker_id in range(num_workers)]
+    num_restarts = [0] * num_workers
+    # Workers that died and were not restarted
+    stopped = set()
+
+    queue = JobQueue(db_path)
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker_id, worker in enumerate(workers):
+                worker.join(timeout=report_interval / len(workers))
+                if worker.exitcode is None or worker.exitcode == 0 or worker_id in stopped:
+                    continue
+                # Otherwise the other workers wait for its jobs forever
+                job_ids = queue.fail_worker(worker_id, 'Worker exited with code {}'.format(worker.exitcode), max_attempts, backoff)
+                print('Worker {} exited with code {}, failed jobs {}'.format(worker_id, worker.exitcode, job_ids))
+                if num_restarts[worker_id] < max_restarts and queue.has_work():
+                    num_restarts[worker_id] += 1
+                    workers[worker_id] = start_worker(worker_id)
+                else:
+                    stopped.add(worker_id)
+            print(format_progress(queue.progress()))
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        queue.close()